@@ -0,0 +1,214 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional
+
+from app import config
+from app.timing import stage
+
+# Methods whose requests count against the read slots; every other method is a write
+READ_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+# Monitoring must answer during an overload
+EXEMPT_PATHS = frozenset(("/health", "/metrics", "/internal/stats"))
+# Streams stay open for as long as the client listens, so they take slots of their own rather than read slots
+STREAM_PATHS = frozenset(("/changes/stream",))
+# Clients whose buckets are remembered; the least recently seen is forgotten first
+MAX_CLIENTS = 10000
+
+
+class Shed(Exception):
+    """A request refused by admission control, with the status and Retry-After to answer it with"""
+
+    def __init__(self, status: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBuckets:
+    """Per-client token buckets: ``rate`` requests per second on average, bursts of up to ``burst``"""
+
+    def __init__(self, rate: float, burst: int, max_clients: int = MAX_CLIENTS):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_clients = max_clients
+        # client -> (tokens, time they were counted)
+        self._buckets: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def take(self, client: str, now: Optional[float] = None) -> float:
+        """Take a token for one request of client: 0 if it may go ahead, else seconds until it may"""
+        now = time.monotonic() if now is None else now
+        tokens, counted = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - counted) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0.0
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[client] = (tokens, now)
+        if len(self._buckets) > self.max_clients:
+            # An idle client's bucket is full again, so forgetting it only forgives a burst
+            self._buckets.popitem(last=False)
+        return wait
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class Slots:
+    """At most ``limit`` requests of a route class at once, ``queue`` more waiting up to ``timeout`` seconds
+
+    A request that finds every slot taken and the queue full is shed at
+    once, as is one that waited the whole timeout: the client hears back
+    quickly instead of piling more work on a saturated server. A finished
+    request hands its slot straight to the longest waiting one.
+    """
+
+    def __init__(self, limit: int, queue: int, timeout: float):
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.shed: Dict[str, int] = {"rate_limited": 0, "queue_full": 0, "queue_timeout": 0}
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self):
+        """Take a slot, waiting in line if all are taken; raises Shed when the line is full or too slow"""
+        if self.limit <= 0 or (self.in_flight < self.limit and not self._waiters):
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.queue:
+            self.shed["queue_full"] += 1
+            raise Shed(503, f"{self.limit} requests in flight and {self.queue} waiting", 1)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued += 1
+        try:
+            with stage("admission"):
+                await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # The slot was handed over just as the wait ran out; take it after all
+                self.admitted += 1
+                return
+            self._waiters.remove(waiter)
+            waiter.cancel()
+            self.shed["queue_timeout"] += 1
+            raise Shed(503, f"No request slot within {self.timeout}s", max(1, math.ceil(self.timeout)))
+        except asyncio.CancelledError:
+            # The client went away: give back a slot that was already handed over
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                self._waiters.remove(waiter)
+                waiter.cancel()
+            raise
+        self.admitted += 1
+
+    def release(self):
+        """Free a slot, or hand it to the next waiting request"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # The slot moves to the waiter without ever being free, so newcomers cannot jump the line
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def counts(self) -> Dict[str, int]:
+        """Requests by outcome: admitted, queued (then admitted or shed) and shed_<reason>"""
+        return {"admitted": self.admitted, "queued": self.queued,
+                **{f"shed_{reason}": count for reason, count in self.shed.items()}}
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "shed": dict(self.shed),
+        }
+
+
+class AdmissionControl:
+    """Decides whether a request is handled now, waits for a slot, or is refused at once
+
+    Each client (its ``client_header`` value when set, else its address)
+    is rate limited by a token bucket and refused with 429 Too Many
+    Requests beyond it. Reads (GET, HEAD, OPTIONS) and writes then take a
+    slot of their own class, so a flood of writes can fill the write slots
+    and queue but never keeps reads waiting; what does not fit is refused
+    with 503 Service Unavailable. Both carry a Retry-After header. Change
+    streams take "stream" slots, which nothing waits for. A slot is held
+    until the response body has been sent, not only until the handler
+    returns.
+
+    Runs on the event loop only, so its counters need no lock.
+    """
+
+    def __init__(self, rate: float = 0, burst: int = 100, client_header: str = "",
+                 max_reads: int = 64, max_writes: int = 8, queue: int = 32, queue_timeout: float = 0.5,
+                 max_streams: int = 100):
+        self.buckets = TokenBuckets(rate, burst) if rate > 0 else None
+        self.client_header = client_header.lower()
+        self.slots = {
+            "read": Slots(max_reads, queue, queue_timeout),
+            "write": Slots(max_writes, queue, queue_timeout),
+            # A queued stream could wait for as long as the open ones last
+            "stream": Slots(max_streams, 0, queue_timeout),
+        }
+
+    @staticmethod
+    def route_class(method: str, path: str) -> str:
+        if path in STREAM_PATHS:
+            return "stream"
+        return "read" if method in READ_METHODS else "write"
+
+    def client(self, request) -> str:
+        """Who the request is counted against for rate limiting"""
+        if self.client_header:
+            value = request.headers.get(self.client_header)
+            if value:
+                return value
+        return request.client.host if request.client is not None else "unknown"
+
+    async def admit(self, request) -> Optional[Slots]:
+        """Admit a request, returning the slots to release when it finishes (None if exempt); raises Shed"""
+        if request.url.path in EXEMPT_PATHS:
+            return None
+        slots = self.slots[self.route_class(request.method, request.url.path)]
+        if self.buckets is not None:
+            wait = self.buckets.take(self.client(request))
+            if wait > 0:
+                slots.shed["rate_limited"] += 1
+                raise Shed(429, "Rate limit exceeded", max(1, math.ceil(wait)))
+        await slots.acquire()
+        return slots
+
+    def stats(self) -> dict:
+        """Per route class slots and counters, and the rate limit"""
+        return {
+            "rate_limit": {
+                "rate": self.buckets.rate if self.buckets is not None else 0,
+                "burst": self.buckets.burst if self.buckets is not None else 0,
+                "clients": len(self.buckets) if self.buckets is not None else 0,
+            },
+            **{name: slots.stats() for name, slots in self.slots.items()},
+        }
+
+
+admission = AdmissionControl(
+    config.RATE_LIMIT, config.RATE_BURST, config.CLIENT_HEADER,
+    config.MAX_READS_IN_FLIGHT, config.MAX_WRITES_IN_FLIGHT,
+    config.ADMISSION_QUEUE, config.ADMISSION_QUEUE_TIMEOUT_MS / 1000, config.MAX_STREAMS,
+)
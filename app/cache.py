@@ -0,0 +1,110 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, NamedTuple, Optional
+
+# Approximate bookkeeping cost of an entry, added to its body size
+ENTRY_OVERHEAD = 200
+
+
+def encode_json(content: Any) -> bytes:
+    """Encode content exactly as FastAPI's default JSONResponse does"""
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def content_etag(body: bytes) -> str:
+    """Strong ETag derived from the response body itself"""
+    return f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+
+
+def version_etag(store, key: Hashable) -> str:
+    """ETag naming a query at the store's current version, computed without reading any data
+
+    The generation tells apart stores whose version counters restarted, e.g.
+    an in-memory store after a restart.
+    """
+    digest = hashlib.blake2b(repr(key).encode(), digest_size=6).hexdigest()
+    return f'"{store.generation}-{store.version}-{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+class CachedResponse(NamedTuple):
+    validator: Any
+    etag: str
+    body: bytes
+
+
+class ResponseCache:
+    """LRU cache of encoded JSON response bodies within a memory budget
+
+    Each entry carries a validator: the version ETag of the query for
+    listings, the record itself for single-record reads. A lookup only hits
+    when the caller's current validator equals the stored one, so a
+    mutation invalidates the entries it affects without any explicit purge;
+    stale entries are overwritten on their next miss or evicted as least
+    recently used.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _cost(entry: CachedResponse) -> int:
+        return len(entry.body) + ENTRY_OVERHEAD
+
+    def get(self, key: Hashable, validator: Any) -> Optional[CachedResponse]:
+        """Cached response for key if it is still valid for validator"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry.validator is not validator and entry.validator != validator):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Hashable, validator: Any, etag: str, body: bytes) -> CachedResponse:
+        """Store a response, evicting least recently used entries beyond the budget"""
+        entry = CachedResponse(validator, etag, body)
+        if self._cost(entry) > self.max_bytes:
+            # Larger than the whole budget: serve it once, never cache it
+            return entry
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= self._cost(old)
+            self._entries[key] = entry
+            self._size += self._cost(entry)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= self._cost(evicted)
+                self.evictions += 1
+        return entry
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0,
+                "evictions": self.evictions,
+            }
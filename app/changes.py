@@ -0,0 +1,147 @@
+import asyncio
+import threading
+import uuid
+from typing import Any, Iterable, List, Optional, Set, Tuple
+
+from app import config
+from app.sqlite_store import SqliteStore
+from app.store import Change, Record
+
+# (seq, collection, op, key, record) as kept in the log
+Entry = Tuple[int, str, str, Any, Optional[Record]]
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ChangeLog:
+    """Bounded log of the changes to the replicated collections, numbered by one global sequence
+
+    Stores registered with attach() publish every write here in commit
+    order, as inserts, updates and deletes. A client replicates by loading
+    the collections once and then asking for the changes since the last
+    sequence number it applied (see since()), so syncing costs as much as
+    the churn rather than the catalog.
+
+    Only the last ``size`` changes are kept. A client that fell further
+    behind, or that holds a position in another log (``epoch``), is told to
+    resync: reload the collections, then continue from the latest change.
+
+    In memory the log lasts as long as the process, so a restart starts a
+    new epoch. Attaching a SqliteStore keeps the log in the database
+    instead, written in the same transaction as each change: every worker
+    then shares one numbering, which also survives restarts, and the epoch
+    is the database's generation.
+    """
+
+    def __init__(self, size: int = 100000, poll_interval: float = 0.5):
+        self.size = size
+        # How often waiters look for changes made by other workers of a shared database
+        self.poll_interval = poll_interval
+        self.epoch = uuid.uuid4().hex[:8]
+        self._entries: List[Entry] = []
+        self._latest = 0
+        self._lock = threading.Lock()
+        self._database: Optional[SqliteStore] = None
+        self._waiters: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = set()
+
+    @property
+    def blocking_reads(self) -> bool:
+        """Whether reading the log queries the database, so async callers run it on a thread"""
+        return self._database is not None
+
+    def attach(self, collection: str, store):
+        """Log every change committed to store under the collection name"""
+        if isinstance(store, SqliteStore):
+            store.enable_feed(collection, self.size)
+            self._database = store
+            self.epoch = store.generation
+        else:
+            store.feed = lambda changes: self._append(collection, changes)
+
+    def _append(self, collection: str, changes: List[Change]):
+        with self._lock:
+            for op, key, record in changes:
+                self._latest += 1
+                self._entries.append((self._latest, collection, op, key, record))
+            # Trimmed a quarter of the log at a time, so appending stays O(1) amortized
+            if len(self._entries) > self.size + self.size // 4:
+                del self._entries[:len(self._entries) - self.size]
+            waiters, self._waiters = self._waiters, set()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    def _read(self, seq: int, limit: int) -> Tuple[int, int, List[Entry]]:
+        if self._database is not None:
+            return self._database.read_feed(seq, limit)
+        with self._lock:
+            oldest = self._entries[0][0] if self._entries else self._latest + 1
+            start = max(0, seq + 1 - oldest)
+            return oldest, self._latest, self._entries[start:start + limit]
+
+    def latest(self) -> int:
+        """Sequence number of the latest change"""
+        return self._read(0, 0)[1]
+
+    def since(self, seq: int, limit: int = 1000, collections: Iterable[str] = (),
+              epoch: Optional[str] = None) -> dict:
+        """Up to limit changes after seq, optionally only those of some collections
+
+        ``next_since`` is the position to ask from next time; it also moves
+        past the changes the collection filter left out. ``resync`` is true
+        when the changes after seq are no longer all in the log, or seq and
+        epoch belong to another log: the client then reloads the collections
+        and continues from ``next_since``.
+        """
+        oldest, latest, entries = self._read(seq, limit)
+        if (epoch is not None and epoch != self.epoch) or seq > latest or seq + 1 < oldest:
+            return {"epoch": self.epoch, "resync": True, "latest": latest, "next_since": latest, "changes": []}
+        wanted = set(collections)
+        changes = [
+            {"seq": number, "collection": collection, "op": op, "id": key, "record": record}
+            for number, collection, op, key, record in entries
+            if not wanted or collection in wanted
+        ]
+        return {"epoch": self.epoch, "resync": False, "latest": latest,
+                "next_since": entries[-1][0] if entries else seq, "changes": changes}
+
+    async def wait(self, seq: int, timeout: float):
+        """Wait at most timeout seconds for a change after seq; call from the event loop
+
+        With a shared database, changes made by other workers are only
+        noticed every ``poll_interval`` seconds, so this may return early.
+        """
+        if self._database is not None:
+            await asyncio.sleep(min(timeout, self.poll_interval))
+            return
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self._lock:
+            if self._latest > seq:
+                return
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+    def stats(self) -> dict:
+        """Position and retention of the log"""
+        oldest, latest, _ = self._read(0, 0)
+        return {
+            "epoch": self.epoch,
+            "storage": "sqlite" if self._database is not None else "memory",
+            "size": self.size,
+            "oldest": oldest,
+            "latest": latest,
+            "retained": latest - oldest + 1,
+            "listeners": len(self._waiters),
+        }
+
+
+change_log = ChangeLog(config.CHANGE_LOG_SIZE, config.CHANGES_POLL_MS / 1000)
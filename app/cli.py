@@ -0,0 +1,149 @@
+"""Import and export the library collections as CSV, and reshard them, from the command line
+
+Works on the configured storage directly (see app/config.py), so stop the
+API first unless it runs with "sqlite" storage, which is safe to share.
+Both directions stream: files of any size are read and written in chunks
+with constant memory. With "json" storage an import writes the data file
+once, at the end, rather than after every batch; nothing of it is on
+disk until the import finishes.
+
+Usage:
+    python -m app.cli export books [--output books.csv]
+    python -m app.cli import books data/books.csv [--rollback] [--map column:field ...]
+                                                  [--default field:value ...]
+    python -m app.cli reshard books --shards 4
+
+The import prints its progress to stderr and its summary as JSON to
+stdout, and exits with status 1 if any row failed. Resharding always
+requires the API to be stopped; afterwards start it with LIBRARY_SHARDS
+set to the new count.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import threading
+import time
+from typing import AsyncIterator, BinaryIO
+
+from app import config
+from app.ingest import BATCH_SIZE, bulk_ingest, iter_csv_rows, parse_pairs
+from app.library_manager import BookManager
+from app.models import Book, Reader, Staff
+from app.persistence import reshard
+from app.reader_manager import ReaderManager
+from app.staff_manager import StaffManager
+
+# Bytes read from the input file at a time
+CHUNK_SIZE = 64 * 1024
+
+# name: (manager class, model, stream method, bulk insert method, bulk delete method, column defaults)
+COLLECTIONS = {
+    "books": (BookManager, Book, "stream_books", "add_books_bulk", "delete_books_bulk",
+              {"year": config.CSV_DEFAULT_YEAR}),
+    "readers": (ReaderManager, Reader, "stream_readers", "add_readers_bulk", "delete_readers_bulk", {}),
+    "staff": (StaffManager, Staff, "stream_staff", "add_staff_bulk", "delete_staff_bulk", {}),
+}
+
+
+async def read_chunks(f: BinaryIO) -> AsyncIterator[bytes]:
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def export_csv(manager, stream: str, output: BinaryIO) -> int:
+    written = 0
+    for chunk in getattr(manager, stream)("csv"):
+        output.write(chunk)
+        written += len(chunk)
+    return written
+
+
+def import_csv(manager, model, insert: str, delete: str, source: BinaryIO, args, defaults: dict) -> dict:
+    started = time.perf_counter()
+
+    def progress(summary: dict):
+        rate = summary["total"] / max(time.perf_counter() - started, 1e-9)
+        print(f"\r{summary['total']} rows read, {summary['inserted']} inserted, {summary['failed']} failed "
+              f"({rate:.0f} rows/s)", end="", file=sys.stderr, flush=True)
+
+    rows = iter_csv_rows(read_chunks(source), model.model_fields, parse_pairs(args.map),
+                         {**defaults, **parse_pairs(args.default)})
+    summary = asyncio.run(bulk_ingest(rows, model, getattr(manager, insert), getattr(manager, delete),
+                                      rollback=args.rollback, batch_size=args.batch_size, progress=progress))
+    print(file=sys.stderr)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="write a collection as CSV")
+    export.add_argument("collection", choices=COLLECTIONS)
+    export.add_argument("--output", "-o", default="-", help="output file, - for stdout")
+
+    imports = commands.add_parser("import", help="insert the rows of a CSV file into a collection")
+    imports.add_argument("collection", choices=COLLECTIONS)
+    imports.add_argument("file", help="input file, - for stdin")
+    imports.add_argument("--rollback", action="store_true",
+                         help="stop at the first failing row and delete the rows inserted so far")
+    imports.add_argument("--map", action="append", default=[], metavar="COLUMN:FIELD",
+                         help="read FIELD from a differently named CSV column")
+    imports.add_argument("--default", action="append", default=[], metavar="FIELD:VALUE",
+                         help="value for FIELD where the CSV has no column or an empty cell")
+    imports.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+
+    resharding = commands.add_parser("reshard", help="redistribute a collection's data files over N shards")
+    resharding.add_argument("collection", choices=COLLECTIONS)
+    resharding.add_argument("--shards", type=int, required=True)
+    args = parser.parse_args()
+
+    if args.command == "reshard":
+        try:
+            print(json.dumps(reshard(args.collection, args.shards), indent=2))
+        except ValueError as e:
+            parser.error(str(e))
+        return
+
+    if args.command == "import" and config.STORAGE_MODE == "json":
+        # "json" rewrites the whole file on every write, which would make an import quadratic:
+        # the changes are queued instead and the file is written once, when the manager closes
+        config.DURABILITY = "async"
+        config.FLUSH_INTERVAL_MS = threading.TIMEOUT_MAX * 1000
+        config.FLUSH_MAX_BATCH = sys.maxsize
+
+    manager_class, model, stream, insert, delete, defaults = COLLECTIONS[args.collection]
+    manager = manager_class()
+    manager.open()
+    try:
+        if args.command == "export":
+            if args.output == "-":
+                export_csv(manager, stream, sys.stdout.buffer)
+            else:
+                with open(args.output, "wb") as output:
+                    written = export_csv(manager, stream, output)
+                print(f"Wrote {len(manager.store)} {args.collection} ({written} bytes) to {args.output}",
+                      file=sys.stderr)
+            return
+
+        try:
+            if args.file == "-":
+                summary = import_csv(manager, model, insert, delete, sys.stdin.buffer, args, defaults)
+            else:
+                with open(args.file, "rb") as source:
+                    summary = import_csv(manager, model, insert, delete, source, args, defaults)
+        except ValueError as e:
+            parser.error(str(e))
+        print(json.dumps(summary, indent=2))
+        if summary["failed"]:
+            raise SystemExit(1)
+    finally:
+        manager.close()
+
+
+if __name__ == "__main__":
+    main()
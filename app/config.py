@@ -0,0 +1,149 @@
+import os
+
+# -------------------------
+# Storage
+# -------------------------
+# Directory holding the books/readers/staff data files
+DATA_DIR = os.getenv("LIBRARY_DATA_DIR", "app/data")
+
+# "json" rewrites the whole data file after every change,
+# "journal" appends one line per change and compacts into a snapshot,
+# "snapshot" is "journal" with a memory-mapped binary snapshot decoded lazily,
+# "sqlite" keeps every store in one WAL-mode database shared by all workers
+STORAGE_MODE = os.getenv("LIBRARY_STORAGE", "json")
+
+# In-memory representation of records for the "json" and "journal" modes:
+#   "dict"     - one dict per record, as loaded
+#   "slots"    - one __slots__ object per record, low-cardinality strings interned
+#   "columnar" - one array per field, low-cardinality strings stored as codes
+RECORD_LAYOUT = os.getenv("LIBRARY_RECORD_LAYOUT", "dict")
+
+# Database file (inside DATA_DIR) used by the "sqlite" storage mode
+SQLITE_FILE = os.getenv("LIBRARY_SQLITE_FILE", "library.db")
+
+# Books, readers and staff are split into this many shards by id hash, each with
+# its own lock, indexes and data files; change it with "python -m app.cli reshard"
+SHARDS = int(os.getenv("LIBRARY_SHARDS", "1"))
+
+# Number of journal entries after which the journal is folded into the snapshot
+JOURNAL_COMPACT_EVERY = int(os.getenv("LIBRARY_JOURNAL_COMPACT_EVERY", "10000"))
+
+# How writes reach the disk:
+#   "sync"  - each request writes (and fsyncs) its own change before returning
+#   "group" - requests wait for a shared background flush (group commit)
+#   "async" - requests return immediately, changes are flushed in the background
+DURABILITY = os.getenv("LIBRARY_DURABILITY", "sync")
+
+# Background flush cadence for the "group" and "async" modes
+FLUSH_INTERVAL_MS = float(os.getenv("LIBRARY_FLUSH_INTERVAL_MS", "10"))
+FLUSH_MAX_BATCH = int(os.getenv("LIBRARY_FLUSH_MAX_BATCH", "1000"))
+
+# -------------------------
+# Logging
+# -------------------------
+LOG_LEVEL = os.getenv("LIBRARY_LOG_LEVEL", "INFO")
+
+# Application log and per-request access log
+LOG_FILE = os.getenv("LIBRARY_LOG_FILE", "app.log")
+ACCESS_LOG_FILE = os.getenv("LIBRARY_ACCESS_LOG_FILE", "logs/api.log")
+
+# "text" for the classic line format, "json" for one JSON object per line
+LOG_FORMAT = os.getenv("LIBRARY_LOG_FORMAT", "text")
+
+# Log files rotate once they reach LOG_MAX_BYTES, or on a schedule when
+# LOG_ROTATE_WHEN is set ("midnight", "h", "d", ... as in TimedRotatingFileHandler)
+LOG_MAX_BYTES = int(os.getenv("LIBRARY_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_ROTATE_WHEN = os.getenv("LIBRARY_LOG_ROTATE_WHEN", "")
+LOG_BACKUP_COUNT = int(os.getenv("LIBRARY_LOG_BACKUP_COUNT", "5"))
+
+# Records waiting for the background writer; further records are dropped
+LOG_QUEUE_SIZE = int(os.getenv("LIBRARY_LOG_QUEUE_SIZE", "10000"))
+
+# Request body capture in the access log:
+#   "off"      - bodies are not logged
+#   "truncate" - the first LOG_BODY_MAX_BYTES of every body are logged
+#   "sample"   - like "truncate", for a LOG_BODY_SAMPLE_RATE fraction of requests
+LOG_BODY = os.getenv("LIBRARY_LOG_BODY", "truncate")
+LOG_BODY_MAX_BYTES = int(os.getenv("LIBRARY_LOG_BODY_MAX_BYTES", "1024"))
+LOG_BODY_SAMPLE_RATE = float(os.getenv("LIBRARY_LOG_BODY_SAMPLE_RATE", "0.01"))
+
+# -------------------------
+# CSV import
+# -------------------------
+# Year given to imported books whose CSV has no year column, as data/books.csv;
+# 0 stands for "unknown" and can be overridden per import
+CSV_DEFAULT_YEAR = int(os.getenv("LIBRARY_CSV_DEFAULT_YEAR", "0"))
+
+# -------------------------
+# Response cache
+# -------------------------
+# Memory budget for encoded GET responses; 0 disables caching (ETags still apply)
+RESPONSE_CACHE_MB = float(os.getenv("LIBRARY_RESPONSE_CACHE_MB", "64"))
+
+# -------------------------
+# Request timing and profiling
+# -------------------------
+# "on" adds a Server-Timing header with per-stage durations to every response
+SERVER_TIMING = os.getenv("LIBRARY_SERVER_TIMING", "off") == "on"
+
+# Requests whose X-Debug-Token header carries this value get Server-Timing and may
+# ask for a profile with X-Debug-Profile: cprofile|sample; empty disables the header
+DEBUG_TOKEN = os.getenv("LIBRARY_DEBUG_TOKEN", "")
+
+# Where requested profiles are saved, and the stack sampling period of "sample" profiles
+PROFILE_DIR = os.getenv("LIBRARY_PROFILE_DIR", "logs/profiles")
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("LIBRARY_PROFILE_SAMPLE_INTERVAL_MS", "1"))
+
+# -------------------------
+# Async write path
+# -------------------------
+# How the async handlers run store writes:
+#   "writer"     - on dedicated writer threads; group commits are awaited without holding a thread
+#   "threadpool" - reads and writes on the shared AnyIO threadpool, holding a thread until
+#                  durable, as the plain def handlers did
+WRITE_PATH = os.getenv("LIBRARY_WRITE_PATH", "writer")
+WRITER_THREADS = int(os.getenv("LIBRARY_WRITER_THREADS", "2"))
+
+# Writes in flight before further writes wait for room, and the seconds
+# they wait before being refused with 503 Service Unavailable
+MAX_PENDING_WRITES = int(os.getenv("LIBRARY_MAX_PENDING_WRITES", "1000"))
+WRITE_QUEUE_TIMEOUT = float(os.getenv("LIBRARY_WRITE_QUEUE_TIMEOUT", "5"))
+
+# -------------------------
+# Loans
+# -------------------------
+# Default loan period in days, and how many times a loan may be renewed
+LOAN_DAYS = int(os.getenv("LIBRARY_LOAN_DAYS", "14"))
+LOAN_MAX_RENEWALS = int(os.getenv("LIBRARY_LOAN_MAX_RENEWALS", "2"))
+
+# -------------------------
+# Change feed
+# -------------------------
+# Changes kept for GET /changes; clients further behind are told to resync
+CHANGE_LOG_SIZE = int(os.getenv("LIBRARY_CHANGE_LOG_SIZE", "100000"))
+
+# Seconds between keep-alive comments on an idle change stream, and how often
+# the stream looks for changes made by other workers with sqlite storage
+CHANGES_HEARTBEAT = float(os.getenv("LIBRARY_CHANGES_HEARTBEAT", "15"))
+CHANGES_POLL_MS = int(os.getenv("LIBRARY_CHANGES_POLL_MS", "500"))
+
+# -------------------------
+# Admission control
+# -------------------------
+# Requests per second allowed per client on average, and the burst above it;
+# further requests get 429 Too Many Requests. 0 disables rate limiting
+RATE_LIMIT = float(os.getenv("LIBRARY_RATE_LIMIT", "0"))
+RATE_BURST = int(os.getenv("LIBRARY_RATE_BURST", "100"))
+# Header identifying the client for rate limiting (e.g. X-API-Key, or X-Forwarded-For
+# behind a proxy); the peer address when empty or absent
+CLIENT_HEADER = os.getenv("LIBRARY_CLIENT_HEADER", "")
+
+# Requests handled at once, reads (GET, HEAD) and writes counted separately; 0 removes the cap
+MAX_READS_IN_FLIGHT = int(os.getenv("LIBRARY_MAX_READS_IN_FLIGHT", "64"))
+MAX_WRITES_IN_FLIGHT = int(os.getenv("LIBRARY_MAX_WRITES_IN_FLIGHT", "8"))
+# Change streams open at once; further ones are refused without waiting. 0 removes the cap
+MAX_STREAMS = int(os.getenv("LIBRARY_MAX_STREAMS", "100"))
+# Requests of each class waiting for a slot, and the milliseconds they wait, before
+# further ones are refused with 503 Service Unavailable
+ADMISSION_QUEUE = int(os.getenv("LIBRARY_ADMISSION_QUEUE", "32"))
+ADMISSION_QUEUE_TIMEOUT_MS = int(os.getenv("LIBRARY_ADMISSION_QUEUE_TIMEOUT_MS", "500"))
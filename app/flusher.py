@@ -0,0 +1,256 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger("api")
+
+DURABILITY_MODES = ("sync", "group", "async")
+
+
+def percentiles(samples: Iterable[float], points=(50, 95, 99)) -> dict:
+    """Nearest-rank percentiles of samples, keyed as p50/p95/p99"""
+    ordered = sorted(samples)
+    if not ordered:
+        return {f"p{p}": None for p in points}
+    return {f"p{p}": round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))], 3) for p in points}
+
+
+def _settle(future: asyncio.Future, error: Optional[Exception]):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+
+class FlushingPersistence:
+    """Write-behind wrapper that coalesces changes into batched disk writes
+
+    In "sync" mode every change is written and fsynced by the calling thread.
+    In "group" mode changes are queued and a background thread writes them as
+    one batch every ``interval_ms`` or every ``max_batch`` changes, with each
+    caller blocking until its batch is durable. "async" uses the same flusher
+    but lets callers return as soon as the change is queued.
+    """
+
+    def __init__(self, inner, mode: str = "sync", interval_ms: float = 10.0, max_batch: int = 1000):
+        if mode not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {mode}")
+        self.inner = inner
+        self.path = inner.path
+        self.mode = mode
+        self.interval = interval_ms / 1000
+        self.max_batch = max_batch
+
+        self._cond = threading.Condition()
+        self._write_lock = threading.RLock()
+        self._pending: List[Tuple[Tuple[str, Any], float]] = []
+        self._queued_seq = 0
+        self._flushed_seq = 0
+        self._error: Optional[Tuple[Exception, int]] = None
+        self._closed = False
+        # (ticket, loop, future) of callers of wait_async(), resolved by flush()
+        self._async_waiters: List[Tuple[int, asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+        self._started = time.perf_counter()
+        self._writes = 0
+        self._flushes = 0
+        self._errors = 0
+        self._commit_latency: Deque[float] = deque(maxlen=10000)
+        self._flush_time: Deque[float] = deque(maxlen=10000)
+
+        self._thread = None
+        if mode != "sync":
+            self._thread = threading.Thread(
+                target=self._run, name=f"flusher-{os.path.basename(self.path)}", daemon=True
+            )
+            self._thread.start()
+
+    # -------------------------
+    # Persistence interface
+    # -------------------------
+    def bind(self, source):
+        self.inner.bind(source)
+
+    def load(self):
+        return self.inner.load()
+
+    def put(self, record):
+        self.wait(self.submit([("put", record)]))
+
+    def delete(self, key):
+        self.wait(self.submit([("del", key)]))
+
+    def put_many(self, records):
+        self.wait(self.submit([("put", record) for record in records]))
+
+    def delete_many(self, keys):
+        self.wait(self.submit([("del", key) for key in keys]))
+
+    def compact(self):
+        """Flush queued changes, then compact the underlying persistence"""
+        with self._write_lock:
+            self.flush()
+            self.inner.compact()
+
+    def close(self):
+        """Flush everything still queued and release the underlying persistence"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        self.inner.close()
+
+    # -------------------------
+    # Write path
+    # -------------------------
+    def submit(self, entries: List[Tuple[str, Any]]) -> int:
+        """Hand changes over for writing and return the ticket to wait on
+
+        Writers that need their changes applied in order submit while holding
+        their own lock and call wait() after releasing it, so concurrent
+        writers still share one group commit.
+        """
+        if not entries:
+            return 0
+        if self.mode == "sync":
+            started = time.perf_counter()
+            with self._write_lock:
+                self.inner.write_batch(list(entries))
+            elapsed = (time.perf_counter() - started) * 1000
+            with self._cond:
+                self._writes += len(entries)
+                self._flushes += 1
+                self._commit_latency.append(elapsed)
+                self._flush_time.append(elapsed)
+            return 0
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"Persistence for {self.path} is closed")
+            was_empty = not self._pending
+            queued = time.perf_counter()
+            self._pending.extend((entry, queued) for entry in entries)
+            self._queued_seq += len(entries)
+            if was_empty or len(self._pending) >= self.max_batch:
+                self._cond.notify_all()
+            return self._queued_seq
+
+    def wait(self, ticket: int):
+        """Block until the changes up to ticket are durable ("group" mode only)"""
+        if self.mode != "group" or not ticket:
+            return
+        with self._cond:
+            while self._flushed_seq < ticket:
+                if self._error is not None and self._error[1] >= ticket:
+                    raise self._error[0]
+                self._cond.wait()
+
+    def wait_async(self, ticket: int) -> asyncio.Future:
+        """Future resolved once the changes up to ticket are durable, to await without holding a thread"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            if self.mode != "group" or not ticket or self._flushed_seq >= ticket:
+                future.set_result(None)
+            elif self._error is not None and self._error[1] >= ticket:
+                future.set_exception(self._error[0])
+            else:
+                self._async_waiters.append((ticket, loop, future))
+        return future
+
+    def _wake_async_waiters(self, upto: int, error: Optional[Exception] = None):
+        """Resolve the wait_async() futures of tickets up to upto; called under the condition"""
+        waiting = []
+        for ticket, loop, future in self._async_waiters:
+            if ticket > upto:
+                waiting.append((ticket, loop, future))
+                continue
+            try:
+                loop.call_soon_threadsafe(_settle, future, error)
+            except RuntimeError:
+                # The waiter's event loop is gone
+                pass
+        self._async_waiters = waiting
+
+    def flush(self):
+        """Write every queued change now, on the calling thread"""
+        with self._write_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+                upto = self._queued_seq
+            if not batch:
+                return
+
+            started = time.perf_counter()
+            try:
+                self.inner.write_batch([entry for entry, _ in batch])
+            except Exception as e:
+                logger.error("Error flushing %s changes to %s: %s", len(batch), self.path, e)
+                with self._cond:
+                    # Keep the batch for the next attempt and fail its waiters
+                    self._pending[:0] = batch
+                    self._error = (e, upto)
+                    self._errors += 1
+                    self._wake_async_waiters(upto, e)
+                    self._cond.notify_all()
+                return
+
+            done = time.perf_counter()
+            with self._cond:
+                self._flushed_seq = upto
+                self._error = None
+                self._writes += len(batch)
+                self._flushes += 1
+                self._flush_time.append((done - started) * 1000)
+                self._commit_latency.extend((done - queued) * 1000 for _, queued in batch)
+                self._wake_async_waiters(upto)
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed and not self._pending:
+                    return
+
+                # Let the batch fill up until the interval elapses or it is full
+                deadline = time.perf_counter() + self.interval
+                while len(self._pending) < self.max_batch and not self._closed:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()
+
+    # -------------------------
+    # Monitoring
+    # -------------------------
+    def pending(self) -> int:
+        """Number of changes queued but not yet written"""
+        with self._cond:
+            return len(self._pending)
+
+    def stats(self) -> dict:
+        """Throughput and latency figures for this persistence"""
+        with self._cond:
+            elapsed = time.perf_counter() - self._started
+            return {
+                "mode": self.mode,
+                "pending_writes": len(self._pending),
+                "writes": self._writes,
+                "flushes": self._flushes,
+                "errors": self._errors,
+                "avg_batch_size": round(self._writes / self._flushes, 2) if self._flushes else 0,
+                "writes_per_sec": round(self._writes / elapsed, 2) if elapsed else 0,
+                "commit_latency_ms": percentiles(self._commit_latency),
+                "flush_time_ms": percentiles(self._flush_time),
+            }
@@ -0,0 +1,251 @@
+import math
+from bisect import bisect_left, bisect_right, insort
+from itertools import chain, islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+
+class SortedKeyList:
+    """Sorted list of keys split into blocks of bounded size
+
+    Inserts and removals only shift items inside one block, so they stay
+    cheap at millions of keys, and range scans are a bisect followed by a
+    walk over consecutive blocks.
+    """
+
+    __slots__ = ("_load", "_blocks", "_maxes", "_len")
+
+    def __init__(self, keys: Iterable[Any] = (), load: int = 1000):
+        self._load = load
+        self._blocks: List[list] = []
+        self._maxes: list = []
+        self._len = 0
+        self.update(keys)
+
+    def update(self, keys: Iterable[Any]):
+        """Add many keys at once by re-sorting and re-chunking"""
+        merged = sorted(chain(chain.from_iterable(self._blocks), keys))
+        self._blocks = [merged[i:i + self._load] for i in range(0, len(merged), self._load)]
+        self._maxes = [block[-1] for block in self._blocks]
+        self._len = len(merged)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[Any]:
+        return chain.from_iterable(self._blocks)
+
+    def __contains__(self, key: Any) -> bool:
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return False
+        block = self._blocks[i]
+        j = bisect_left(block, key)
+        return j < len(block) and block[j] == key
+
+    def add(self, key: Any):
+        """Insert a key, keeping the list sorted"""
+        if not self._blocks:
+            self._blocks.append([key])
+            self._maxes.append(key)
+            self._len = 1
+            return
+
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+            self._blocks[i].append(key)
+            self._maxes[i] = key
+        else:
+            insort(self._blocks[i], key)
+        self._len += 1
+
+        block = self._blocks[i]
+        if len(block) > 2 * self._load:
+            self._blocks[i:i + 1] = [block[:self._load], block[self._load:]]
+            self._maxes[i:i + 1] = [block[self._load - 1], block[-1]]
+
+    def remove(self, key: Any) -> bool:
+        """Remove a key, returning whether it was present"""
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return False
+        block = self._blocks[i]
+        j = bisect_left(block, key)
+        if j == len(block) or block[j] != key:
+            return False
+
+        del block[j]
+        self._len -= 1
+        if block:
+            self._maxes[i] = block[-1]
+        else:
+            del self._blocks[i]
+            del self._maxes[i]
+        return True
+
+    def _position(self, key: Any, right: bool = False) -> int:
+        """Number of keys below key, or up to and including it if right"""
+        find = bisect_right if right else bisect_left
+        i = find(self._maxes, key)
+        if i == len(self._maxes):
+            return self._len
+        return sum(map(len, self._blocks[:i])) + find(self._blocks[i], key)
+
+    def count_range(self, lo: Optional[Any] = None, hi: Optional[Any] = None) -> int:
+        """Number of keys between lo and hi inclusive, counted block by block without walking them"""
+        start = self._position(lo) if lo is not None else 0
+        stop = self._position(hi, right=True) if hi is not None else self._len
+        return max(stop - start, 0)
+
+    def irange(self, lo: Optional[Any] = None, hi: Optional[Any] = None, exclusive_lo: bool = False) -> Iterator[Any]:
+        """Iterate keys between lo and hi (inclusive unless exclusive_lo) in order"""
+        if lo is None:
+            i, j = 0, 0
+        else:
+            find = bisect_right if exclusive_lo else bisect_left
+            i = find(self._maxes, lo)
+            if i == len(self._blocks):
+                return
+            j = find(self._blocks[i], lo)
+
+        for block in self._blocks[i:]:
+            for key in block[j:] if j else block:
+                if hi is not None and key > hi:
+                    return
+                yield key
+            j = 0
+
+
+class UniqueViolation(ValueError):
+    """A write that would give two records the same value of a unique index"""
+
+
+class HashIndex:
+    """Equality index mapping a field value to the keys of the records holding it
+
+    The keys of each value are kept sorted, so a query can walk them in key
+    order and stop early. A ``unique`` index allows each value on one
+    record only. SqliteStore enforces it with a unique column index, across
+    every worker, and raises UniqueViolation; in-memory stores leave it to
+    their single process.
+    """
+
+    # keys() walks a bucket that is already in key order
+    key_ordered = True
+
+    def __init__(self, field: str, normalize: Optional[Callable[[Any], Any]] = None, unique: bool = False):
+        self.field = field
+        self.normalize = normalize
+        self.unique = unique
+        self._keys: Dict[Any, SortedKeyList] = {}
+
+    def _value(self, value: Any) -> Any:
+        return self.normalize(value) if self.normalize is not None else value
+
+    def add(self, key: Any, record: dict):
+        value = self._value(record.get(self.field))
+        keys = self._keys.get(value)
+        if keys is None:
+            self._keys[value] = SortedKeyList((key,))
+        else:
+            keys.add(key)
+
+    def remove(self, key: Any, record: dict):
+        value = self._value(record.get(self.field))
+        keys = self._keys.get(value)
+        if keys is not None:
+            keys.remove(key)
+            if not keys:
+                del self._keys[value]
+
+    def rebuild(self, records: Dict[Any, dict]):
+        groups: Dict[Any, list] = {}
+        for key, record in records.items():
+            groups.setdefault(self._value(record.get(self.field)), []).append(key)
+        self._keys = {value: SortedKeyList(keys) for value, keys in groups.items()}
+
+    def match(self, value: Any) -> Set[Any]:
+        """Keys of the records whose field equals value"""
+        return set(self._keys.get(self._value(value), ()))
+
+    def count(self, value: Any) -> int:
+        """Number of records whose field equals value"""
+        keys = self._keys.get(self._value(value))
+        return len(keys) if keys is not None else 0
+
+    def keys(self, value: Any, after: Optional[Any] = None) -> Iterator[Any]:
+        """Keys greater than after of the records whose field equals value, in key order"""
+        keys = self._keys.get(self._value(value))
+        if keys is None:
+            return iter(())
+        return keys.irange(after, exclusive_lo=True)
+
+    def accepts(self, record: dict, value: Any) -> bool:
+        """Whether record's field equals value"""
+        return self._value(record.get(self.field)) == self._value(value)
+
+
+class RangeIndex:
+    """Ordered index of (value, key) pairs answering range queries on a field"""
+
+    # keys() has to sort the keys in range
+    key_ordered = False
+
+    def __init__(self, field: str):
+        self.field = field
+        self._entries = SortedKeyList()
+
+    def add(self, key: Any, record: dict):
+        self._entries.add((record[self.field], key))
+
+    def remove(self, key: Any, record: dict):
+        self._entries.remove((record[self.field], key))
+
+    def rebuild(self, records: Dict[Any, dict]):
+        self._entries = SortedKeyList((record[self.field], key) for key, record in records.items())
+
+    @staticmethod
+    def _limits(bounds: Tuple[Optional[Any], Optional[Any]]) -> Tuple[Optional[tuple], Optional[tuple]]:
+        low, high = bounds
+        return (low,) if low is not None else None, (high, math.inf) if high is not None else None
+
+    def match(self, bounds: Tuple[Optional[Any], Optional[Any]]) -> Set[Any]:
+        """Keys of the records whose field lies within the inclusive (low, high) bounds"""
+        return {key for _, key in self._entries.irange(*self._limits(bounds))}
+
+    def count(self, bounds: Tuple[Optional[Any], Optional[Any]]) -> int:
+        """Number of records whose field lies within the inclusive (low, high) bounds"""
+        return self._entries.count_range(*self._limits(bounds))
+
+    def keys(self, bounds: Tuple[Optional[Any], Optional[Any]], after: Optional[Any] = None) -> Iterator[Any]:
+        """Keys greater than after of the records within the bounds, in key order
+
+        The entries are ordered by value, so every key in range is collected
+        and sorted first.
+        """
+        keys = sorted(self.match(bounds))
+        return islice(keys, bisect_right(keys, after) if after is not None else 0, None)
+
+    def accepts(self, record: dict, bounds: Tuple[Optional[Any], Optional[Any]]) -> bool:
+        """Whether record's field lies within the inclusive (low, high) bounds"""
+        low, high = bounds
+        value = record[self.field]
+        return (low is None or value >= low) and (high is None or value <= high)
+
+    def walk(self, bounds: Tuple[Optional[Any], Optional[Any]],
+             after: Optional[Tuple[Any, Any]] = None) -> Iterator[Any]:
+        """Keys of the records within the inclusive (low, high) bounds in (value, key) order
+
+        Starts after the (value, key) position ``after`` when given, so
+        reading the first n keys costs a bisect plus n steps.
+        """
+        low, high = bounds
+        if after is not None and (low is None or tuple(after) >= (low,)):
+            entries = self._entries.irange(tuple(after), None, exclusive_lo=True)
+        else:
+            entries = self._entries.irange((low,) if low is not None else None)
+        upper = (high, math.inf) if high is not None else None
+        for entry in entries:
+            if upper is not None and entry > upper:
+                return
+            yield entry[1]
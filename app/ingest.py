@@ -0,0 +1,306 @@
+import asyncio
+import codecs
+import csv
+import io
+import json
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple, Type
+
+from pydantic import BaseModel, ValidationError
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger("api")
+
+# Rows are validated and persisted in batches of this size
+BATCH_SIZE = 1000
+# Only the first errors are listed in the summary; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+# Rows between two progress log lines of an import
+PROGRESS_EVERY = 100_000
+
+_WHITESPACE = " \t\r\n"
+
+
+class RowError(Exception):
+    """A row that could not be parsed from the request body"""
+
+
+async def iter_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Any]]:
+    """Yield (row number, value) pairs from a streamed JSON array or NDJSON body
+
+    The format is detected from the first non-whitespace character. Only the
+    current chunk and one partial row are held in memory, so arbitrarily
+    large bodies can be consumed. Unparseable rows are yielded as RowError.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    iterator = chunks.__aiter__()
+    while not buffer.strip():
+        try:
+            buffer += decoder.decode(await iterator.__anext__())
+        except StopAsyncIteration:
+            buffer += decoder.decode(b"", final=True)
+            break
+    buffer = buffer.lstrip(_WHITESPACE)
+    if not buffer:
+        return
+
+    if buffer[0] == "[":
+        parse = _iter_json_array
+    else:
+        parse = _iter_ndjson
+    async for row in parse(buffer, iterator, decoder):
+        yield row
+
+
+def parse_pairs(pairs: Iterable[str]) -> Dict[str, str]:
+    """Parse "name:value" pairs, as given for CSV column mappings and defaults"""
+    parsed = {}
+    for pair in pairs:
+        name, sep, value = pair.partition(":")
+        if not sep or not name.strip():
+            raise ValueError(f"Expected name:value, got {pair!r}")
+        parsed[name.strip()] = value.strip()
+    return parsed
+
+
+def _complete_records(text: str) -> int:
+    """Length of the longest prefix of text made of whole CSV records
+
+    A newline ends a record unless it falls inside a quoted field, i.e.
+    after an odd number of quote characters; escaped quotes come in pairs
+    and keep the parity.
+    """
+    end = pos = quotes = 0
+    while True:
+        newline = text.find("\n", pos)
+        if newline < 0:
+            return end
+        quotes += text.count('"', pos, newline)
+        pos = newline + 1
+        if quotes % 2 == 0:
+            end = pos
+
+
+async def iter_csv_rows(chunks: AsyncIterator[bytes], fields: Iterable[str],
+                        mapping: Optional[Dict[str, str]] = None,
+                        defaults: Optional[Dict[str, Any]] = None) -> AsyncIterator[Tuple[int, Any]]:
+    """Yield (row number, record) pairs from a streamed CSV body with a header row
+
+    Header names are matched to ``fields`` case-insensitively, after
+    renaming through ``mapping`` (CSV column to field); other columns are
+    ignored. Empty cells count as missing, and missing fields take their
+    value from ``defaults`` if it has one. Row numbers count data rows.
+    Only the current chunk and one partial record are held in memory.
+    """
+    known = {field.casefold(): field for field in fields}
+    renamed = {column.casefold(): field for column, field in (mapping or {}).items()}
+    defaults = defaults or {}
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    iterator = chunks.__aiter__()
+    columns: Optional[List[Optional[str]]] = None
+    buffer = ""
+    row_no = 0
+    eof = False
+    while not eof:
+        try:
+            buffer += decoder.decode(await iterator.__anext__())
+        except StopAsyncIteration:
+            buffer += decoder.decode(b"", final=True)
+            eof = True
+        end = len(buffer) if eof else _complete_records(buffer)
+        if not end:
+            continue
+        for cells in csv.reader(io.StringIO(buffer[:end])):
+            if not cells:
+                continue
+            if columns is None:
+                header = [cell.strip() for cell in cells]
+                columns = [known.get(renamed.get(name.casefold(), name).casefold()) for name in header]
+                ignored = [name for name, field in zip(header, columns) if field is None]
+                if ignored:
+                    logger.info("Ignoring CSV columns %s", ", ".join(ignored))
+                continue
+            row_no += 1
+            if len(cells) != len(columns):
+                yield row_no, RowError(f"Expected {len(columns)} fields, got {len(cells)}")
+                continue
+            record = dict(defaults)
+            record.update((field, cell) for field, cell in zip(columns, cells) if field is not None and cell != "")
+            yield row_no, record
+        buffer = buffer[end:]
+
+
+async def _iter_ndjson(buffer: str, iterator, decoder) -> AsyncIterator[Tuple[int, Any]]:
+    row_no = 0
+    eof = False
+    while True:
+        *lines, buffer = buffer.split("\n")
+        if eof and buffer:
+            lines.append(buffer)
+        for line in lines:
+            if not line.strip():
+                continue
+            row_no += 1
+            try:
+                yield row_no, json.loads(line)
+            except json.JSONDecodeError as e:
+                yield row_no, RowError(f"Invalid JSON: {e}")
+        if eof:
+            return
+        try:
+            buffer += decoder.decode(await iterator.__anext__())
+        except StopAsyncIteration:
+            buffer += decoder.decode(b"", final=True)
+            eof = True
+
+
+async def _iter_json_array(buffer: str, iterator, decoder) -> AsyncIterator[Tuple[int, Any]]:
+    json_decoder = json.JSONDecoder()
+    row_no = 0
+    pos = 1  # skip the opening bracket
+    eof = False
+    while True:
+        while True:
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE + ",":
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == "]":
+                return
+            try:
+                value, end = json_decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                if eof:
+                    row_no += 1
+                    yield row_no, RowError(f"Invalid JSON: {e}")
+                    return
+                break
+            if end >= len(buffer) and not eof:
+                # A value touching the end of the buffer may still be incomplete
+                break
+            row_no += 1
+            yield row_no, value
+            pos = end
+
+        if eof:
+            row_no += 1
+            yield row_no, RowError("Unterminated JSON array")
+            return
+        buffer = buffer[pos:]
+        pos = 0
+        try:
+            buffer += decoder.decode(await iterator.__anext__())
+        except StopAsyncIteration:
+            buffer += decoder.decode(b"", final=True)
+            eof = True
+
+
+def log_progress(label: str, every: int = PROGRESS_EVERY) -> Callable[[dict], None]:
+    """Progress callback for bulk_ingest that logs the running totals every ``every`` rows"""
+    logged = 0
+
+    def report(summary: dict):
+        nonlocal logged
+        if summary["total"] - logged >= every:
+            logged = summary["total"]
+            logger.info("%s: %s rows read, %s inserted, %s failed", label, summary["total"],
+                        summary["inserted"], summary["failed"])
+
+    return report
+
+
+def _format_error(error: Exception) -> str:
+    if isinstance(error, ValidationError):
+        return "; ".join(
+            f"{'.'.join(str(p) for p in e['loc']) or 'row'}: {e['msg']}" for e in error.errors()
+        )
+    return str(error)
+
+
+async def _run(function: Callable, *args):
+    """Await an async function, or run a plain one on the threadpool"""
+    if asyncio.iscoroutinefunction(function):
+        return await function(*args)
+    return await run_in_threadpool(function, *args)
+
+
+async def bulk_ingest(
+    rows: AsyncIterator[Tuple[int, Any]],
+    model: Type[BaseModel],
+    insert_many: Callable[[List[BaseModel]], Any],
+    delete_many: Callable[[List[Any]], Any],
+    rollback: bool = False,
+    batch_size: int = BATCH_SIZE,
+    progress: Optional[Callable[[dict], None]] = None,
+) -> dict:
+    """Validate rows in batches and insert each batch with a single persistence write
+
+    Failing rows are reported and the remaining rows are applied. With
+    ``rollback`` the first failing row stops the import instead, and the
+    rows inserted so far are deleted again. That is a compensating
+    rollback, not a transaction: every batch is committed, visible to
+    readers and published to the change feed as it is written, then
+    deleted, and a crash in between leaves it applied. The summary says
+    whether the import was ``aborted`` and how many rows were
+    ``rolled_back``. ``progress`` is called with the running summary after
+    every batch. ``insert_many`` and ``delete_many`` may be async; plain
+    functions run on the threadpool.
+
+    Memory stays constant, but each batch costs one persistence write: with
+    "json" storage that rewrites the whole file, so the import as a whole
+    is quadratic unless the caller defers the writes (see app.cli).
+    """
+    summary = {"total": 0, "inserted": 0, "failed": 0, "errors": []}
+    # Only kept with rollback; one key per inserted row, for the whole import
+    inserted_keys: List[Any] = []
+    batch: List[Tuple[int, BaseModel]] = []
+
+    def fail(row_no: int, row_id: Any, message: str):
+        summary["failed"] += 1
+        if len(summary["errors"]) < MAX_REPORTED_ERRORS:
+            summary["errors"].append({"row": row_no, "id": row_id, "error": message})
+
+    async def flush() -> bool:
+        results = await _run(insert_many, [item for _, item in batch])
+        for (row_no, item), error in zip(batch, results):
+            if error is None:
+                summary["inserted"] += 1
+                if rollback:
+                    inserted_keys.append(item.id)
+            else:
+                fail(row_no, item.id, error)
+        batch.clear()
+        if progress is not None:
+            progress(summary)
+        return summary["failed"] == 0
+
+    ok = True
+    async for row_no, value in rows:
+        summary["total"] += 1
+        try:
+            if isinstance(value, RowError):
+                raise value
+            batch.append((row_no, model.model_validate(value)))
+        except (RowError, ValidationError) as e:
+            row_id = value.get("id") if isinstance(value, dict) else None
+            fail(row_no, row_id, _format_error(e))
+            if rollback:
+                ok = False
+                break
+        if len(batch) >= batch_size and not await flush() and rollback:
+            ok = False
+            break
+
+    if ok and batch:
+        ok = await flush() or not rollback
+
+    summary["errors_truncated"] = summary["failed"] > len(summary["errors"])
+    summary["aborted"] = not ok
+    if rollback and not ok:
+        summary["rolled_back"] = await _run(delete_many, inserted_keys)
+        logger.warning("Bulk %s import aborted at row %s, %s inserted rows deleted again", model.__name__,
+                       summary['total'], summary["rolled_back"])
+    else:
+        logger.info("Bulk %s import: %s inserted, %s failed", model.__name__, summary['inserted'], summary['failed'])
+    return summary
@@ -0,0 +1,323 @@
+import sys
+import time
+from abc import ABC, abstractmethod
+from array import array
+from operator import attrgetter
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+Record = Dict[str, Any]
+
+# "dict" keeps every record as the dict it arrived as,
+# "slots" as a __slots__ object with interned strings,
+# "columnar" as one row across per-field arrays
+RECORD_LAYOUTS = ("dict", "slots", "columnar")
+
+# Bytes of replaced strings a string column tolerates before considering compaction
+COMPACT_MIN_GARBAGE = 1 << 20
+# A code column with more distinct values than this that are repeated on fewer
+# than CODES_MIN_REPEAT rows on average is stored as strings instead
+CODES_MIN_DISTINCT = 1024
+CODES_MIN_REPEAT = 4
+
+
+class _CompactRecords(ABC):
+    """Dict-like mapping of key to record, as a RecordStore keeps its records in
+
+    Records are stored without their dicts and rebuilt on every access, so
+    callers always get a fresh dict. The key field is not stored: it is the
+    mapping key. Every record must have exactly the layout's fields.
+    """
+
+    def __init__(self, key: str, fields: Iterable[str], interned: Iterable[str] = ()):
+        self.key = key
+        self.fields = tuple(field for field in fields if field != key)
+        self.interned = frozenset(interned)
+        self._names = frozenset(self.fields) | {key}
+
+    def _values(self, record: Record) -> List[Any]:
+        if record.keys() != self._names:
+            raise ValueError(f"Record fields {sorted(record)} do not match the layout {sorted(self._names)}")
+        return [
+            sys.intern(record[field]) if field in self.interned and isinstance(record[field], str) else record[field]
+            for field in self.fields
+        ]
+
+    def _record(self, key: Any, values: Iterable[Any]) -> Record:
+        record = {self.key: key}
+        record.update(zip(self.fields, values))
+        return record
+
+    @abstractmethod
+    def get(self, key: Any, default: Any = None) -> Any:
+        """The record stored under key, rebuilt as a new dict, or default"""
+
+    def __getitem__(self, key: Any) -> Record:
+        record = self.get(key)
+        if record is None:
+            raise KeyError(key)
+        return record
+
+    def values(self) -> Iterator[Record]:
+        for key in self:
+            yield self[key]
+
+    def items(self) -> Iterator[Tuple[Any, Record]]:
+        for key in self:
+            yield key, self[key]
+
+
+class SlotsRecords(_CompactRecords):
+    """Records as immutable __slots__ objects
+
+    A slotted object holds its field values without a per-record dict or
+    hash table. Rows are replaced, never modified, so reads are as atomic
+    as with plain dicts.
+    """
+
+    def __init__(self, key: str, fields: Iterable[str], interned: Iterable[str] = ()):
+        super().__init__(key, fields, interned)
+        self._row = type("Row", (), {"__slots__": self.fields})
+        self._get_values = attrgetter(*self.fields) if len(self.fields) > 1 else lambda row: (
+            tuple(getattr(row, field) for field in self.fields))
+        self._rows: Dict[Any, Any] = {}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._rows
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._rows)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        row = self._rows.get(key)
+        return default if row is None else self._record(key, self._get_values(row))
+
+    def __setitem__(self, key: Any, record: Record):
+        row = self._row()
+        for field, value in zip(self.fields, self._values(record)):
+            setattr(row, field, value)
+        self._rows[key] = row
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        row = self._rows.pop(key, None)
+        return default if row is None else self._record(key, self._get_values(row))
+
+
+class _Codes:
+    """Column of interned strings, stored as 32-bit codes into a table of distinct values
+
+    Codes are never reclaimed, which suits low-cardinality fields like an
+    author or a position. Each distinct value costs a table entry and a
+    lookup entry, so the column only pays off while values repeat (see
+    ``sparse``).
+    """
+
+    def __init__(self):
+        self.codes = array("I")
+        self.table: List[Any] = []
+        self._lookup: Dict[Any, int] = {}
+
+    def code(self, value: Any) -> int:
+        code = self._lookup.get(value)
+        if code is None:
+            code = self._lookup[value] = len(self.table)
+            self.table.append(value)
+        return code
+
+    def __iter__(self) -> Iterator[Any]:
+        return (self.table[code] for code in self.codes)
+
+    def __getitem__(self, row: int) -> Any:
+        return self.table[self.codes[row]]
+
+    def __setitem__(self, row: int, value: Any):
+        self.codes[row] = self.code(value)
+
+    def append(self, value: Any):
+        self.codes.append(self.code(value))
+
+    @property
+    def sparse(self) -> bool:
+        """Whether values repeat too rarely for codes to save memory"""
+        distinct = len(self.table)
+        return distinct > CODES_MIN_DISTINCT and distinct * CODES_MIN_REPEAT > len(self.codes)
+
+
+class _Strings:
+    """Column of strings stored as UTF-8 in one shared buffer, addressed by offset and length
+
+    Saves the ~50 bytes of object header every str carries. A replaced
+    value leaves its old bytes behind; once they make up half the buffer
+    it is rewritten without them.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.starts = array("Q")
+        self.lengths = array("I")
+        self._garbage = 0
+
+    def __iter__(self) -> Iterator[str]:
+        return (self[row] for row in range(len(self.starts)))
+
+    def __getitem__(self, row: int) -> str:
+        start = self.starts[row]
+        return self.buffer[start:start + self.lengths[row]].decode()
+
+    def _encode(self, value: str) -> Tuple[int, int]:
+        data = value.encode()
+        start = len(self.buffer)
+        self.buffer += data
+        return start, len(data)
+
+    def __setitem__(self, row: int, value: str):
+        self._garbage += self.lengths[row]
+        self.starts[row], self.lengths[row] = self._encode(value)
+        if self._garbage > COMPACT_MIN_GARBAGE and self._garbage * 2 > len(self.buffer):
+            self._compact()
+
+    def append(self, value: str):
+        start, length = self._encode(value)
+        self.starts.append(start)
+        self.lengths.append(length)
+
+    def _compact(self):
+        buffer = bytearray()
+        for row, start in enumerate(self.starts):
+            self.starts[row] = len(buffer)
+            buffer += self.buffer[start:start + self.lengths[row]]
+        self.buffer = buffer
+        self._garbage = 0
+
+
+class ColumnarRecords(_CompactRecords):
+    """Records as rows across one column per field
+
+    Integer fields are 64-bit arrays, interned fields 32-bit codes (see
+    _Codes), other string fields a shared UTF-8 buffer (see _Strings) and
+    anything else a plain list. The key maps to its row; freed rows are
+    reused by later inserts. A code column whose values turn out to be
+    mostly distinct becomes a string column, and a column that meets a
+    value it cannot hold (an integer beyond 64 bits, a string field set to
+    null) turns into a list.
+
+    Rows are overwritten in place, so writes bump ``_version`` before and
+    after, and get() reads a row again if a write ran meanwhile, the way
+    RecordStore.read validates multi-step reads.
+    """
+
+    def __init__(self, key: str, fields: Dict[str, Any], interned: Iterable[str] = ()):
+        # Codes already store each distinct value once, so values are not interned as well
+        super().__init__(key, fields)
+        interned = frozenset(interned)
+        self._columns: List[Any] = [
+            _Codes() if field in interned
+            else array("q") if fields[field] is int
+            else _Strings() if fields[field] is str
+            else []
+            for field in self.fields
+        ]
+        self._rows: Dict[Any, int] = {}
+        self._free: List[int] = []
+        self._size = 0
+        self._version = 0
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._rows
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._rows)
+
+    def _read(self, row: int) -> List[Any]:
+        return [column[row] for column in self._columns]
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        while True:
+            version = self._version
+            row = self._rows.get(key)
+            try:
+                record = default if row is None else self._record(key, self._read(row))
+            except Exception:
+                # A failure caused by a concurrent write is retried; any other is real
+                if self._version == version:
+                    raise
+            else:
+                if self._version == version and version % 2 == 0:
+                    return record
+            # Let the writer finish before trying again
+            time.sleep(0)
+
+    def values(self) -> Iterator[Record]:
+        for key, row in self._rows.items():
+            yield self._record(key, self._read(row))
+
+    def _store(self, i: int, row: Optional[int], value: Any):
+        column = self._columns[i]
+        try:
+            if row is None:
+                column.append(value)
+            else:
+                column[row] = value
+        except (OverflowError, TypeError, AttributeError):
+            self._columns[i] = column = list(column)
+            self._store(i, row, value)
+        else:
+            if isinstance(column, _Codes) and column.sparse:
+                self._columns[i] = self._strings(column)
+
+    @staticmethod
+    def _strings(column: _Codes) -> Any:
+        """The values of a code column as a string column, or a list if some are not strings"""
+        if not all(isinstance(value, str) for value in column.table):
+            return list(column)
+        strings = _Strings()
+        for value in column:
+            strings.append(value)
+        return strings
+
+    def __setitem__(self, key: Any, record: Record):
+        values = self._values(record)
+        self._version += 1
+        try:
+            row = self._rows.get(key)
+            if row is None and self._free:
+                row = self._free.pop()
+            if row is None:
+                for i, value in enumerate(values):
+                    self._store(i, None, value)
+                row = self._size
+                self._size += 1
+            else:
+                for i, value in enumerate(values):
+                    self._store(i, row, value)
+            self._rows[key] = row
+        finally:
+            self._version += 1
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        row = self._rows.pop(key, None)
+        if row is None:
+            return default
+        self._free.append(row)
+        return self._record(key, self._read(row))
+
+
+def record_layout(layout: str, key: str, model, interned: Iterable[str] = ()) -> Optional[Callable[[], Any]]:
+    """Factory for the record mapping of a layout, for RecordStore's ``layout`` argument
+
+    ``model`` is the pydantic model whose fields the records hold. Returns
+    None for the plain dict layout.
+    """
+    if layout not in RECORD_LAYOUTS:
+        raise ValueError(f"Unknown record layout: {layout}")
+    fields = {name: info.annotation for name, info in model.model_fields.items()}
+    if layout == "slots":
+        return lambda: SlotsRecords(key, fields, interned)
+    if layout == "columnar":
+        return lambda: ColumnarRecords(key, fields, interned)
+    return None
@@ -1,22 +1,62 @@
+import heapq
 import json
 import logging
-from typing import List
+from collections import Counter
+from typing import Iterator, List, Optional
+from app import config
+from app.changes import change_log
+from app.indexes import HashIndex, RangeIndex
 from app.models import Book
+from app.pagination import DEFAULT_PAGE_SIZE, paginate, stream_records
+from app.persistence import open_store
+from app.search import SearchIndex
+from app.shards import ShardedStore
+from app.store import RecordStore
+from app.writer import store_writer
 
 logger = logging.getLogger("api")
 
 class BookManager:
     def __init__(self):
-        self.data_file = "app/data/books.json"
-        self.books = self._load_books()
+        # Opened by open() when the application starts, not at import time
+        self.store: Optional[RecordStore[int]] = None
+        self.persistence = None
+        self.data_file = None
 
-    def _load_books(self) -> List[dict]:
-        """Load books from JSON file"""
+    def open(self):
+        """Load the books store; a snapshot-backed store finishes indexing in build_indexes()"""
+        self.store = open_store(
+            "books",
+            self._load_books,
+            indexes={
+                "author": HashIndex("author", normalize=str.casefold),
+                "year": RangeIndex("year"),
+                "search": SearchIndex({"title": 2.0, "author": 1.0}),
+            },
+            model=Book,
+            interned=("author",),
+            shards=config.SHARDS,
+        )
+        change_log.attach("books", self.store)
+        self.persistence = self.store.persistence
+        self.data_file = self.persistence.path
+
+    @property
+    def ready(self) -> bool:
+        """Whether the books store is open and fully indexed"""
+        return self.store is not None and self.store.ready
+
+    @property
+    def books(self) -> List[dict]:
+        """All books in insertion order"""
+        return self.store.values()
+
+    def _load_books(self, persistence) -> List[dict]:
+        """Load books from the data file"""
         try:
-            with open(self.data_file, "r") as f:
-                books_data = json.load(f)
-                logger.info(f"Loaded {len(books_data)} books from file")
-                return books_data
+            books_data = persistence.load()
+            logger.info("Loaded %s books from file", len(books_data))
+            return books_data
         except FileNotFoundError:
             logger.warning("Books data file not found, starting with empty list")
             return []
@@ -25,26 +65,89 @@ class BookManager:
             return []
 
     def save_data(self):
-        """Save books to JSON file"""
+        """Write a full books snapshot to the data file"""
         try:
-            with open(self.data_file, "w") as f:
-                json.dump(self.books, f, indent=4)
+            self.store.save()
             logger.debug("Books data saved successfully")
         except Exception as e:
-            logger.error(f"Error saving books data: {e}")
+            logger.error("Error saving books data: %s", e)
             raise
 
-    def get_all_books(self) -> List[dict]:
-        """Get all books"""
-        return self.books
+    def close(self):
+        """Flush pending writes and release the data file"""
+        if self.store is not None:
+            self.store.close()
+
+    @staticmethod
+    def _criteria(author: Optional[str], year_min: Optional[int], year_max: Optional[int]) -> dict:
+        """Translate filter arguments into store index criteria"""
+        criteria = {}
+        if author is not None:
+            criteria["author"] = author
+        if year_min is not None or year_max is not None:
+            criteria["year"] = (year_min, year_max)
+        return criteria
+
+    def get_all_books(self, author: Optional[str] = None,
+                      year_min: Optional[int] = None, year_max: Optional[int] = None) -> List[dict]:
+        """Get all books, optionally filtered by author and year range"""
+        criteria = self._criteria(author, year_min, year_max)
+        return self.store.select(criteria) if criteria else self.store.values()
+
+    def get_books_page(self, after: Optional[int] = None, limit: int = DEFAULT_PAGE_SIZE,
+                       author: Optional[str] = None,
+                       year_min: Optional[int] = None, year_max: Optional[int] = None) -> dict:
+        """Get one page of books ordered by ID, starting after the given ID"""
+        return paginate(self.store, after, limit, self._criteria(author, year_min, year_max))
+
+    def stream_books(self, fmt: str = "json", after: Optional[int] = None,
+                     author: Optional[str] = None,
+                     year_min: Optional[int] = None, year_max: Optional[int] = None) -> Iterator[bytes]:
+        """Encode all matching books ordered by ID as JSON, NDJSON or CSV chunks"""
+        return stream_records(self.store, fmt, after, self._criteria(author, year_min, year_max),
+                              columns=list(Book.model_fields))
+
+    def _partitions(self) -> List[RecordStore]:
+        """Stores whose indexes together cover every book: the shards of a sharded store, else the store"""
+        return self.store.shards if isinstance(self.store, ShardedStore) else [self.store]
+
+    def search_books(self, query: str, limit: int = 10) -> List[dict]:
+        """Rank books against a free-text query on title and author, best match first
+
+        Each shard ranks its own books, weighing terms by how rare they are
+        within the shard, and the best of every shard's top results win.
+        """
+        hits = []
+        for store in self._partitions():
+            index = store.indexes["search"]
+            store.ensure_indexes()
+            hits.extend(store.read(lambda: index.search(query, limit)))
+        hits.sort(key=lambda hit: (-hit[1], hit[0]))
+        results = []
+        for book_id, score in hits[:limit]:
+            book = self.store.get(book_id)
+            if book is not None:
+                results.append({**book, "score": score})
+        logger.debug("Search '%s' returned %s books", query, len(results))
+        return results
+
+    def suggest_terms(self, prefix: str, limit: int = 10) -> List[str]:
+        """Autocomplete a title or author word from its prefix"""
+        counts = Counter()
+        for store in self._partitions():
+            index = store.indexes["search"]
+            store.ensure_indexes()
+            for token, count in store.read(lambda: index.frequent(prefix, limit)):
+                counts[token] += count
+        return heapq.nsmallest(limit, counts, key=lambda token: (-counts[token], token))
 
     def get_book(self, book_id: int) -> dict:
         """Get book by ID"""
-        book = next((b for b in self.books if b["id"] == book_id), None)
+        book = self.store.get(book_id)
         if book:
-            logger.debug(f"Retrieved book with ID: {book_id}")
+            logger.debug("Retrieved book with ID: %s", book_id)
         else:
-            logger.debug(f"Book with ID {book_id} not found")
+            logger.debug("Book with ID %s not found", book_id)
         return book
 
     def add_book(self, book: Book) -> dict:
@@ -52,34 +155,66 @@ class BookManager:
         book_dict = book.model_dump()
         
         # Check if book with same ID already exists
-        if any(b["id"] == book_dict["id"] for b in self.books):
-            logger.warning(f"Book with ID {book_dict['id']} already exists")
+        if book_dict["id"] in self.store:
+            logger.warning("Book with ID %s already exists", book_dict['id'])
             raise ValueError(f"Book with ID {book_dict['id']} already exists")
         
-        self.books.append(book_dict)
-        self.save_data()
-        logger.info(f"Added new book: {book_dict}")
+        self.store.insert(book_dict)
+        logger.debug("Added new book: %s", book_dict)
         return book_dict
 
+    def add_books_bulk(self, books: List[Book]) -> List[Optional[str]]:
+        """Add several books with a single write, returning a per-row error or None"""
+        results = self.store.insert_many([item.model_dump() for item in books])
+        logger.info("Bulk added %s of %s books", results.count(None), len(results))
+        return results
+
     def update_book(self, book_id: int, updated_book: Book) -> dict:
         """Update an existing book"""
-        for i, book in enumerate(self.books):
-            if book["id"] == book_id:
-                self.books[i] = updated_book.model_dump()
-                self.save_data()
-                logger.info(f"Updated book with ID: {book_id}")
-                return self.books[i]
+        book_dict = self.store.update(book_id, updated_book.model_dump())
+        if book_dict is not None:
+            logger.info("Updated book with ID: %s", book_id)
+            return book_dict
         
-        logger.warning(f"Book with ID {book_id} not found for update")
+        logger.warning("Book with ID %s not found for update", book_id)
         return None
 
     def delete_book(self, book_id: int):
         """Delete a book by ID"""
-        initial_count = len(self.books)
-        self.books = [book for book in self.books if book["id"] != book_id]
-        
-        if len(self.books) < initial_count:
-            self.save_data()
-            logger.info(f"Deleted book with ID: {book_id}")
+        if self.store.delete(book_id) is not None:
+            logger.info("Deleted book with ID: %s", book_id)
         else:
-            logger.warning(f"Book with ID {book_id} not found for deletion")
\ No newline at end of file
+            logger.warning("Book with ID %s not found for deletion", book_id)
+
+    def delete_books_bulk(self, book_ids: List[int]) -> int:
+        """Delete several books by ID with a single write"""
+        deleted = self.store.delete_many(book_ids)
+        logger.info("Bulk deleted %s books", deleted)
+        return deleted
+
+    # -------------------------
+    # Async variants for async handlers: writes run on the store writer (see app.writer)
+    # -------------------------
+    async def get_book_async(self, book_id: int) -> dict:
+        """Get book by ID without blocking the event loop"""
+        return await store_writer.read(self.store, self.get_book, book_id)
+
+    async def add_book_async(self, book: Book) -> dict:
+        """Add a new book, returning once it is durable"""
+        return await store_writer.write(self.add_book, book)
+
+    async def add_books_bulk_async(self, books: List[Book]) -> List[Optional[str]]:
+        """Add several books with a single write, returning once they are durable"""
+        return await store_writer.write(self.add_books_bulk, books)
+
+    async def update_book_async(self, book_id: int, updated_book: Book) -> dict:
+        """Update an existing book, returning once the change is durable"""
+        return await store_writer.write(self.update_book, book_id, updated_book)
+
+    async def delete_book_async(self, book_id: int):
+        """Delete a book by ID, returning once the deletion is durable"""
+        return await store_writer.write(self.delete_book, book_id)
+
+    async def delete_books_bulk_async(self, book_ids: List[int]) -> int:
+        """Delete several books by ID with a single write, returning once it is durable"""
+        return await store_writer.write(self.delete_books_bulk, book_ids)
@@ -0,0 +1,328 @@
+import json
+import logging
+import threading
+from datetime import date, timedelta
+from typing import Dict, List, Optional
+from app import config
+from app.indexes import HashIndex, RangeIndex, UniqueViolation
+from app.models import Book, Checkout, Loan, Reader
+from app.pagination import DEFAULT_PAGE_SIZE, paginate
+from app.persistence import open_store
+from app.store import RecordStore, overlapped_waits
+from app.writer import store_writer
+
+logger = logging.getLogger("api")
+
+class MissingRecord(LookupError):
+    """A loan refers to a book or reader that does not exist"""
+
+
+class LoanConflict(ValueError):
+    """A loan operation the current state does not allow, e.g. lending a book already on loan"""
+
+
+def active_loan_indexes() -> Dict[str, object]:
+    """Indexes of the active loans: by book (at most one each), by reader, and ordered by due date"""
+    return {
+        "book_id": HashIndex("book_id", unique=True),
+        "reader_id": HashIndex("reader_id"),
+        "due": RangeIndex("due"),
+    }
+
+
+class LoanManager:
+    """Lends books to readers, validated against the book and reader managers
+
+    Active loans and returned ones live in separate stores, so the indexes
+    of active loans only ever hold what is currently lent out: whether a
+    book is available and what a reader has out are single index lookups,
+    and overdue loans are the start of the due date index. Dates are stored
+    as ISO strings, which sort chronologically.
+    """
+
+    def __init__(self, book_manager, reader_manager):
+        self.books = book_manager
+        self.readers = reader_manager
+        # Opened by open() when the application starts, not at import time
+        self.store: Optional[RecordStore[int]] = None
+        self.history: Optional[RecordStore[int]] = None
+        self.persistence = None
+        self.data_file = None
+        # Makes "is the book available" and lending it one step within this process; across
+        # workers sharing a sqlite database the unique book_id index has the last word
+        self._lock = threading.Lock()
+
+    def open(self):
+        """Load the active loans and the loan history"""
+        self.store = open_store("loans", self._loader("loans"), indexes=active_loan_indexes(), model=Loan)
+        self.history = open_store(
+            "loan_history",
+            self._loader("returned loans"),
+            indexes={"book_id": HashIndex("book_id"), "reader_id": HashIndex("reader_id")},
+            model=Loan,
+        )
+        self.persistence = self.store.persistence
+        self.data_file = self.persistence.path
+
+    @property
+    def ready(self) -> bool:
+        """Whether both loan stores are open and fully indexed"""
+        return self.store is not None and self.store.ready and self.history.ready
+
+    @staticmethod
+    def _loader(label: str):
+        def load(persistence) -> List[dict]:
+            try:
+                loans = persistence.load()
+                logger.info("Loaded %s %s from file", len(loans), label)
+                return loans
+            except FileNotFoundError:
+                logger.warning("No %s data file, starting with empty list", label)
+                return []
+            except json.JSONDecodeError:
+                logger.error("Error decoding %s JSON, starting with empty list", label)
+                return []
+        return load
+
+    def save_data(self):
+        """Write full snapshots of the active loans and the history"""
+        try:
+            self.store.save()
+            self.history.save()
+            logger.debug("Loans data saved successfully")
+        except Exception as e:
+            logger.error("Error saving loans data: %s", e)
+            raise
+
+    def close(self):
+        """Flush pending writes and release the data files"""
+        if self.store is not None:
+            self.store.close()
+            self.history.close()
+
+    @staticmethod
+    def _today(today: Optional[date]) -> date:
+        return today if today is not None else date.today()
+
+    # -------------------------
+    # Lookups
+    # -------------------------
+    def get_loan(self, loan_id: int) -> Optional[dict]:
+        """Get an active or returned loan by ID"""
+        loan = self.store.get(loan_id)
+        return loan if loan is not None else self.history.get(loan_id)
+
+    def get_book_loan(self, book_id: int) -> Optional[dict]:
+        """The active loan of a book, or None if it is available"""
+        loans = self.store.select({"book_id": book_id})
+        return loans[0] if loans else None
+
+    def get_reader_loans(self, reader_id: int) -> List[dict]:
+        """Active loans of a reader, by loan ID"""
+        return self.store.select({"reader_id": reader_id})
+
+    @staticmethod
+    def _criteria(book_id: Optional[int], reader_id: Optional[int]) -> dict:
+        """Translate filter arguments into store index criteria"""
+        criteria = {}
+        if book_id is not None:
+            criteria["book_id"] = book_id
+        if reader_id is not None:
+            criteria["reader_id"] = reader_id
+        return criteria
+
+    def get_loans_page(self, after: Optional[int] = None, limit: int = DEFAULT_PAGE_SIZE,
+                       book_id: Optional[int] = None, reader_id: Optional[int] = None) -> dict:
+        """Get one page of active loans ordered by ID, optionally for one book or reader"""
+        return paginate(self.store, after, limit, self._criteria(book_id, reader_id))
+
+    def get_overdue_page(self, as_of: Optional[date] = None, after: Optional[str] = None,
+                         limit: int = DEFAULT_PAGE_SIZE) -> dict:
+        """Get one page of the active loans due before as_of (today by default), most overdue first
+
+        Walks the due date index, so a page costs the same however many
+        loans are overdue. ``after`` is the ``next_after`` cursor of the
+        previous page, "<due>:<loan id>".
+        """
+        last_due = self._today(as_of) - timedelta(days=1)
+        position = None
+        if after is not None:
+            due, _, loan_id = after.partition(":")
+            position = (date.fromisoformat(due).isoformat(), int(loan_id))
+        items = self.store.page_by("due", (None, last_due.isoformat()), position, limit + 1)
+        has_more = len(items) > limit
+        items = items[:limit]
+        return {"items": items, "next_after": f"{items[-1]['due']}:{items[-1]['id']}" if has_more else None}
+
+    def get_history_page(self, after: Optional[int] = None, limit: int = DEFAULT_PAGE_SIZE,
+                         book_id: Optional[int] = None, reader_id: Optional[int] = None) -> dict:
+        """Get one page of returned loans ordered by ID, optionally for one book or reader"""
+        return paginate(self.history, after, limit, self._criteria(book_id, reader_id))
+
+    # -------------------------
+    # Circulation
+    # -------------------------
+    def checkout(self, request: Checkout, today: Optional[date] = None) -> dict:
+        """Lend a book to a reader"""
+        today = self._today(today)
+        days = request.days or config.LOAN_DAYS
+        # The lock only covers the check and the insert: the loan becomes durable after it is
+        # released, so checkouts do not queue behind each other's disk writes
+        with overlapped_waits(), self._lock:
+            if self.books.get_book(request.book_id) is None:
+                raise MissingRecord(f"Book {request.book_id} not found")
+            if self.readers.get_reader(request.reader_id) is None:
+                raise MissingRecord(f"Reader {request.reader_id} not found")
+            if request.id in self.store or request.id in self.history:
+                raise LoanConflict(f"Loan with ID {request.id} already exists")
+            if self.store.find({"book_id": request.book_id}):
+                raise LoanConflict(f"Book {request.book_id} is already on loan")
+            loan = Loan(id=request.id, book_id=request.book_id, reader_id=request.reader_id,
+                        loaned_on=today, due=today + timedelta(days=days)).model_dump(mode="json")
+            try:
+                self.store.insert(loan)
+            except UniqueViolation:
+                # Another worker lent the book since the check above
+                raise LoanConflict(f"Book {request.book_id} is already on loan")
+            except ValueError:
+                raise LoanConflict(f"Loan with ID {request.id} already exists")
+        logger.info("Lent book %s to reader %s until %s", request.book_id, request.reader_id, loan["due"])
+        return loan
+
+    def return_loan(self, loan_id: int, today: Optional[date] = None) -> Optional[dict]:
+        """Return a lent book, moving its loan to the history
+
+        The active loan is removed first, so a crash between the two
+        writes can only lose the history entry, never keep a returned
+        book on loan.
+        """
+        # Under the lock, so a renewal cannot update the loan halfway through being returned
+        with overlapped_waits(), self._lock:
+            loan = self.store.delete(loan_id)
+        if loan is None:
+            logger.warning("Loan with ID %s not found for return", loan_id)
+            return None
+        returned = {**loan, "returned_on": self._today(today).isoformat()}
+        self.history.insert(returned)
+        logger.info("Book %s returned by reader %s", loan["book_id"], loan["reader_id"])
+        return returned
+
+    def renew(self, loan_id: int, today: Optional[date] = None) -> Optional[dict]:
+        """Extend an active loan by LIBRARY_LOAN_DAYS from its due date, or from today if overdue"""
+        with overlapped_waits(), self._lock:
+            loan = self.store.get(loan_id)
+            if loan is None:
+                logger.warning("Loan with ID %s not found for renewal", loan_id)
+                return None
+            if loan["renewals"] >= config.LOAN_MAX_RENEWALS:
+                raise LoanConflict(f"Loan {loan_id} was already renewed {loan['renewals']} times")
+            due = max(date.fromisoformat(loan["due"]), self._today(today)) + timedelta(days=config.LOAN_DAYS)
+            renewed = self.store.update(loan_id, {**loan, "due": due.isoformat(), "renewals": loan["renewals"] + 1})
+        if renewed is None:
+            # Returned by another worker sharing the database since it was read
+            logger.warning("Loan with ID %s not found for renewal", loan_id)
+            return None
+        logger.info("Renewed loan %s until %s", loan_id, renewed["due"])
+        return renewed
+
+    # -------------------------
+    # Deleting books and readers, or changing their IDs: refused while they have active loans
+    # -------------------------
+    def update_book(self, book_id: int, updated_book: Book) -> Optional[dict]:
+        """Update a book; raises LoanConflict if it is on loan and its ID would change"""
+        if updated_book.id == book_id:
+            return self.books.update_book(book_id, updated_book)
+        with overlapped_waits(), self._lock:
+            if self.get_book_loan(book_id) is not None:
+                raise LoanConflict(f"Book {book_id} is on loan, its ID cannot change")
+            return self.books.update_book(book_id, updated_book)
+
+    def update_reader(self, reader_id: int, updated_reader: Reader) -> Optional[dict]:
+        """Update a reader; raises LoanConflict if they have books on loan and their ID would change"""
+        if updated_reader.id == reader_id:
+            return self.readers.update_reader(reader_id, updated_reader)
+        with overlapped_waits(), self._lock:
+            if self.get_reader_loans(reader_id):
+                raise LoanConflict(f"Reader {reader_id} has books on loan, their ID cannot change")
+            return self.readers.update_reader(reader_id, updated_reader)
+
+    def delete_book(self, book_id: int):
+        """Delete a book by ID; raises LoanConflict if it is on loan"""
+        with overlapped_waits(), self._lock:
+            if self.get_book_loan(book_id) is not None:
+                raise LoanConflict(f"Book {book_id} is on loan")
+            self.books.delete_book(book_id)
+
+    def delete_books_bulk(self, book_ids: List[int]) -> int:
+        """Delete several books by ID with a single write; raises LoanConflict, deleting none, if any is on loan"""
+        with overlapped_waits(), self._lock:
+            lent = [book_id for book_id in book_ids if self.get_book_loan(book_id) is not None]
+            if lent:
+                raise LoanConflict(f"Books on loan: {', '.join(map(str, lent[:10]))}")
+            return self.books.delete_books_bulk(book_ids)
+
+    def delete_reader(self, reader_id: int):
+        """Delete a reader by ID; raises LoanConflict if they have books on loan"""
+        with overlapped_waits(), self._lock:
+            if self.get_reader_loans(reader_id):
+                raise LoanConflict(f"Reader {reader_id} has books on loan")
+            self.readers.delete_reader(reader_id)
+
+    def delete_readers_bulk(self, reader_ids: List[int]) -> int:
+        """Delete several readers by ID with a single write; raises LoanConflict, deleting none, if any has loans"""
+        with overlapped_waits(), self._lock:
+            lending = [reader_id for reader_id in reader_ids if self.get_reader_loans(reader_id)]
+            if lending:
+                raise LoanConflict(f"Readers with books on loan: {', '.join(map(str, lending[:10]))}")
+            return self.readers.delete_readers_bulk(reader_ids)
+
+    # -------------------------
+    # Async variants for async handlers: writes run on the store writer (see app.writer)
+    # -------------------------
+    async def get_loan_async(self, loan_id: int) -> Optional[dict]:
+        """Get an active or returned loan by ID without blocking the event loop"""
+        return await store_writer.read(self.store, self.get_loan, loan_id)
+
+    async def get_book_loan_async(self, book_id: int) -> Optional[dict]:
+        """The active loan of a book without blocking the event loop"""
+        return await store_writer.read(self.store, self.get_book_loan, book_id)
+
+    async def get_reader_loans_async(self, reader_id: int) -> List[dict]:
+        """Active loans of a reader without blocking the event loop"""
+        return await store_writer.read(self.store, self.get_reader_loans, reader_id)
+
+    async def checkout_async(self, request: Checkout) -> dict:
+        """Lend a book to a reader, returning once the loan is durable"""
+        return await store_writer.write(self.checkout, request)
+
+    async def return_loan_async(self, loan_id: int) -> Optional[dict]:
+        """Return a lent book, returning once the return is durable"""
+        return await store_writer.write(self.return_loan, loan_id)
+
+    async def renew_async(self, loan_id: int) -> Optional[dict]:
+        """Renew an active loan, returning once the renewal is durable"""
+        return await store_writer.write(self.renew, loan_id)
+
+    async def update_book_async(self, book_id: int, updated_book: Book) -> Optional[dict]:
+        """Update a book, keeping the ID of one on loan, returning once the change is durable"""
+        return await store_writer.write(self.update_book, book_id, updated_book)
+
+    async def update_reader_async(self, reader_id: int, updated_reader: Reader) -> Optional[dict]:
+        """Update a reader, keeping the ID of one with loans, returning once the change is durable"""
+        return await store_writer.write(self.update_reader, reader_id, updated_reader)
+
+    async def delete_book_async(self, book_id: int):
+        """Delete a book that is not on loan, returning once the deletion is durable"""
+        return await store_writer.write(self.delete_book, book_id)
+
+    async def delete_books_bulk_async(self, book_ids: List[int]) -> int:
+        """Delete several books none of which is on loan, returning once it is durable"""
+        return await store_writer.write(self.delete_books_bulk, book_ids)
+
+    async def delete_reader_async(self, reader_id: int):
+        """Delete a reader without active loans, returning once the deletion is durable"""
+        return await store_writer.write(self.delete_reader, reader_id)
+
+    async def delete_readers_bulk_async(self, reader_ids: List[int]) -> int:
+        """Delete several readers none of which has active loans, returning once it is durable"""
+        return await store_writer.write(self.delete_readers_bulk, reader_ids)
@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import queue
+import random
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from typing import Optional
+
+from app import config
+
+ACCESS_LOGGER = "api.access"
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+LOG_FORMATS = ("text", "json")
+BODY_CAPTURE_MODES = ("off", "truncate", "sample")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the record's ``fields`` extra merged in"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue handler that never blocks the caller and leaves formatting to the writer
+
+    The stock QueueHandler formats every record on the calling thread before
+    queueing it. Records only cross threads here, not processes, so they are
+    queued as-is and their %-style arguments are merged by the writer thread,
+    off the request path. When the queue is full the record is dropped and
+    counted rather than stalling the event loop.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+
+class BodyCapture:
+    """First bytes of a request body, copied as the endpoint reads it
+
+    Wraps the request's receive channel instead of reading the body up
+    front, so the endpoint still consumes (or streams) the body itself and
+    the log only ever holds ``limit`` bytes of it.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.head = bytearray()
+        self.size = 0
+
+    @classmethod
+    def install(cls, request) -> Optional["BodyCapture"]:
+        """Start capturing the body of request, or return None if it is not to be logged"""
+        mode = config.LOG_BODY
+        if mode == "off" or (mode == "sample" and random.random() >= config.LOG_BODY_SAMPLE_RATE):
+            return None
+
+        capture = cls(config.LOG_BODY_MAX_BYTES)
+        receive = request.receive
+
+        async def tee():
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                room = capture.limit - len(capture.head)
+                if room > 0:
+                    capture.head += chunk[:room]
+                capture.size += len(chunk)
+            return message
+
+        request._receive = tee
+        return capture
+
+    def __str__(self) -> str:
+        if not self.size:
+            return "None"
+        text = self.head.decode(errors="replace")
+        if self.size > len(self.head):
+            text += f"... ({self.size} bytes)"
+        return text
+
+    def __repr__(self) -> str:
+        # Escaped and quoted, so a multi-line body stays on its request's line of a text log
+        return json.dumps(str(self), ensure_ascii=False) if self.size else "None"
+
+
+def _file_handler(path: str) -> logging.Handler:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if config.LOG_ROTATE_WHEN:
+        return TimedRotatingFileHandler(path, when=config.LOG_ROTATE_WHEN,
+                                        backupCount=config.LOG_BACKUP_COUNT, delay=True)
+    return RotatingFileHandler(path, maxBytes=config.LOG_MAX_BYTES,
+                               backupCount=config.LOG_BACKUP_COUNT, delay=True)
+
+
+_handler: Optional[DroppingQueueHandler] = None
+_listener: Optional[QueueListener] = None
+
+
+def configure_logging():
+    """Route all logging through a bounded queue drained by a background writer
+
+    Loggers only ever enqueue; the writer thread formats the records and
+    writes them to the rotating application log, except for the access log
+    records, which go to their own file. Calling it again after
+    stop_logging restarts the writer.
+    """
+    global _handler, _listener
+    if _listener is not None:
+        return
+    if config.LOG_FORMAT not in LOG_FORMATS:
+        raise ValueError(f"Unknown log format: {config.LOG_FORMAT}")
+    if config.LOG_BODY not in BODY_CAPTURE_MODES:
+        raise ValueError(f"Unknown body capture mode: {config.LOG_BODY}")
+
+    formatter = JsonFormatter() if config.LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+    app_handler = _file_handler(config.LOG_FILE)
+    app_handler.addFilter(lambda record: not record.name.startswith(ACCESS_LOGGER))
+    access_handler = _file_handler(config.ACCESS_LOG_FILE)
+    access_handler.addFilter(logging.Filter(ACCESS_LOGGER))
+    for handler in (app_handler, access_handler):
+        handler.setFormatter(formatter)
+
+    root = logging.getLogger()
+    if _handler is None:
+        _handler = DroppingQueueHandler(queue.Queue(config.LOG_QUEUE_SIZE))
+        root.addHandler(_handler)
+    root.setLevel(config.LOG_LEVEL)
+    _listener = QueueListener(_handler.queue, app_handler, access_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """Write out every queued record, then stop the writer and close the log files"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+def logging_stats() -> dict:
+    """Queue depth and dropped records of the logging pipeline"""
+    if _handler is None:
+        return {"queued": 0, "dropped": 0}
+    return {"queued": _handler.queue.qsize(), "dropped": _handler.dropped}
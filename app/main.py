@@ -1,304 +1,887 @@
 import logging
+import threading
 import time
-from fastapi import FastAPI, HTTPException, Request
-from app.models import Book, Reader, Staff
+from contextlib import asynccontextmanager
+from datetime import date
+from typing import Any, Callable, Hashable, List, Optional
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from app import config
+from app.admission import Shed, admission
+from app.changes import change_log
+from app.cache import ResponseCache, content_etag, encode_json, etag_matches, version_etag
+from app.ingest import bulk_ingest, iter_csv_rows, iter_rows, log_progress, parse_pairs
+from app.metrics import PROMETHEUS_MEDIA_TYPE, UNMATCHED_ROUTE, Metrics
+from app.logging_setup import ACCESS_LOGGER, BodyCapture, configure_logging, logging_stats, stop_logging
+from app.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, STREAM_FORMAT_PATTERN, STREAM_MEDIA_TYPES
+from app.models import Book, Checkout, Reader, Staff
+from app.timing import PROFILE_FILE_HEADER, StageTimer, TimedRoute, stage
+from app.writer import WritesBacklogged, store_writer
 from app.library_manager import BookManager
 from app.reader_manager import ReaderManager
 from app.staff_manager import StaffManager
+from app.loan_manager import LoanConflict, LoanManager, MissingRecord
 
 # -------------------------
 # Logging Configuration
 # -------------------------
-logging.basicConfig(
-    level=logging.INFO,
-    filename="app.log",
-    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-    filemode='a'  # Append mode
-)
+# Handlers only enqueue records; a background thread formats and writes them
+configure_logging()
 
 # Create logger for API
 api_logger = logging.getLogger("api")
+access_logger = logging.getLogger(ACCESS_LOGGER)
 
 # -------------------------
 # App initialization
 # -------------------------
-app = FastAPI(title="Library Management System")
+def _build_indexes():
+    for name, manager in stores.items():
+        started = time.perf_counter()
+        manager.store.build_indexes()
+        api_logger.info("Indexed %s in %.0fms", name, (time.perf_counter() - started) * 1000)
+    loan_manager.history.build_indexes()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_logging()
+    # Data is loaded here rather than at import, so reloads and workers start serving sooner
+    started = time.perf_counter()
+    for manager in stores.values():
+        manager.open()
+    api_logger.info("Opened all data stores in %.0fms", (time.perf_counter() - started) * 1000)
+    # Snapshot-backed stores index their records in the background; /health reports when they are done
+    threading.Thread(target=_build_indexes, name="index-builder", daemon=True).start()
+    store_writer.start()
+    yield
+    # Let the writer threads finish, then flush any write-behind changes before the process exits
+    store_writer.stop()
+    for manager in (book_manager, reader_manager, staff_manager, loan_manager):
+        manager.close()
+    api_logger.info("Flushed and closed all data stores")
+    stop_logging()
+
+app = FastAPI(title="Library Management System", lifespan=lifespan)
+# Endpoints are timed as the "handler" stage of requests that ask for Server-Timing
+app.router.route_class = TimedRoute
 book_manager = BookManager()
 reader_manager = ReaderManager()
 staff_manager = StaffManager()
+loan_manager = LoanManager(book_manager, reader_manager)
+
+# -------------------------
+# Metrics
+# -------------------------
+# Keyed by route template and method, so the number of series stays bounded
+metrics = Metrics()
+stores = {"books": book_manager, "readers": reader_manager, "staff": staff_manager, "loans": loan_manager}
+metrics.gauge("library_store_records", "Records held per store",
+              lambda: [({"store": name}, len(manager.store)) for name, manager in stores.items()])
+metrics.gauge("library_pending_writes", "Changes queued but not yet written, per store",
+              lambda: [({"store": name}, manager.persistence.pending()) for name, manager in stores.items()])
+metrics.gauge("library_admission_in_flight", "Requests being handled, per route class",
+              lambda: [({"class": name}, slots.in_flight) for name, slots in admission.slots.items()])
+metrics.gauge("library_admission_requests", "Requests admitted, queued for a slot and shed, per route class",
+              lambda: [({"class": name, "outcome": outcome}, count)
+                       for name, slots in admission.slots.items() for outcome, count in slots.counts().items()])
+metrics.gauge("library_log_records_dropped", "Log records dropped because the log queue was full",
+              lambda: [({}, logging_stats()["dropped"])])
 
 # -------------------------
 # Enhanced Middleware for logging
 # -------------------------
+def _route_template(request: Request) -> str:
+    """Path template of the route that handled the request, e.g. /books/{book_id}"""
+    route = request.scope.get("route")
+    return route.path if route is not None else UNMATCHED_ROUTE
+
+async def _release_when_sent(body, slots):
+    """Pass a response body through, then release the admission slot it was produced under"""
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        slots.release()
+
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    start_time = time.time()
-    
-    # Log request details
-    body = await request.body()
-    api_logger.info(f"Request: {request.method} {request.url.path} - Body: {body.decode() if body else 'None'}")
-    
-    try:
-        response = await call_next(request)
-        process_time = (time.time() - start_time) * 1000
-        
+    start_time = time.perf_counter()
+    method, path = request.method, request.url.path
+
+    # The body is copied as the endpoint reads it, so large uploads are neither buffered nor decoded here
+    body = BodyCapture.install(request)
+    # Stage timing only when configured or asked for by a privileged request; None costs nothing below
+    timer = StageTimer.install(request)
+    with stage("log"):
+        access_logger.info("Request: %s %s", method, path, extra={"fields": {"method": method, "path": path}})
+
+    slots = None
+    try:
+        # Refused requests are answered here, before any routing, body parsing or store work
+        slots = await admission.admit(request)
+        if timer is not None and timer.profile is not None:
+            with timer.profile.thread():
+                response = await call_next(request)
+        else:
+            response = await call_next(request)
+        if timer is not None:
+            # From the endpoint's return until the response starts: encoding the result
+            timer.gap("serialize")
+        process_time = (time.perf_counter() - start_time) * 1000
+        metrics.observe(method, _route_template(request), response.status_code, process_time)
+
         # Log response details
-        api_logger.info(f"Response: {request.method} {request.url.path} - Status: {response.status_code} - Time: {process_time:.2f}ms")
-        
+        if access_logger.isEnabledFor(logging.INFO):
+            with stage("log"):
+                fields = {"method": method, "path": path, "status": response.status_code,
+                          "time_ms": round(process_time, 2)}
+                if body is None:
+                    access_logger.info("Response: %s %s - Status: %s - Time: %.2fms", method, path,
+                                       response.status_code, process_time, extra={"fields": fields})
+                else:
+                    fields["body"] = body
+                    access_logger.info("Response: %s %s - Status: %s - Time: %.2fms - Body: %r", method, path,
+                                       response.status_code, process_time, body, extra={"fields": fields})
+
+        if timer is not None:
+            response.headers["Server-Timing"] = timer.header()
+            if timer.profile is not None:
+                filename = await run_in_threadpool(timer.profile.save, method, path)
+                response.headers[PROFILE_FILE_HEADER] = filename
+                api_logger.info("Saved %s profile of %s %s to %s", timer.profile.mode, method, path, filename)
+        if slots is not None:
+            # Streamed exports and change streams do most of their work while the body is sent
+            response.body_iterator = _release_when_sent(response.body_iterator, slots)
+            slots = None
         return response
+    except Shed as shed:
+        metrics.observe(method, _route_template(request), shed.status, (time.perf_counter() - start_time) * 1000)
+        access_logger.warning("Shed: %s %s - Status: %s - %s", method, path, shed.status, shed,
+                              extra={"fields": {"method": method, "path": path, "status": shed.status}})
+        return JSONResponse({"detail": str(shed)}, status_code=shed.status,
+                            headers={"Retry-After": str(shed.retry_after)})
     except Exception as e:
-        api_logger.error(f"Error: {request.method} {request.url.path} - {str(e)}")
+        metrics.observe(method, _route_template(request), 500, (time.perf_counter() - start_time) * 1000)
+        access_logger.error("Error: %s %s - %s", method, path, e, extra={"fields": {"method": method, "path": path}})
         raise HTTPException(status_code=500, detail="Internal Server Error")
+    finally:
+        if slots is not None:
+            slots.release()
+        if timer is not None:
+            timer.uninstall()
 
 # -------------------------
-# Request Counter for Monitoring
+# Write backpressure
 # -------------------------
-request_counter = {
-    "total": 0,
-    "by_endpoint": {},
-    "errors": 0
-}
-
-def increment_counter(endpoint: str, is_error: bool = False):
-    request_counter["total"] += 1
-    request_counter["by_endpoint"][endpoint] = request_counter["by_endpoint"].get(endpoint, 0) + 1
-    if is_error:
-        request_counter["errors"] += 1
+@app.exception_handler(WritesBacklogged)
+async def writes_backlogged(request: Request, exc: WritesBacklogged):
+    api_logger.warning("Refused %s %s: %s", request.method, request.url.path, exc)
+    return JSONResponse({"detail": "Too many pending writes, retry later"}, status_code=503,
+                        headers={"Retry-After": "1"})
+
+# -------------------------
+# Response cache
+# -------------------------
+response_cache = ResponseCache(int(config.RESPONSE_CACHE_MB * 1024 * 1024))
+metrics.gauge("library_response_cache_bytes", "Bytes held by the encoded response cache",
+              lambda: [({}, response_cache.stats()["bytes"])])
+
+def _json_response(request: Request, etag: str, body: Callable[[], bytes]) -> Response:
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(body(), media_type="application/json", headers={"ETag": etag})
+
+def cached_listing(request: Request, store, key: Hashable, produce: Callable[[], Any]) -> Response:
+    """Serve a listing by the store version: 304 if the client has it, cached bytes if encoded before"""
+    etag = version_etag(store, key)
+
+    def body() -> bytes:
+        entry = response_cache.get(key, etag)
+        if entry is None:
+            entry = response_cache.put(key, etag, etag, encode_json(produce()))
+        return entry.body
+
+    return _json_response(request, etag, body)
+
+def cached_record(request: Request, key: Hashable, record: dict) -> Response:
+    """Serve a single record, re-encoding it only after it changed"""
+    entry = response_cache.get(key, record)
+    if entry is None:
+        body = encode_json(record)
+        entry = response_cache.put(key, record, content_etag(body), body)
+    return _json_response(request, entry.etag, lambda: entry.body)
+
+# -------------------------
+# CSV import/export
+# -------------------------
+def csv_export(name: str, chunks) -> StreamingResponse:
+    """Stream a collection as a CSV attachment"""
+    api_logger.info("Exporting %s as CSV", name)
+    return StreamingResponse(chunks, media_type=STREAM_MEDIA_TYPES["csv"],
+                             headers={"Content-Disposition": f'attachment; filename="{name}.csv"'})
+
+async def csv_import(request: Request, name: str, model, insert_many, delete_many, rollback: bool,
+                     columns: List[str], defaults: List[str], base_defaults: Optional[dict] = None):
+    """Import a streamed CSV body in validated batches, like the bulk endpoints"""
+    try:
+        mapping = parse_pairs(columns)
+        defaults = {**(base_defaults or {}), **parse_pairs(defaults)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        summary = await bulk_ingest(
+            iter_csv_rows(request.stream(), model.model_fields, mapping, defaults),
+            model,
+            insert_many,
+            delete_many,
+            rollback=rollback,
+            progress=log_progress(f"CSV import of {name}"),
+        )
+    except LoanConflict as e:
+        # Rolling back would delete records that were lent out meanwhile
+        raise HTTPException(status_code=409, detail=str(e))
+    except WritesBacklogged:
+        raise
+    except Exception as e:
+        api_logger.error("Error importing %s CSV: %s", name, e)
+        raise HTTPException(status_code=500, detail=f"Error importing {name}")
+    if summary["aborted"]:
+        return JSONResponse(status_code=422, content=summary)
+    return summary
 
 # -------------------------
 # Root & Health Endpoints
 # -------------------------
 @app.get("/")
 def root():
-    increment_counter("/")
     return {"message": "Welcome to the Library Management API"}
 
 @app.get("/health")
 def health():
-    health_status = {
-        "status": "healthy",
-        "total_requests": request_counter["total"],
-        "requests_by_endpoint": request_counter["by_endpoint"],
-        "total_errors": request_counter["errors"]
-    }
+    ready = all(manager.ready for manager in stores.values())
+    health_status = {"status": "healthy" if ready else "starting", "ready": ready, **metrics.summary()}
+    if not ready:
+        # Still indexing: served requests work, but filters and search may wait
+        return JSONResponse(health_status, status_code=503)
     return health_status
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type=PROMETHEUS_MEDIA_TYPE)
+
+@app.get("/internal/stats")
+async def internal_stats():
+    # Served on the event loop, so it still answers while the threadpool is saturated
+    return {
+        "persistence": {
+            "books": book_manager.persistence.stats(),
+            "readers": reader_manager.persistence.stats(),
+            "staff": staff_manager.persistence.stats(),
+            "loans": loan_manager.persistence.stats(),
+            "loan_history": loan_manager.history.persistence.stats(),
+        },
+        "logging": logging_stats(),
+        "response_cache": response_cache.stats(),
+        "writes": store_writer.stats(),
+        "changes": change_log.stats(),
+        "admission": admission.stats(),
+    }
+
 # -------------------------
 # Book Endpoints
 # -------------------------
 @app.get("/books")
-def get_books():
-    increment_counter("/books")
+def get_books(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[int] = None,
+    stream: Optional[str] = Query(None, pattern=STREAM_FORMAT_PATTERN),
+    author: Optional[str] = None,
+    year_min: Optional[int] = None,
+    year_max: Optional[int] = None,
+):
     try:
-        books = book_manager.get_all_books()
-        api_logger.info(f"Retrieved {len(books)} books")
-        return books
+        if stream:
+            api_logger.info("Streaming books as %s", stream)
+            return StreamingResponse(
+                book_manager.stream_books(stream, after, author=author, year_min=year_min, year_max=year_max),
+                media_type=STREAM_MEDIA_TYPES[stream],
+            )
+        if limit is not None or after is not None:
+            limit = limit or DEFAULT_PAGE_SIZE
+            return cached_listing(
+                request, book_manager.store, ("books", after, limit, author, year_min, year_max),
+                lambda: book_manager.get_books_page(after, limit, author=author, year_min=year_min, year_max=year_max),
+            )
+        return cached_listing(
+            request, book_manager.store, ("books", author, year_min, year_max),
+            lambda: book_manager.get_all_books(author=author, year_min=year_min, year_max=year_max),
+        )
     except Exception as e:
-        increment_counter("/books", is_error=True)
-        api_logger.error(f"Error retrieving books: {e}")
+        api_logger.error("Error retrieving books: %s", e)
         raise HTTPException(status_code=500, detail="Error retrieving books")
 
+@app.get("/books/search")
+def search_books(q: str = Query(..., min_length=1), limit: int = Query(10, ge=1, le=100)):
+    try:
+        results = book_manager.search_books(q, limit)
+        api_logger.info("Search '%s' returned %s books", q, len(results))
+        return results
+    except Exception as e:
+        api_logger.error("Error searching books: %s", e)
+        raise HTTPException(status_code=500, detail="Error searching books")
+
+@app.get("/books/suggest")
+def suggest_books(prefix: str = Query(..., min_length=1), limit: int = Query(10, ge=1, le=100)):
+    try:
+        return book_manager.suggest_terms(prefix, limit)
+    except Exception as e:
+        api_logger.error("Error suggesting book terms: %s", e)
+        raise HTTPException(status_code=500, detail="Error suggesting book terms")
+
+@app.get("/books/export.csv")
+def export_books_csv(author: Optional[str] = None, year_min: Optional[int] = None, year_max: Optional[int] = None):
+    return csv_export("books", book_manager.stream_books("csv", author=author, year_min=year_min, year_max=year_max))
+
+@app.post("/books/import.csv")
+async def import_books_csv(
+    request: Request,
+    rollback: bool = False,
+    columns: List[str] = Query([], alias="map"),
+    defaults: List[str] = Query([], alias="default"),
+):
+    return await csv_import(request, "books", Book, book_manager.add_books_bulk_async, loan_manager.delete_books_bulk_async,
+                            rollback, columns, defaults, {"year": config.CSV_DEFAULT_YEAR})
+
 @app.get("/books/{book_id}")
-def get_book(book_id: int):
-    increment_counter(f"/books/{book_id}")
+async def get_book(book_id: int, request: Request):
     try:
-        book = book_manager.get_book(book_id)
+        book = await book_manager.get_book_async(book_id)
         if not book:
-            increment_counter(f"/books/{book_id}", is_error=True)
             raise HTTPException(status_code=404, detail="Book not found")
-        return book
+        return cached_record(request, ("books", book_id), book)
     except HTTPException:
         raise
     except Exception as e:
-        increment_counter(f"/books/{book_id}", is_error=True)
-        api_logger.error(f"Error retrieving book {book_id}: {e}")
+        api_logger.error("Error retrieving book %s: %s", book_id, e)
         raise HTTPException(status_code=500, detail="Error retrieving book")
 
 @app.post("/books")
-def add_book(book: Book):
-    increment_counter("/books", is_error=False)
+async def add_book(book: Book):
     try:
-        result = book_manager.add_book(book)
-        api_logger.info(f"Added new book: {book.title} with ID: {book.id}")
+        result = await book_manager.add_book_async(book)
+        api_logger.info("Added new book: %s with ID: %s", book.title, book.id)
         return result
+    except WritesBacklogged:
+        raise
     except Exception as e:
-        increment_counter("/books", is_error=True)
-        api_logger.error(f"Error adding book: {e}")
+        api_logger.error("Error adding book: %s", e)
         raise HTTPException(status_code=500, detail="Error adding book")
 
+@app.post("/books/bulk")
+async def add_books_bulk(request: Request, rollback: bool = False):
+    try:
+        summary = await bulk_ingest(
+            iter_rows(request.stream()),
+            Book,
+            book_manager.add_books_bulk_async,
+            loan_manager.delete_books_bulk_async,
+            rollback=rollback,
+        )
+    except LoanConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except WritesBacklogged:
+        raise
+    except Exception as e:
+        api_logger.error("Error bulk adding books: %s", e)
+        raise HTTPException(status_code=500, detail="Error bulk adding books")
+    if summary["aborted"]:
+        return JSONResponse(status_code=422, content=summary)
+    return summary
+
 @app.put("/books/{book_id}")
-def update_book(book_id: int, updated_book: Book):
-    increment_counter(f"/books/{book_id}")
+async def update_book(book_id: int, updated_book: Book):
     try:
-        book = book_manager.update_book(book_id, updated_book)
+        book = await loan_manager.update_book_async(book_id, updated_book)
         if not book:
-            increment_counter(f"/books/{book_id}", is_error=True)
             raise HTTPException(status_code=404, detail="Book not found")
-        api_logger.info(f"Updated book with ID: {book_id}")
+        api_logger.info("Updated book with ID: %s", book_id)
         return book
     except HTTPException:
         raise
+    except LoanConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except WritesBacklogged:
+        raise
     except Exception as e:
-        increment_counter(f"/books/{book_id}", is_error=True)
-        api_logger.error(f"Error updating book {book_id}: {e}")
+        api_logger.error("Error updating book %s: %s", book_id, e)
         raise HTTPException(status_code=500, detail="Error updating book")
 
 @app.delete("/books/{book_id}")
-def delete_book(book_id: int):
-    increment_counter(f"/books/{book_id}")
+async def delete_book(book_id: int):
     try:
-        book_manager.delete_book(book_id)
-        api_logger.info(f"Deleted book with ID: {book_id}")
+        await loan_manager.delete_book_async(book_id)
+        api_logger.info("Deleted book with ID: %s", book_id)
         return {"message": "Book deleted successfully"}
+    except LoanConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except WritesBacklogged:
+        raise
     except Exception as e:
-        increment_counter(f"/books/{book_id}", is_error=True)
-        api_logger.error(f"Error deleting book {book_id}: {e}")
+        api_logger.error("Error deleting book %s: %s", book_id, e)
         raise HTTPException(status_code=500, detail="Error deleting book")
 
 # -------------------------
 # Reader Endpoints
 # -------------------------
 @app.get("/readers")
-def get_readers():
-    increment_counter("/readers")
+def get_readers(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[int] = None,
+    stream: Optional[str] = Query(None, pattern=STREAM_FORMAT_PATTERN),
+    membership_id: Optional[str] = None,
+):
     try:
-        readers = reader_manager.get_all_readers()
-        api_logger.info(f"Retrieved {len(readers)} readers")
-        return readers
+        if stream:
+            api_logger.info("Streaming readers as %s", stream)
+            return StreamingResponse(
+                reader_manager.stream_readers(stream, after, membership_id=membership_id),
+                media_type=STREAM_MEDIA_TYPES[stream],
+            )
+        if limit is not None or after is not None:
+            limit = limit or DEFAULT_PAGE_SIZE
+            return cached_listing(
+                request, reader_manager.store, ("readers", after, limit, membership_id),
+                lambda: reader_manager.get_readers_page(after, limit, membership_id=membership_id),
+            )
+        return cached_listing(
+            request, reader_manager.store, ("readers", membership_id),
+            lambda: reader_manager.get_all_readers(membership_id=membership_id),
+        )
     except Exception as e:
-        increment_counter("/readers", is_error=True)
-        api_logger.error(f"Error retrieving readers: {e}")
+        api_logger.error("Error retrieving readers: %s", e)
         raise HTTPException(status_code=500, detail="Error retrieving readers")
 
+@app.get("/readers/export.csv")
+def export_readers_csv(membership_id: Optional[str] = None):
+    return csv_export("readers", reader_manager.stream_readers("csv", membership_id=membership_id))
+
+@app.post("/readers/import.csv")
+async def import_readers_csv(
+    request: Request,
+    rollback: bool = False,
+    columns: List[str] = Query([], alias="map"),
+    defaults: List[str] = Query([], alias="default"),
+):
+    return await csv_import(request, "readers", Reader, reader_manager.add_readers_bulk_async,
+                            loan_manager.delete_readers_bulk_async, rollback, columns, defaults)
+
 @app.get("/readers/{reader_id}")
-def get_reader(reader_id: int):
-    increment_counter(f"/readers/{reader_id}")
+async def get_reader(reader_id: int, request: Request):
     try:
-        reader = reader_manager.get_reader(reader_id)
+        reader = await reader_manager.get_reader_async(reader_id)
         if not reader:
-            increment_counter(f"/readers/{reader_id}", is_error=True)
             raise HTTPException(status_code=404, detail="Reader not found")
-        return reader
+        return cached_record(request, ("readers", reader_id), reader)
     except HTTPException:
         raise
     except Exception as e:
-        increment_counter(f"/readers/{reader_id}", is_error=True)
-        api_logger.error(f"Error retrieving reader {reader_id}: {e}")
+        api_logger.error("Error retrieving reader %s: %s", reader_id, e)
         raise HTTPException(status_code=500, detail="Error retrieving reader")
 
 @app.post("/readers")
-def add_reader(reader: Reader):
-    increment_counter("/readers")
+async def add_reader(reader: Reader):
     try:
-        result = reader_manager.add_reader(reader)
-        api_logger.info(f"Added new reader: {reader.name} with ID: {reader.id}")
+        result = await reader_manager.add_reader_async(reader)
+        api_logger.info("Added new reader: %s with ID: %s", reader.name, reader.id)
         return result
+    except WritesBacklogged:
+        raise
     except Exception as e:
-        increment_counter("/readers", is_error=True)
-        api_logger.error(f"Error adding reader: {e}")
+        api_logger.error("Error adding reader: %s", e)
         raise HTTPException(status_code=500, detail="Error adding reader")
 
+@app.post("/readers/bulk")
+async def add_readers_bulk(request: Request, rollback: bool = False):
+    try:
+        summary = await bulk_ingest(
+            iter_rows(request.stream()),
+            Reader,
+            reader_manager.add_readers_bulk_async,
+            loan_manager.delete_readers_bulk_async,
+            rollback=rollback,
+        )
+    except LoanConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except WritesBacklogged:
+        raise
+    except Exception as e:
+        api_logger.error("Error bulk adding readers: %s", e)
+        raise HTTPException(status_code=500, detail="Error bulk adding readers")
+    if summary["aborted"]:
+        return JSONResponse(status_code=422, content=summary)
+    return summary
+
 @app.put("/readers/{reader_id}")
-def update_reader(reader_id: int, updated_reader: Reader):
-    increment_counter(f"/readers/{reader_id}")
+async def update_reader(reader_id: int, updated_reader: Reader):
     try:
-        reader = reader_manager.update_reader(reader_id, updated_reader)
+        reader = await loan_manager.update_reader_async(reader_id, updated_reader)
         if not reader:
-            increment_counter(f"/readers/{reader_id}", is_error=True)
             raise HTTPException(status_code=404, detail="Reader not found")
-        api_logger.info(f"Updated reader with ID: {reader_id}")
+        api_logger.info("Updated reader with ID: %s", reader_id)
         return reader
     except HTTPException:
         raise
+    except LoanConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except WritesBacklogged:
+        raise
     except Exception as e:
-        increment_counter(f"/readers/{reader_id}", is_error=True)
-        api_logger.error(f"Error updating reader {reader_id}: {e}")
+        api_logger.error("Error updating reader %s: %s", reader_id, e)
         raise HTTPException(status_code=500, detail="Error updating reader")
 
 @app.delete("/readers/{reader_id}")
-def delete_reader(reader_id: int):
-    increment_counter(f"/readers/{reader_id}")
+async def delete_reader(reader_id: int):
     try:
-        reader_manager.delete_reader(reader_id)
-        api_logger.info(f"Deleted reader with ID: {reader_id}")
+        await loan_manager.delete_reader_async(reader_id)
+        api_logger.info("Deleted reader with ID: %s", reader_id)
         return {"message": "Reader deleted successfully"}
+    except LoanConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except WritesBacklogged:
+        raise
     except Exception as e:
-        increment_counter(f"/readers/{reader_id}", is_error=True)
-        api_logger.error(f"Error deleting reader {reader_id}: {e}")
+        api_logger.error("Error deleting reader %s: %s", reader_id, e)
         raise HTTPException(status_code=500, detail="Error deleting reader")
 
 # -------------------------
 # Staff Endpoints
 # -------------------------
 @app.get("/staff")
-def get_staff():
-    increment_counter("/staff")
+def get_staff(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[int] = None,
+    stream: Optional[str] = Query(None, pattern=STREAM_FORMAT_PATTERN),
+    position: Optional[str] = None,
+):
     try:
-        staff = staff_manager.get_all_staff()
-        api_logger.info(f"Retrieved {len(staff)} staff members")
-        return staff
+        if stream:
+            api_logger.info("Streaming staff members as %s", stream)
+            return StreamingResponse(
+                staff_manager.stream_staff(stream, after, position=position),
+                media_type=STREAM_MEDIA_TYPES[stream],
+            )
+        if limit is not None or after is not None:
+            limit = limit or DEFAULT_PAGE_SIZE
+            return cached_listing(
+                request, staff_manager.store, ("staff", after, limit, position),
+                lambda: staff_manager.get_staff_page(after, limit, position=position),
+            )
+        return cached_listing(
+            request, staff_manager.store, ("staff", position),
+            lambda: staff_manager.get_all_staff(position=position),
+        )
     except Exception as e:
-        increment_counter("/staff", is_error=True)
-        api_logger.error(f"Error retrieving staff: {e}")
+        api_logger.error("Error retrieving staff: %s", e)
         raise HTTPException(status_code=500, detail="Error retrieving staff")
 
+@app.get("/staff/export.csv")
+def export_staff_csv(position: Optional[str] = None):
+    return csv_export("staff", staff_manager.stream_staff("csv", position=position))
+
+@app.post("/staff/import.csv")
+async def import_staff_csv(
+    request: Request,
+    rollback: bool = False,
+    columns: List[str] = Query([], alias="map"),
+    defaults: List[str] = Query([], alias="default"),
+):
+    return await csv_import(request, "staff", Staff, staff_manager.add_staff_bulk_async, staff_manager.delete_staff_bulk_async,
+                            rollback, columns, defaults)
+
 @app.get("/staff/{staff_id}")
-def get_staff_member(staff_id: int):
-    increment_counter(f"/staff/{staff_id}")
+async def get_staff_member(staff_id: int, request: Request):
     try:
-        staff = staff_manager.get_staff(staff_id)
+        staff = await staff_manager.get_staff_async(staff_id)
         if not staff:
-            increment_counter(f"/staff/{staff_id}", is_error=True)
             raise HTTPException(status_code=404, detail="Staff not found")
-        return staff
+        return cached_record(request, ("staff", staff_id), staff)
     except HTTPException:
         raise
     except Exception as e:
-        increment_counter(f"/staff/{staff_id}", is_error=True)
-        api_logger.error(f"Error retrieving staff {staff_id}: {e}")
+        api_logger.error("Error retrieving staff %s: %s", staff_id, e)
         raise HTTPException(status_code=500, detail="Error retrieving staff")
 
 @app.post("/staff")
-def add_staff(staff: Staff):
-    increment_counter("/staff")
+async def add_staff(staff: Staff):
     try:
-        result = staff_manager.add_staff(staff)
-        api_logger.info(f"Added new staff: {staff.name} with ID: {staff.id}")
+        result = await staff_manager.add_staff_async(staff)
+        api_logger.info("Added new staff: %s with ID: %s", staff.name, staff.id)
         return result
+    except WritesBacklogged:
+        raise
     except Exception as e:
-        increment_counter("/staff", is_error=True)
-        api_logger.error(f"Error adding staff: {e}")
+        api_logger.error("Error adding staff: %s", e)
         raise HTTPException(status_code=500, detail="Error adding staff")
 
+@app.post("/staff/bulk")
+async def add_staff_bulk(request: Request, rollback: bool = False):
+    try:
+        summary = await bulk_ingest(
+            iter_rows(request.stream()),
+            Staff,
+            staff_manager.add_staff_bulk_async,
+            staff_manager.delete_staff_bulk_async,
+            rollback=rollback,
+        )
+    except WritesBacklogged:
+        raise
+    except Exception as e:
+        api_logger.error("Error bulk adding staff: %s", e)
+        raise HTTPException(status_code=500, detail="Error bulk adding staff")
+    if summary["aborted"]:
+        return JSONResponse(status_code=422, content=summary)
+    return summary
+
 @app.put("/staff/{staff_id}")
-def update_staff(staff_id: int, updated_staff: Staff):
-    increment_counter(f"/staff/{staff_id}")
+async def update_staff(staff_id: int, updated_staff: Staff):
     try:
-        staff = staff_manager.update_staff(staff_id, updated_staff)
+        staff = await staff_manager.update_staff_async(staff_id, updated_staff)
         if not staff:
-            increment_counter(f"/staff/{staff_id}", is_error=True)
             raise HTTPException(status_code=404, detail="Staff not found")
-        api_logger.info(f"Updated staff with ID: {staff_id}")
+        api_logger.info("Updated staff with ID: %s", staff_id)
         return staff
     except HTTPException:
         raise
+    except WritesBacklogged:
+        raise
     except Exception as e:
-        increment_counter(f"/staff/{staff_id}", is_error=True)
-        api_logger.error(f"Error updating staff {staff_id}: {e}")
+        api_logger.error("Error updating staff %s: %s", staff_id, e)
         raise HTTPException(status_code=500, detail="Error updating staff")
 
 @app.delete("/staff/{staff_id}")
-def delete_staff(staff_id: int):
-    increment_counter(f"/staff/{staff_id}")
+async def delete_staff(staff_id: int):
     try:
-        staff_manager.delete_staff(staff_id)
-        api_logger.info(f"Deleted staff with ID: {staff_id}")
+        await staff_manager.delete_staff_async(staff_id)
+        api_logger.info("Deleted staff with ID: %s", staff_id)
         return {"message": "Staff deleted successfully"}
+    except WritesBacklogged:
+        raise
     except Exception as e:
-        increment_counter(f"/staff/{staff_id}", is_error=True)
-        api_logger.error(f"Error deleting staff {staff_id}: {e}")
+        api_logger.error("Error deleting staff %s: %s", staff_id, e)
         raise HTTPException(status_code=500, detail="Error deleting staff")
 
+# -------------------------
+# Loan Endpoints
+# -------------------------
+@app.get("/loans")
+def get_loans(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[int] = None,
+    book_id: Optional[int] = None,
+    reader_id: Optional[int] = None,
+):
+    try:
+        return cached_listing(
+            request, loan_manager.store, ("loans", after, limit, book_id, reader_id),
+            lambda: loan_manager.get_loans_page(after, limit, book_id=book_id, reader_id=reader_id),
+        )
+    except Exception as e:
+        api_logger.error("Error retrieving loans: %s", e)
+        raise HTTPException(status_code=500, detail="Error retrieving loans")
+
+@app.get("/loans/overdue")
+def get_overdue_loans(
+    request: Request,
+    as_of: Optional[date] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}:-?\d+$"),
+):
+    as_of = as_of or date.today()
+    try:
+        return cached_listing(
+            request, loan_manager.store, ("loans/overdue", as_of, after, limit),
+            lambda: loan_manager.get_overdue_page(as_of, after, limit),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {e}")
+    except Exception as e:
+        api_logger.error("Error retrieving overdue loans: %s", e)
+        raise HTTPException(status_code=500, detail="Error retrieving overdue loans")
+
+@app.get("/loans/history")
+def get_loan_history(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[int] = None,
+    book_id: Optional[int] = None,
+    reader_id: Optional[int] = None,
+):
+    try:
+        return cached_listing(
+            request, loan_manager.history, ("loans/history", after, limit, book_id, reader_id),
+            lambda: loan_manager.get_history_page(after, limit, book_id=book_id, reader_id=reader_id),
+        )
+    except Exception as e:
+        api_logger.error("Error retrieving loan history: %s", e)
+        raise HTTPException(status_code=500, detail="Error retrieving loan history")
+
+@app.get("/loans/{loan_id}")
+async def get_loan(loan_id: int):
+    try:
+        loan = await loan_manager.get_loan_async(loan_id)
+        if not loan:
+            raise HTTPException(status_code=404, detail="Loan not found")
+        return loan
+    except HTTPException:
+        raise
+    except Exception as e:
+        api_logger.error("Error retrieving loan %s: %s", loan_id, e)
+        raise HTTPException(status_code=500, detail="Error retrieving loan")
+
+@app.post("/loans")
+async def checkout_book(checkout: Checkout):
+    try:
+        loan = await loan_manager.checkout_async(checkout)
+        api_logger.info("Lent book %s to reader %s with loan ID: %s", checkout.book_id, checkout.reader_id, checkout.id)
+        return loan
+    except MissingRecord as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except LoanConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except WritesBacklogged:
+        raise
+    except Exception as e:
+        api_logger.error("Error lending book %s: %s", checkout.book_id, e)
+        raise HTTPException(status_code=500, detail="Error lending book")
+
+@app.post("/loans/{loan_id}/return")
+async def return_loan(loan_id: int):
+    try:
+        loan = await loan_manager.return_loan_async(loan_id)
+        if not loan:
+            raise HTTPException(status_code=404, detail="Active loan not found")
+        api_logger.info("Returned loan with ID: %s", loan_id)
+        return loan
+    except HTTPException:
+        raise
+    except WritesBacklogged:
+        raise
+    except Exception as e:
+        api_logger.error("Error returning loan %s: %s", loan_id, e)
+        raise HTTPException(status_code=500, detail="Error returning loan")
+
+@app.post("/loans/{loan_id}/renew")
+async def renew_loan(loan_id: int):
+    try:
+        loan = await loan_manager.renew_async(loan_id)
+        if not loan:
+            raise HTTPException(status_code=404, detail="Active loan not found")
+        api_logger.info("Renewed loan with ID: %s", loan_id)
+        return loan
+    except HTTPException:
+        raise
+    except LoanConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except WritesBacklogged:
+        raise
+    except Exception as e:
+        api_logger.error("Error renewing loan %s: %s", loan_id, e)
+        raise HTTPException(status_code=500, detail="Error renewing loan")
+
+@app.get("/books/{book_id}/availability")
+async def get_book_availability(book_id: int):
+    try:
+        if not await book_manager.get_book_async(book_id):
+            raise HTTPException(status_code=404, detail="Book not found")
+        loan = await loan_manager.get_book_loan_async(book_id)
+        return {"book_id": book_id, "available": loan is None, "due": loan["due"] if loan else None}
+    except HTTPException:
+        raise
+    except Exception as e:
+        api_logger.error("Error retrieving availability of book %s: %s", book_id, e)
+        raise HTTPException(status_code=500, detail="Error retrieving availability")
+
+@app.get("/readers/{reader_id}/loans")
+async def get_reader_loans(reader_id: int):
+    try:
+        if not await reader_manager.get_reader_async(reader_id):
+            raise HTTPException(status_code=404, detail="Reader not found")
+        return await loan_manager.get_reader_loans_async(reader_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        api_logger.error("Error retrieving loans of reader %s: %s", reader_id, e)
+        raise HTTPException(status_code=500, detail="Error retrieving reader loans")
+
+# -------------------------
+# Change Feed Endpoints
+# -------------------------
+SSE_MEDIA_TYPE = "text/event-stream"
+
+def _sse(event: str, data: Any, event_id: Optional[str] = None) -> str:
+    lines = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{lines}event: {event}\ndata: {encode_json(data).decode()}\n\n"
+
+@app.get("/changes")
+async def get_changes(
+    since: int = Query(..., ge=0),
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    epoch: Optional[str] = None,
+    collections: List[str] = Query([], alias="collection"),
+):
+    try:
+        return await store_writer.read(change_log, change_log.since, since, limit, collections, epoch)
+    except Exception as e:
+        api_logger.error("Error retrieving changes since %s: %s", since, e)
+        raise HTTPException(status_code=500, detail="Error retrieving changes")
+
+@app.get("/changes/stream")
+async def stream_changes(
+    request: Request,
+    since: Optional[int] = Query(None, ge=0),
+    epoch: Optional[str] = None,
+    collections: List[str] = Query([], alias="collection"),
+):
+    # A reconnecting EventSource resumes from the "<epoch>:<seq>" id of the last event it got
+    last_event = request.headers.get("last-event-id")
+    if last_event:
+        epoch, _, seq = last_event.partition(":")
+        if not seq.isdigit():
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+        since = int(seq)
+    if since is None:
+        since = await store_writer.read(change_log, change_log.latest)
+
+    async def events():
+        position, expected = since, epoch
+        quiet_since = time.monotonic()
+        while True:
+            page = await store_writer.read(change_log, change_log.since, position, MAX_PAGE_SIZE, collections, expected)
+            if page["resync"]:
+                yield _sse("resync", {"epoch": page["epoch"], "latest": page["latest"]})
+                return
+            for change in page["changes"]:
+                yield _sse("change", change, f"{page['epoch']}:{change['seq']}")
+            if page["changes"]:
+                quiet_since = time.monotonic()
+            elif time.monotonic() - quiet_since >= config.CHANGES_HEARTBEAT:
+                # Keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+                quiet_since = time.monotonic()
+            position, expected = page["next_since"], page["epoch"]
+            if position < page["latest"]:
+                continue
+            await change_log.wait(position, config.CHANGES_HEARTBEAT)
+
+    api_logger.info("Streaming changes since %s", since)
+    return StreamingResponse(events(), media_type=SSE_MEDIA_TYPE,
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,123 @@
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, Tuple
+
+from app.flusher import percentiles
+
+# Route label for requests that matched no route, so unknown paths cannot add series
+UNMATCHED_ROUTE = "<unmatched>"
+# Latency samples kept per route for the p50/p95/p99 estimates
+LATENCY_WINDOW = 1024
+QUANTILES = (50, 95, 99)
+PROMETHEUS_MEDIA_TYPE = "text/plain; version=0.0.4"
+
+Gauge = Callable[[], Iterable[Tuple[Dict[str, str], float]]]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: Dict[str, object]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class RouteStats:
+    """Request count, error count and recent latencies of one route and method"""
+
+    __slots__ = ("requests", "statuses", "latency_sum", "latencies")
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses: Dict[int, int] = {}
+        self.latency_sum = 0.0
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+
+class Metrics:
+    """Thread-safe request metrics keyed by route template and method
+
+    Series are keyed by the route's path template ("/books/{book_id}"),
+    never by the concrete path, so their number is bounded by the route
+    table no matter how many distinct ids are requested. Gauges are read
+    from registered callbacks when the metrics are rendered.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes: Dict[Tuple[str, str], RouteStats] = {}
+        self._gauges: Dict[str, Tuple[str, Gauge]] = {}
+
+    def observe(self, method: str, route: str, status: int, latency_ms: float):
+        """Record one finished request"""
+        with self._lock:
+            stats = self._routes.get((route, method))
+            if stats is None:
+                stats = self._routes[(route, method)] = RouteStats()
+            stats.requests += 1
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.latency_sum += latency_ms
+            stats.latencies.append(latency_ms)
+
+    def gauge(self, name: str, help_text: str, read: Gauge):
+        """Register a gauge whose (labels, value) samples are read at render time"""
+        self._gauges[name] = (help_text, read)
+
+    def summary(self) -> dict:
+        """Constant-size request totals, for the health endpoint"""
+        with self._lock:
+            total = errors = 0
+            by_endpoint: Dict[str, int] = {}
+            for (route, _), stats in self._routes.items():
+                total += stats.requests
+                errors += sum(count for status, count in stats.statuses.items() if status >= 400)
+                by_endpoint[route] = by_endpoint.get(route, 0) + stats.requests
+        return {"total_requests": total, "requests_by_endpoint": by_endpoint, "total_errors": errors}
+
+    def render(self) -> str:
+        """Prometheus text exposition of every metric"""
+        with self._lock:
+            snapshot = [
+                (route, method, stats.requests, dict(stats.statuses), stats.latency_sum, list(stats.latencies))
+                for (route, method), stats in sorted(self._routes.items())
+            ]
+        # Percentiles are computed outside the lock so rendering does not stall requests
+        routes = [(*fields, percentiles(latencies, QUANTILES)) for *fields, latencies in snapshot]
+
+        lines: List[str] = [
+            "# HELP http_requests_total Requests handled, by route template, method and status",
+            "# TYPE http_requests_total counter",
+        ]
+        for route, method, _, statuses, _, _ in routes:
+            for status, count in sorted(statuses.items()):
+                labels = _labels({"route": route, "method": method, "status": status})
+                lines.append(f"http_requests_total{labels} {count}")
+
+        lines += [
+            "# HELP http_request_errors_total Requests answered with a 4xx or 5xx status",
+            "# TYPE http_request_errors_total counter",
+        ]
+        for route, method, _, statuses, _, _ in routes:
+            for status, count in sorted(statuses.items()):
+                if status >= 400:
+                    labels = _labels({"route": route, "method": method, "status": status})
+                    lines.append(f"http_request_errors_total{labels} {count}")
+
+        lines += [
+            f"# HELP http_request_duration_ms Request latency over the last {LATENCY_WINDOW} requests per route",
+            "# TYPE http_request_duration_ms summary",
+        ]
+        for route, method, requests, _, latency_sum, quantiles in routes:
+            for point in QUANTILES:
+                labels = _labels({"route": route, "method": method, "quantile": point / 100})
+                lines.append(f"http_request_duration_ms{labels} {quantiles[f'p{point}']}")
+            labels = _labels({"route": route, "method": method})
+            lines.append(f"http_request_duration_ms_sum{labels} {round(latency_sum, 3)}")
+            lines.append(f"http_request_duration_ms_count{labels} {requests}")
+
+        for name, (help_text, read) in sorted(self._gauges.items()):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            lines.extend(f"{name}{_labels(labels)} {value}" for labels, value in read())
+        return "\n".join(lines) + "\n"
@@ -1,4 +1,7 @@
-from pydantic import BaseModel
+from datetime import date
+from typing import Optional
+
+from pydantic import BaseModel, Field
 
 class Book(BaseModel):
     id: int
@@ -15,3 +18,19 @@ class Staff(BaseModel):
     id: int
     name: str
     position: str
+
+class Loan(BaseModel):
+    id: int
+    book_id: int
+    reader_id: int
+    loaned_on: date
+    due: date
+    renewals: int = 0
+    returned_on: Optional[date] = None
+
+class Checkout(BaseModel):
+    id: int
+    book_id: int
+    reader_id: int
+    # Loan period in days; LIBRARY_LOAN_DAYS when omitted
+    days: Optional[int] = Field(None, ge=1, le=365)
@@ -0,0 +1,88 @@
+import csv
+import io
+import json
+from typing import Any, Dict, Iterator, List, Optional
+
+from app.store import RecordStore
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Records encoded per chunk when streaming a full listing
+STREAM_CHUNK_SIZE = 500
+STREAM_MEDIA_TYPES = {"json": "application/json", "ndjson": "application/x-ndjson", "csv": "text/csv"}
+STREAM_FORMAT_PATTERN = "^(json|ndjson|csv)$"
+
+
+def paginate(store: RecordStore, after: Optional[Any] = None, limit: int = DEFAULT_PAGE_SIZE,
+             criteria: Optional[Dict[str, Any]] = None) -> dict:
+    """Get one keyset page of records ordered by key
+
+    ``next_after`` is the key to pass as ``after`` for the following page,
+    or None on the last page. Keyset cursors stay stable while records are
+    added or removed between requests.
+    """
+    items = store.page(after, limit + 1, criteria)
+    has_more = len(items) > limit
+    items = items[:limit]
+    return {"items": items, "next_after": items[-1][store.key] if has_more else None}
+
+
+def _iter_pages(store: RecordStore, after: Optional[Any], chunk_size: int,
+                criteria: Optional[Dict[str, Any]]) -> Iterator[list]:
+    if criteria:
+        # Resolve the matching keys once instead of re-querying for every chunk
+        keys = [key for key in store.find(criteria) if after is None or key > after]
+        for start in range(0, len(keys), chunk_size):
+            records = (store.get(key) for key in keys[start:start + chunk_size])
+            yield [record for record in records if record is not None]
+        return
+    while True:
+        page = store.page(after, chunk_size)
+        if not page:
+            return
+        after = page[-1][store.key]
+        yield page
+
+
+def stream_records(store: RecordStore, fmt: str = "json", after: Optional[Any] = None,
+                   criteria: Optional[Dict[str, Any]] = None,
+                   chunk_size: int = STREAM_CHUNK_SIZE, columns: Optional[List[str]] = None) -> Iterator[bytes]:
+    """Encode records ordered by key as a JSON array, NDJSON or CSV, chunk by chunk
+
+    The store is walked one keyset page at a time, so only a single chunk
+    of records is materialized no matter how large the listing is; filtered
+    listings additionally hold just the matching keys. CSV output starts
+    with a header row of ``columns``.
+    """
+    if fmt == "csv":
+        yield from _stream_csv(store, after, criteria, chunk_size, columns)
+        return
+    if fmt == "json":
+        yield b"["
+    first = True
+    for page in _iter_pages(store, after, chunk_size, criteria):
+        if not page:
+            continue
+        if fmt == "ndjson":
+            yield "".join(json.dumps(record) + "\n" for record in page).encode()
+        else:
+            chunk = ",".join(json.dumps(record) for record in page)
+            yield (chunk if first else "," + chunk).encode()
+            first = False
+    if fmt == "json":
+        yield b"]"
+
+
+def _stream_csv(store: RecordStore, after: Optional[Any], criteria: Optional[Dict[str, Any]],
+                chunk_size: int, columns: List[str]) -> Iterator[bytes]:
+    out = io.StringIO()
+    writer = csv.DictWriter(out, columns, extrasaction="ignore")
+    writer.writeheader()
+    for page in _iter_pages(store, after, chunk_size, criteria):
+        writer.writerows(page)
+        yield out.getvalue().encode()
+        out.seek(0)
+        out.truncate()
+    if out.tell():
+        yield out.getvalue().encode()
@@ -0,0 +1,318 @@
+import copy
+import json
+import logging
+import os
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+from app import config
+from app.flusher import FlushingPersistence
+from app.layouts import record_layout
+from app.shards import DATA_EXTENSIONS, ShardedStore, shard_filename, shard_of, stored_shards
+from app.snapshot import LazyRecords, Snapshot, write_snapshot
+from app.sqlite_store import SqliteStore
+from app.store import Record, RecordStore
+
+logger = logging.getLogger("api")
+
+RecordSource = Callable[[], Iterable[Record]]
+
+# ("put", record) or ("del", key)
+Entry = Tuple[str, Any]
+
+
+def atomic_write_json(path: str, records: Iterable[Record], indent: Optional[int] = 4):
+    """Write records to path via a temp file, fsync and rename
+
+    Readers and crash recovery only ever see the old or the new file,
+    never a truncated one.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(list(records), f, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class JsonFilePersistence:
+    """Persists a store by rewriting the whole JSON file after every change"""
+
+    indent: Optional[int] = 4
+
+    def __init__(self, path: str):
+        self.path = path
+        self._source: RecordSource = list
+
+    def bind(self, source: RecordSource):
+        """Attach the callable that yields the current records for snapshots"""
+        self._source = source
+
+    def load(self) -> List[Record]:
+        """Read all records from the data file"""
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def put(self, record: Record):
+        """Persist an inserted or updated record"""
+        self.write_batch([("put", record)])
+
+    def delete(self, key: Any):
+        """Persist the deletion of a record"""
+        self.write_batch([("del", key)])
+
+    def put_many(self, records: List[Record]):
+        """Persist several inserted or updated records with a single write"""
+        self.write_batch([("put", record) for record in records])
+
+    def delete_many(self, keys: List[Any]):
+        """Persist several deletions with a single write"""
+        self.write_batch([("del", key) for key in keys])
+
+    def write_batch(self, entries: List[Entry]):
+        """Durably persist a batch of changes with a single write"""
+        self.snapshot()
+
+    def snapshot(self):
+        """Write every record to the data file"""
+        try:
+            self._write_snapshot(self._source())
+            logger.debug("Snapshot written to %s", self.path)
+        except Exception as e:
+            logger.error("Error writing snapshot %s: %s", self.path, e)
+            raise
+
+    def _write_snapshot(self, records: Iterable[Record]):
+        atomic_write_json(self.path, records, self.indent)
+
+    def compact(self):
+        """Bring the data file fully up to date"""
+        self.snapshot()
+
+    def close(self):
+        """Release any open file handles"""
+
+
+class JournalPersistence(JsonFilePersistence):
+    """Persists a store as a JSON snapshot plus an append-only journal
+
+    Every mutation appends one compact JSON line to the journal, so the cost
+    of a write does not depend on the catalog size. On load the journal is
+    replayed over the snapshot; once it holds ``compact_every`` entries it is
+    folded into a new snapshot and truncated.
+    """
+
+    indent = None
+
+    def __init__(self, path: str, compact_every: int = config.JOURNAL_COMPACT_EVERY, key: str = "id"):
+        super().__init__(path)
+        self.journal_path = os.path.splitext(path)[0] + ".journal"
+        self.compact_every = compact_every
+        self.key = key
+        self._entries = 0
+        self._journal = None
+
+    def bind(self, source: RecordSource):
+        super().bind(source)
+        if self._entries >= self.compact_every:
+            self.compact()
+
+    def load(self) -> List[Record]:
+        """Read the snapshot and replay the journal on top of it"""
+        try:
+            records = {record[self.key]: record for record in super().load()}
+        except FileNotFoundError:
+            if not os.path.exists(self.journal_path):
+                raise
+            records = {}
+        self._replay(records)
+        return list(records.values())
+
+    def _replay(self, records):
+        """Apply the journal to a mapping of key to record"""
+        self._entries = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r") as f:
+                for line_no, line in enumerate(f, 1):
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn last line is what a crash mid-append leaves behind
+                        logger.warning("Ignoring unreadable journal entry %s:%s", self.journal_path, line_no)
+                        continue
+                    if entry["op"] == "put":
+                        records[entry["record"][self.key]] = entry["record"]
+                    elif entry["op"] == "del":
+                        records.pop(entry["key"], None)
+                    self._entries += 1
+            logger.info("Replayed %s journal entries from %s", self._entries, self.journal_path)
+
+    def write_batch(self, entries: List[Entry]):
+        """Append the batch to the journal and fsync it once"""
+        lines = []
+        for op, value in entries:
+            entry = {"op": "put", "record": value} if op == "put" else {"op": "del", "key": value}
+            lines.append(json.dumps(entry, separators=(",", ":")) + "\n")
+
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a")
+        self._journal.write("".join(lines))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._entries += len(entries)
+        if self._entries >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """Fold the journal into a fresh snapshot and truncate it
+
+        The snapshot is replaced before the journal is truncated; a crash in
+        between only means replaying entries the snapshot already contains.
+        """
+        self.snapshot()
+        self.close()
+        open(self.journal_path, "w").close()
+        self._entries = 0
+        logger.info("Compacted journal into %s", self.path)
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+class SnapshotPersistence(JournalPersistence):
+    """Persists a store as a binary snapshot (see app.snapshot) plus an append-only journal
+
+    Loading maps the snapshot instead of parsing it and returns a
+    LazyRecords mapping, so only the records the journal touches are
+    decoded and startup time no longer grows with the catalog. When there
+    is no snapshot yet, one is created from the collection's JSON file.
+    """
+
+    def __init__(self, path: str, seed_path: Optional[str] = None, **kwargs):
+        super().__init__(path, **kwargs)
+        self.seed_path = seed_path
+
+    def load(self) -> LazyRecords:
+        """Map the snapshot and replay the journal on top of it"""
+        if not os.path.exists(self.path):
+            if self.seed_path is not None and os.path.exists(self.seed_path):
+                with open(self.seed_path, "r") as f:
+                    self._write_snapshot(json.load(f))
+                logger.info("Converted %s into snapshot %s", self.seed_path, self.path)
+            elif os.path.exists(self.journal_path):
+                self._write_snapshot([])
+            else:
+                raise FileNotFoundError(self.path)
+        records = LazyRecords(Snapshot(self.path))
+        self._replay(records)
+        return records
+
+    def _write_snapshot(self, records: Iterable[Record]):
+        write_snapshot(self.path, records, self.key)
+
+
+def storage_for(filename: str):
+    """The persistence of a data file as configured by LIBRARY_STORAGE, without write batching"""
+    path = os.path.join(config.DATA_DIR, filename)
+    if config.STORAGE_MODE == "journal":
+        return JournalPersistence(path)
+    if config.STORAGE_MODE == "snapshot":
+        return SnapshotPersistence(os.path.splitext(path)[0] + ".snap", seed_path=path)
+    if config.STORAGE_MODE == "json":
+        return JsonFilePersistence(path)
+    raise ValueError(f"Unknown storage mode: {config.STORAGE_MODE}")
+
+
+def open_persistence(filename: str):
+    """Create the persistence configured by LIBRARY_STORAGE and LIBRARY_DURABILITY"""
+    return FlushingPersistence(
+        storage_for(filename),
+        mode=config.DURABILITY,
+        interval_ms=config.FLUSH_INTERVAL_MS,
+        max_batch=config.FLUSH_MAX_BATCH,
+    )
+
+
+def open_store(name: str, load: Callable[[Any], List[Record]], indexes: Optional[dict] = None,
+               model=None, interned: Iterable[str] = (), shards: int = 1):
+    """Create the record store for one collection, backed as configured by LIBRARY_STORAGE
+
+    ``load`` receives a persistence and returns the records to start from.
+    In "sqlite" mode it is only called to seed a new table from the
+    collection's JSON file, which makes switching backends a migration.
+    For the in-memory modes, ``model`` and ``interned`` describe the records
+    to the compact layout chosen by LIBRARY_RECORD_LAYOUT, and ``shards``
+    above 1 splits the collection into a ShardedStore, ``load`` then being
+    called once per shard. The database of "sqlite" mode is not sharded.
+    """
+    if config.STORAGE_MODE == "sqlite":
+        os.makedirs(config.DATA_DIR, exist_ok=True)
+        seed = JsonFilePersistence(os.path.join(config.DATA_DIR, f"{name}.json"))
+        return SqliteStore(
+            os.path.join(config.DATA_DIR, config.SQLITE_FILE),
+            table=name,
+            indexes=indexes,
+            durability=config.DURABILITY,
+            seed=lambda: load(seed),
+        )
+    stored = stored_shards(name)
+    if stored and shards not in stored:
+        # Starting empty would hide the data; it has to be redistributed first
+        raise ValueError(f"{name} is stored in {stored[0]} shard(s), not {shards}: "
+                         f"run python -m app.cli reshard {name} --shards {shards}")
+    layout = record_layout(config.RECORD_LAYOUT, "id", model, interned) if model is not None else None
+    if shards == 1:
+        persistence = open_persistence(f"{name}.json")
+        return RecordStore(load(persistence), persistence=persistence, indexes=indexes, layout=layout)
+    parts = []
+    for index in range(shards):
+        persistence = open_persistence(shard_filename(name, index, shards))
+        parts.append(RecordStore(load(persistence), persistence=persistence,
+                                 indexes=copy.deepcopy(indexes), layout=layout))
+    return ShardedStore(parts, os.path.join(config.DATA_DIR, f"{name}.*-of-{shards}.json"))
+
+
+def reshard(name: str, shards: int, key: str = "id") -> dict:
+    """Redistribute a collection's data files over a number of shards; only with the API stopped
+
+    Every record is read from the current layout and written to the new
+    shards' files as full snapshots. The old files are removed only once
+    the new layout is complete, so an interrupted run loses nothing: the
+    new files are then deleted by hand and the run repeated.
+    """
+    if config.STORAGE_MODE == "sqlite":
+        raise ValueError("sqlite storage is not sharded")
+    if shards < 1:
+        raise ValueError("shards must be at least 1")
+    stored = stored_shards(name)
+    if len(stored) > 1:
+        raise ValueError(f"{name} has data files for {', '.join(map(str, stored))} shards; keep only one layout")
+    current = stored[0] if stored else shards
+    if current == shards:
+        return {"collection": name, "from": current, "to": shards, "records": None}
+
+    parts: List[List[Record]] = [[] for _ in range(shards)]
+    for index in range(current):
+        storage = storage_for(shard_filename(name, index, current))
+        try:
+            records = storage.load()
+        except FileNotFoundError:
+            continue
+        for record in records.values() if isinstance(records, LazyRecords) else records:
+            parts[shard_of(record[key], shards)].append(record)
+        storage.close()
+
+    for index, records in enumerate(parts):
+        storage = storage_for(shard_filename(name, index, shards))
+        storage.bind(lambda records=records: records)
+        storage.compact()
+        storage.close()
+    for index in range(current):
+        base = os.path.splitext(os.path.join(config.DATA_DIR, shard_filename(name, index, current)))[0]
+        for extension in DATA_EXTENSIONS:
+            if os.path.exists(base + extension):
+                os.remove(base + extension)
+    logger.info("Resharded %s from %s to %s shards", name, current, shards)
+    return {"collection": name, "from": current, "to": shards, "records": sum(map(len, parts)),
+            "per_shard": [len(records) for records in parts]}
@@ -1,22 +1,53 @@
 import json
 import logging
-from typing import List
+from typing import Iterator, List, Optional
+from app import config
+from app.changes import change_log
+from app.indexes import HashIndex
 from app.models import Reader
+from app.pagination import DEFAULT_PAGE_SIZE, paginate, stream_records
+from app.persistence import open_store
+from app.store import RecordStore
+from app.writer import store_writer
 
 logger = logging.getLogger("api")
 
 class ReaderManager:
     def __init__(self):
-        self.data_file = "app/data/readers.json"
-        self.readers = self._load_readers()
+        # Opened by open() when the application starts, not at import time
+        self.store: Optional[RecordStore[int]] = None
+        self.persistence = None
+        self.data_file = None
 
-    def _load_readers(self) -> List[dict]:
-        """Load readers from JSON file"""
+    def open(self):
+        """Load the readers store; a snapshot-backed store finishes indexing in build_indexes()"""
+        self.store = open_store(
+            "readers",
+            self._load_readers,
+            indexes={"membership_id": HashIndex("membership_id")},
+            model=Reader,
+            shards=config.SHARDS,
+        )
+        change_log.attach("readers", self.store)
+        self.persistence = self.store.persistence
+        self.data_file = self.persistence.path
+
+    @property
+    def ready(self) -> bool:
+        """Whether the readers store is open and fully indexed"""
+        return self.store is not None and self.store.ready
+
+    @property
+    def readers(self) -> List[dict]:
+        """All readers in insertion order"""
+        return self.store.values()
+
+    def _load_readers(self, persistence) -> List[dict]:
+        """Load readers from the data file"""
         try:
-            with open(self.data_file, "r") as f:
-                readers_data = json.load(f)
-                logger.info(f"Loaded {len(readers_data)} readers from file")
-                return readers_data
+            readers_data = persistence.load()
+            logger.info("Loaded %s readers from file", len(readers_data))
+            return readers_data
         except FileNotFoundError:
             logger.warning("Readers data file not found, starting with empty list")
             return []
@@ -25,26 +56,47 @@ class ReaderManager:
             return []
 
     def save_data(self):
-        """Save readers to JSON file"""
+        """Write a full readers snapshot to the data file"""
         try:
-            with open(self.data_file, "w") as f:
-                json.dump(self.readers, f, indent=4)
+            self.store.save()
             logger.debug("Readers data saved successfully")
         except Exception as e:
-            logger.error(f"Error saving readers data: {e}")
+            logger.error("Error saving readers data: %s", e)
             raise
 
-    def get_all_readers(self) -> List[dict]:
-        """Get all readers"""
-        return self.readers
+    def close(self):
+        """Flush pending writes and release the data file"""
+        if self.store is not None:
+            self.store.close()
+
+    @staticmethod
+    def _criteria(membership_id: Optional[str]) -> dict:
+        """Translate filter arguments into store index criteria"""
+        return {"membership_id": membership_id} if membership_id is not None else {}
+
+    def get_all_readers(self, membership_id: Optional[str] = None) -> List[dict]:
+        """Get all readers, optionally filtered by membership ID"""
+        criteria = self._criteria(membership_id)
+        return self.store.select(criteria) if criteria else self.store.values()
+
+    def get_readers_page(self, after: Optional[int] = None, limit: int = DEFAULT_PAGE_SIZE,
+                         membership_id: Optional[str] = None) -> dict:
+        """Get one page of readers ordered by ID, starting after the given ID"""
+        return paginate(self.store, after, limit, self._criteria(membership_id))
+
+    def stream_readers(self, fmt: str = "json", after: Optional[int] = None,
+                       membership_id: Optional[str] = None) -> Iterator[bytes]:
+        """Encode all matching readers ordered by ID as JSON, NDJSON or CSV chunks"""
+        return stream_records(self.store, fmt, after, self._criteria(membership_id),
+                              columns=list(Reader.model_fields))
 
     def get_reader(self, reader_id: int) -> dict:
         """Get reader by ID"""
-        reader = next((r for r in self.readers if r["id"] == reader_id), None)
+        reader = self.store.get(reader_id)
         if reader:
-            logger.debug(f"Retrieved reader with ID: {reader_id}")
+            logger.debug("Retrieved reader with ID: %s", reader_id)
         else:
-            logger.debug(f"Reader with ID {reader_id} not found")
+            logger.debug("Reader with ID %s not found", reader_id)
         return reader
 
     def add_reader(self, reader: Reader) -> dict:
@@ -52,34 +104,66 @@ class ReaderManager:
         reader_dict = reader.model_dump()
         
         # Check if reader with same ID already exists
-        if any(r["id"] == reader_dict["id"] for r in self.readers):
-            logger.warning(f"Reader with ID {reader_dict['id']} already exists")
+        if reader_dict["id"] in self.store:
+            logger.warning("Reader with ID %s already exists", reader_dict['id'])
             raise ValueError(f"Reader with ID {reader_dict['id']} already exists")
         
-        self.readers.append(reader_dict)
-        self.save_data()
-        logger.info(f"Added new reader: {reader_dict}")
+        self.store.insert(reader_dict)
+        logger.debug("Added new reader: %s", reader_dict)
         return reader_dict
 
+    def add_readers_bulk(self, readers: List[Reader]) -> List[Optional[str]]:
+        """Add several readers with a single write, returning a per-row error or None"""
+        results = self.store.insert_many([item.model_dump() for item in readers])
+        logger.info("Bulk added %s of %s readers", results.count(None), len(results))
+        return results
+
     def update_reader(self, reader_id: int, updated_reader: Reader) -> dict:
         """Update an existing reader"""
-        for i, reader in enumerate(self.readers):
-            if reader["id"] == reader_id:
-                self.readers[i] = updated_reader.model_dump()
-                self.save_data()
-                logger.info(f"Updated reader with ID: {reader_id}")
-                return self.readers[i]
+        reader_dict = self.store.update(reader_id, updated_reader.model_dump())
+        if reader_dict is not None:
+            logger.info("Updated reader with ID: %s", reader_id)
+            return reader_dict
         
-        logger.warning(f"Reader with ID {reader_id} not found for update")
+        logger.warning("Reader with ID %s not found for update", reader_id)
         return None
 
     def delete_reader(self, reader_id: int):
         """Delete a reader by ID"""
-        initial_count = len(self.readers)
-        self.readers = [reader for reader in self.readers if reader["id"] != reader_id]
-        
-        if len(self.readers) < initial_count:
-            self.save_data()
-            logger.info(f"Deleted reader with ID: {reader_id}")
+        if self.store.delete(reader_id) is not None:
+            logger.info("Deleted reader with ID: %s", reader_id)
         else:
-            logger.warning(f"Reader with ID {reader_id} not found for deletion")
\ No newline at end of file
+            logger.warning("Reader with ID %s not found for deletion", reader_id)
+
+    def delete_readers_bulk(self, reader_ids: List[int]) -> int:
+        """Delete several readers by ID with a single write"""
+        deleted = self.store.delete_many(reader_ids)
+        logger.info("Bulk deleted %s readers", deleted)
+        return deleted
+
+    # -------------------------
+    # Async variants for async handlers: writes run on the store writer (see app.writer)
+    # -------------------------
+    async def get_reader_async(self, reader_id: int) -> dict:
+        """Get reader by ID without blocking the event loop"""
+        return await store_writer.read(self.store, self.get_reader, reader_id)
+
+    async def add_reader_async(self, reader: Reader) -> dict:
+        """Add a new reader, returning once it is durable"""
+        return await store_writer.write(self.add_reader, reader)
+
+    async def add_readers_bulk_async(self, readers: List[Reader]) -> List[Optional[str]]:
+        """Add several readers with a single write, returning once they are durable"""
+        return await store_writer.write(self.add_readers_bulk, readers)
+
+    async def update_reader_async(self, reader_id: int, updated_reader: Reader) -> dict:
+        """Update an existing reader, returning once the change is durable"""
+        return await store_writer.write(self.update_reader, reader_id, updated_reader)
+
+    async def delete_reader_async(self, reader_id: int):
+        """Delete a reader by ID, returning once the deletion is durable"""
+        return await store_writer.write(self.delete_reader, reader_id)
+
+    async def delete_readers_bulk_async(self, reader_ids: List[int]) -> int:
+        """Delete several readers by ID with a single write, returning once it is durable"""
+        return await store_writer.write(self.delete_readers_bulk, reader_ids)
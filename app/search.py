@@ -0,0 +1,256 @@
+import heapq
+import math
+import re
+import sys
+from collections import Counter
+from itertools import chain, islice
+from typing import Any, Dict, Iterator, List, Set, Tuple, Union
+
+from app.indexes import SortedKeyList
+
+_TOKEN_RE = re.compile(r"\w+")
+STOPWORDS = frozenset({"a", "an", "and", "at", "by", "for", "in", "of", "on", "or", "the", "to", "with"})
+
+# Weight of a query token matching an index token exactly, by prefix, or fuzzily
+EXACT_WEIGHT = 1.0
+PREFIX_WEIGHT = 0.8
+FUZZY_WEIGHT = 0.7
+# Lowest trigram similarity accepted as a fuzzy match
+MIN_SIMILARITY = 0.3
+# Most index tokens a single query token may expand to by prefix or by typo
+MAX_EXPANSIONS = 10
+# Vocabulary entries scanned when ranking prefix completions
+PREFIX_SCAN = 2000
+# Upper bound on group combinations visited per query
+MAX_COMBINATIONS = 2000
+
+# A posting is a bare key while a token occurs in one record, a set of keys after that
+Posting = Union[Any, Set[Any]]
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase word tokens, dropping stopwords"""
+    return [token for token in _TOKEN_RE.findall(str(text).casefold()) if token not in STOPWORDS]
+
+
+def trigrams(token: str) -> Set[str]:
+    """Padded character trigrams of a token"""
+    padded = f"${token}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    """Inverted index over text fields with prefix and typo-tolerant lookup
+
+    Maintained incrementally through the same add/remove/rebuild hooks as
+    the other store indexes. Postings map each token to the records that
+    contain it, with single-record postings kept as a bare key. Prefix
+    lookups walk a sorted vocabulary and fuzzy lookups go through a
+    trigram index over the vocabulary, so both scale with the number of
+    distinct tokens rather than with the number of records.
+    """
+
+    def __init__(self, fields: Dict[str, float]):
+        self.fields = fields
+        self._reset()
+
+    def _reset(self):
+        self._postings: Dict[str, Dict[str, Posting]] = {field: {} for field in self.fields}
+        self._doc_freq: Dict[str, int] = {}
+        self._vocabulary = SortedKeyList()
+        self._trigrams: Dict[str, Set[str]] = {}
+        self._size = 0
+
+    # -------------------------
+    # Maintenance
+    # -------------------------
+    def _tokens(self, record: dict) -> Iterator[Tuple[str, Set[str]]]:
+        for field in self.fields:
+            yield field, set(tokenize(record.get(field, "")))
+
+    def add(self, key: Any, record: dict):
+        self._size += 1
+        for field, tokens in self._tokens(record):
+            postings = self._postings[field]
+            for token in tokens:
+                token = sys.intern(token)
+                posting = postings.get(token)
+                if posting is None:
+                    postings[token] = key
+                elif isinstance(posting, set):
+                    posting.add(key)
+                elif posting != key:
+                    postings[token] = {posting, key}
+                self._count(token, 1)
+
+    def remove(self, key: Any, record: dict):
+        self._size -= 1
+        for field, tokens in self._tokens(record):
+            postings = self._postings[field]
+            for token in tokens:
+                posting = postings.get(token)
+                if posting is None:
+                    continue
+                if isinstance(posting, set):
+                    if key not in posting:
+                        continue
+                    posting.discard(key)
+                    if len(posting) == 1:
+                        postings[token] = next(iter(posting))
+                elif posting == key:
+                    del postings[token]
+                else:
+                    continue
+                self._count(token, -1)
+
+    def rebuild(self, records: Dict[Any, dict]):
+        self._reset()
+        for key, record in records.items():
+            self.add(key, record)
+
+    def _count(self, token: str, delta: int):
+        count = self._doc_freq.get(token, 0) + delta
+        if count > 0:
+            self._doc_freq[token] = count
+            if count == delta:
+                self._vocabulary.add(token)
+                for gram in trigrams(token):
+                    self._trigrams.setdefault(gram, set()).add(token)
+            return
+
+        self._doc_freq.pop(token, None)
+        self._vocabulary.remove(token)
+        for gram in trigrams(token):
+            tokens = self._trigrams.get(gram)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._trigrams[gram]
+
+    # -------------------------
+    # Queries
+    # -------------------------
+    def complete(self, prefix: str, limit: int = 10) -> List[str]:
+        """Most frequent index tokens starting with prefix"""
+        return [token for token, _ in self.frequent(prefix, limit)]
+
+    def frequent(self, prefix: str, limit: int = 10) -> List[Tuple[str, int]]:
+        """(token, records holding it) of the most frequent index tokens starting with prefix"""
+        prefix = prefix.casefold()
+        if not prefix:
+            return []
+        tokens = islice(self._vocabulary.irange(prefix, prefix + "\uffff"), PREFIX_SCAN)
+        best = heapq.nsmallest(limit, tokens, key=lambda token: (-self._doc_freq.get(token, 0), token))
+        return [(token, self._doc_freq.get(token, 0)) for token in best]
+
+    def _expand(self, term: str, is_last: bool) -> Dict[str, float]:
+        """Index tokens a query term may stand for, with their match weight
+
+        Only the last term is completed as a prefix, as it is the one still
+        being typed, and only terms that neither occur in the vocabulary nor
+        complete to a token are treated as misspelled.
+        """
+        expansions: Dict[str, float] = {}
+        if term in self._doc_freq:
+            expansions[term] = EXACT_WEIGHT
+        if is_last:
+            for token in self.complete(term, MAX_EXPANSIONS):
+                expansions.setdefault(token, PREFIX_WEIGHT)
+        if expansions or len(term) < 3:
+            return expansions
+
+        grams = trigrams(term)
+        shared = Counter(chain.from_iterable(self._trigrams.get(gram, ()) for gram in grams))
+        scored = []
+        # Only tokens sharing the most trigrams can reach a high similarity
+        for token, common in shared.most_common(MAX_EXPANSIONS * 10):
+            # Jaccard similarity; a padded token of length n has n trigrams
+            similarity = common / (len(grams) + len(token) - common)
+            if similarity >= MIN_SIMILARITY:
+                scored.append((similarity, token))
+        for similarity, token in heapq.nlargest(MAX_EXPANSIONS, scored):
+            expansions[token] = FUZZY_WEIGHT * similarity
+        return expansions
+
+    def _groups(self, term: str, is_last: bool) -> List[Tuple[float, Set[Any]]]:
+        """(score, keys) groups of the records matching a term, best score first"""
+        total = max(self._size, 1)
+        groups = []
+        for token, weight in self._expand(term, is_last).items():
+            idf = math.log(1 + total / self._doc_freq.get(token, 1))
+            for field, field_weight in self.fields.items():
+                posting = self._postings[field].get(token)
+                if posting is not None:
+                    keys = posting if isinstance(posting, set) else {posting}
+                    groups.append((weight * field_weight * idf, keys))
+        groups.sort(key=lambda group: -group[0])
+        return groups
+
+    def search(self, query: str, limit: int = 10) -> List[Tuple[Any, float]]:
+        """Top-ranked (key, score) pairs for a free-text query
+
+        A record scores, for every query term, the weight of its best match
+        (exact, prefix or fuzzy) scaled by field weight and inverse document
+        frequency. A record's score is therefore fixed by which match group
+        it falls in for each term, so the best records are found by visiting
+        combinations of groups in descending score order and intersecting
+        their key sets. Only as many combinations as needed to fill the top
+        ``limit`` are visited, so postings of groups that cannot reach the
+        top are never touched. Each visited combination still costs time
+        linear in its smallest key set, for the intersection and for picking
+        the new keys from it, though at C speed.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        terms = [self._groups(term, i == len(terms) - 1) for i, term in enumerate(terms)]
+        terms = [groups for groups in terms if groups]
+        if not terms:
+            return []
+
+        # A choice holds one group index per term; an index past the end means "no match"
+        def score_of(choice: Tuple[int, ...]) -> float:
+            return sum(groups[i][0] for groups, i in zip(terms, choice) if i < len(groups))
+
+        start = (0,) * len(terms)
+        heap = [(-score_of(start), start)]
+        queued = {start}
+        seen: Set[Any] = set()
+        results: List[Tuple[float, Any]] = []
+        visited = 0
+        while heap and visited < MAX_COMBINATIONS:
+            negative, choice = heapq.heappop(heap)
+            score = -negative
+            if score <= 0 or (len(results) >= limit and score < results[-1][0]):
+                break
+            visited += 1
+
+            chosen = sorted((groups[i][1] for groups, i in zip(terms, choice) if i < len(groups)), key=len)
+            keys = chosen[0]
+            for other in chosen[1:]:
+                keys = keys & other
+                if not keys:
+                    break
+            if keys:
+                # Records seen before already scored higher through another combination
+                new = heapq.nsmallest(limit, keys - seen)
+                seen.update(new)
+                results.extend((score, key) for key in new)
+                results.sort(key=lambda result: (-result[0], result[1]))
+                del results[limit:]
+
+            for t, groups in enumerate(terms):
+                if choice[t] < len(groups):
+                    step = choice[:t] + (choice[t] + 1,) + choice[t + 1:]
+                    if step not in queued:
+                        queued.add(step)
+                        heapq.heappush(heap, (-score_of(step), step))
+
+        return [(key, round(score, 4)) for score, key in results]
+
+    def match(self, query: str) -> Set[Any]:
+        """Keys of every record matching any query term, for use as a store criterion"""
+        terms = list(dict.fromkeys(tokenize(query)))
+        keys: Set[Any] = set()
+        for i, term in enumerate(terms):
+            for _, group in self._groups(term, i == len(terms) - 1):
+                keys |= group
+        return keys
@@ -0,0 +1,241 @@
+import heapq
+import os
+import re
+import sys
+import uuid
+import zlib
+from contextlib import ExitStack
+from itertools import islice
+from operator import itemgetter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from app import config
+from app.store import Change, Record, RecordStore, overlapped_waits
+
+# Extensions of the files a collection's data may be in, whatever the storage mode
+DATA_EXTENSIONS = (".json", ".journal", ".snap")
+
+
+def shard_of(key: Any, shards: int) -> int:
+    """Shard holding key; a stable hash, so every process and every restart agree"""
+    return zlib.crc32(str(key).encode()) % shards
+
+
+def shard_filename(name: str, index: int, shards: int) -> str:
+    """Data file of one shard of a collection: "books.json" unsharded, "books.2-of-4.json" otherwise"""
+    return f"{name}.json" if shards == 1 else f"{name}.{index}-of-{shards}.json"
+
+
+def stored_shards(name: str) -> List[int]:
+    """Shard counts that a collection has data files for in LIBRARY_DATA_DIR"""
+    pattern = re.compile(rf"{re.escape(name)}(?:\.\d+-of-(\d+))?(?:{'|'.join(map(re.escape, DATA_EXTENSIONS))})")
+    try:
+        files = os.listdir(config.DATA_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted({int(match.group(1) or 1) for match in map(pattern.fullmatch, files) if match})
+
+
+class ShardedStore:
+    """Record store split by key hash into shards, each a RecordStore with its own lock, indexes and data file
+
+    A record lives in the shard shard_of() picks for its key. Writes to
+    different shards proceed in parallel, each shard's persistence only
+    ever writes that shard's records, and save() rewrites only the shards
+    that changed since the last save.
+
+    Reads that span shards merge the shards' results by key, so listings,
+    pages and queries come out as from a single store. Each shard's part
+    reflects one committed version of that shard, but a listing is not one
+    snapshot of all shards: a write to another shard may land mid-listing.
+
+    The store is its own persistence, as SqliteStore is: managers read
+    ``path``, stats() and pending() from it.
+    """
+
+    # Reads are served from memory, so they may run on the event loop
+    blocking_reads = False
+
+    def __init__(self, shards: List[RecordStore], path: str):
+        self.shards = shards
+        self.key = shards[0].key
+        self.path = path
+        self.persistence = self
+        # Distinguishes this store's versions from those of a previous process
+        self.generation = uuid.uuid4().hex[:8]
+        self._saved = [shard.version for shard in shards]
+
+    def _shard(self, key: Any) -> RecordStore:
+        return self.shards[shard_of(key, len(self.shards))]
+
+    @property
+    def version(self) -> int:
+        """Grows with every write to any shard, so it can validate cached listings"""
+        return sum(shard.version for shard in self.shards)
+
+    @property
+    def feed(self) -> Optional[Callable[[List[Change]], None]]:
+        return self.shards[0].feed
+
+    @feed.setter
+    def feed(self, feed: Optional[Callable[[List[Change]], None]]):
+        for shard in self.shards:
+            shard.feed = feed
+
+    @property
+    def ready(self) -> bool:
+        """Whether every shard is fully indexed"""
+        return all(shard.ready for shard in self.shards)
+
+    def build_indexes(self):
+        """Index the records of lazily loaded shard snapshots, one shard after the other"""
+        for shard in self.shards:
+            shard.build_indexes()
+
+    def ensure_indexes(self):
+        """Wait until every shard's secondary indexes cover all its records"""
+        for shard in self.shards:
+            shard.ensure_indexes()
+
+    # -------------------------
+    # Reads
+    # -------------------------
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._shard(key)
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def values(self) -> List[Record]:
+        """Get all records in key order (insertion order is only kept within a shard)"""
+        parts = [shard.page(None, sys.maxsize) for shard in self.shards]
+        return list(heapq.merge(*parts, key=itemgetter(self.key)))
+
+    def get(self, key: Any) -> Optional[Record]:
+        """Get a record by primary key"""
+        return self._shard(key).get(key)
+
+    def find(self, criteria: Dict[str, Any]) -> List[Any]:
+        """Get the keys of the records matching every criterion, in key order"""
+        return list(heapq.merge(*(shard.find(criteria) for shard in self.shards)))
+
+    def select(self, criteria: Dict[str, Any]) -> List[Record]:
+        """Get the records matching every criterion, in key order"""
+        return list(heapq.merge(*(shard.select(criteria) for shard in self.shards), key=itemgetter(self.key)))
+
+    def page(self, after: Optional[Any] = None, limit: int = 100,
+             criteria: Optional[Dict[str, Any]] = None) -> List[Record]:
+        """Get up to limit records with keys greater than after, in key order
+
+        Takes up to limit records from every shard, so a page costs
+        ``shards * limit`` records at most, however large the collection.
+        """
+        parts = [shard.page(after, limit, criteria) for shard in self.shards]
+        return list(islice(heapq.merge(*parts, key=itemgetter(self.key)), limit))
+
+    def page_by(self, name: str, bounds: Tuple[Optional[Any], Optional[Any]] = (None, None),
+                after: Optional[Tuple[Any, Any]] = None, limit: int = 100) -> List[Record]:
+        """Get up to limit records ordered by the field of RangeIndex name, then key"""
+        field = self.shards[0].indexes[name].field
+        parts = [shard.page_by(name, bounds, after, limit) for shard in self.shards]
+        return list(islice(heapq.merge(*parts, key=lambda record: (record[field], record[self.key])), limit))
+
+    # -------------------------
+    # Writes
+    # -------------------------
+    def _split(self, keys: Iterable[Any]) -> Dict[int, List[int]]:
+        """Positions of keys grouped by the shard holding them"""
+        groups: Dict[int, List[int]] = {}
+        for position, key in enumerate(keys):
+            groups.setdefault(shard_of(key, len(self.shards)), []).append(position)
+        return groups
+
+    def insert(self, record: Record) -> Record:
+        """Insert a new record, rejecting duplicate keys"""
+        return self._shard(record[self.key]).insert(record)
+
+    def insert_many(self, records: List[Record]) -> List[Optional[str]]:
+        """Insert several records with one persistence write per shard they fall in
+
+        Returns one entry per record: None if it was inserted, otherwise
+        the reason it was rejected. The shards' writes are made durable
+        together rather than one after the other.
+        """
+        results: List[Optional[str]] = [None] * len(records)
+        with overlapped_waits():
+            for index, positions in self._split(record[self.key] for record in records).items():
+                outcome = self.shards[index].insert_many([records[position] for position in positions])
+                for position, result in zip(positions, outcome):
+                    results[position] = result
+        return results
+
+    def update(self, key: Any, record: Record) -> Optional[Record]:
+        """Replace the record stored under key
+
+        A record whose new key hashes to another shard moves there. Both
+        shards are locked for the move, and it is inserted into the new
+        shard before being deleted from the old one, so a crash in between
+        can leave it in both but never lose it.
+        """
+        new_key = record[self.key]
+        source, target = shard_of(key, len(self.shards)), shard_of(new_key, len(self.shards))
+        if source == target:
+            return self.shards[source].update(key, record)
+        with overlapped_waits(), ExitStack() as held:
+            # Locked in shard order, so two opposite moves cannot deadlock
+            for index in sorted((source, target)):
+                held.enter_context(self.shards[index].exclusive())
+            if key not in self.shards[source]:
+                return None
+            if new_key in self.shards[target]:
+                raise ValueError(f"Record with ID {new_key} already exists")
+            self.shards[target].insert(record)
+            self.shards[source].delete(key)
+        return record
+
+    def delete(self, key: Any) -> Optional[Record]:
+        """Delete a record by primary key, returning it if it existed"""
+        return self._shard(key).delete(key)
+
+    def delete_many(self, keys: Iterable[Any]) -> int:
+        """Delete several records with one persistence write per shard they fall in"""
+        keys = list(keys)
+        with overlapped_waits():
+            return sum(self.shards[index].delete_many([keys[position] for position in positions])
+                       for index, positions in self._split(keys).items())
+
+    def save(self):
+        """Write a full snapshot of every shard changed since the last save"""
+        for index, shard in enumerate(self.shards):
+            version = shard.version
+            if version != self._saved[index]:
+                shard.save()
+                self._saved[index] = version
+
+    def close(self):
+        """Flush and release every shard's persistence"""
+        for shard in self.shards:
+            shard.close()
+
+    # -------------------------
+    # Persistence monitoring
+    # -------------------------
+    def pending(self) -> int:
+        """Changes queued but not yet written, over all shards"""
+        return sum(shard.persistence.pending() for shard in self.shards)
+
+    def stats(self) -> dict:
+        """Write figures summed over the shards, and each shard's own"""
+        shards = [shard.persistence.stats() for shard in self.shards]
+        totals = {name: sum(stats[name] for stats in shards)
+                  for name in ("pending_writes", "writes", "flushes", "errors", "writes_per_sec")}
+        return {
+            "mode": shards[0]["mode"],
+            "shards": len(shards),
+            **totals,
+            "avg_batch_size": round(totals["writes"] / totals["flushes"], 2) if totals["flushes"] else 0,
+            "per_shard": shards,
+        }
@@ -0,0 +1,266 @@
+import heapq
+import json
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from app.indexes import SortedKeyList
+
+Record = Dict[str, Any]
+
+MAGIC = b"LIBSNAP1"
+# Written in native byte order; a reader on a machine of the other endianness sees it reversed
+BYTE_ORDER_MARK = 0x01020304
+# magic, byte order mark, reserved, record count
+HEADER = struct.Struct("=8sIIQ")
+
+
+def write_snapshot(path: str, records: Iterable[Record], key: str = "id"):
+    """Write records to path as a binary snapshot via a temp file, fsync and rename
+
+    Layout, every part 8-byte aligned:
+
+    - header: magic, byte order mark, record count ``n``
+    - ``keys``: the n integer keys in ascending order
+    - ``slots``: for each entry of ``keys``, the slot of its record
+    - ``order``: the key of each slot, slots being in insertion order
+    - ``offsets``: n + 1 offsets delimiting each slot's data
+    - data: one compact JSON document per record, in slot order
+
+    The tables have a fixed layout, so a key is found by bisecting ``keys``
+    in the mapped file and only its record is decoded.
+    """
+    records = list(records)
+    count = len(records)
+    data_start = HEADER.size + 8 * (4 * count + 1)
+    order = array("q")
+    offsets = array("Q", [0])
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.seek(data_start)
+        end = 0
+        for record in records:
+            record_key = record[key]
+            if not isinstance(record_key, int):
+                raise ValueError(f"Snapshot keys must be integers, got {record_key!r}")
+            order.append(record_key)
+            body = json.dumps(record, separators=(",", ":")).encode()
+            f.write(body)
+            end += len(body)
+            offsets.append(end)
+
+        slots = array("q", sorted(range(count), key=order.__getitem__))
+        keys = array("q", (order[slot] for slot in slots))
+        for i in range(1, count):
+            if keys[i] == keys[i - 1]:
+                raise ValueError(f"Duplicate key {keys[i]} in snapshot")
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, BYTE_ORDER_MARK, 0, count))
+        for table in (keys, slots, order, offsets):
+            table.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Snapshot:
+    """Read-only, memory-mapped view of a snapshot written by write_snapshot
+
+    Opening only maps the file and validates the header; pages are read by
+    the OS as keys and records are touched.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, mark, _, count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a snapshot file")
+        if mark != BYTE_ORDER_MARK:
+            raise ValueError(f"{path} was written with a different byte order")
+
+        self.count = count
+        view = memoryview(self._mmap)
+        tables = []
+        start = HEADER.size
+        for length, code in ((count, "q"), (count, "q"), (count, "q"), (count + 1, "Q")):
+            tables.append(view[start:start + 8 * length].cast(code))
+            start += 8 * length
+        self.keys, self.slots, self.order, self.offsets = tables
+        self._data_start = start
+
+    def __len__(self) -> int:
+        return self.count
+
+    def slot(self, key: Any) -> Optional[int]:
+        """Slot of the record stored under key, or None"""
+        if not isinstance(key, int):
+            return None
+        i = bisect_left(self.keys, key)
+        if i < self.count and self.keys[i] == key:
+            return self.slots[i]
+        return None
+
+    def record(self, slot: int) -> Record:
+        """Decode the record in a slot"""
+        start = self._data_start + self.offsets[slot]
+        return json.loads(self._mmap[start:self._data_start + self.offsets[slot + 1]])
+
+
+class LazyRecords:
+    """Mapping of key to record over a Snapshot, decoding each record on first access
+
+    Behaves like the dict a RecordStore keeps its records in, insertion
+    order included. Changes are held in memory on top of the snapshot,
+    which is never modified: ``_written`` has every record stored since
+    loading, ``_removed`` the snapshot keys deleted (and perhaps re-added)
+    since, and ``_tail`` the keys added after the snapshot's records in
+    iteration order. Decoded snapshot records are cached in ``_cache``;
+    since they can never go stale, concurrent readers may fill it freely.
+    """
+
+    def __init__(self, snapshot: Snapshot):
+        self.snapshot = snapshot
+        self._written: Dict[Any, Record] = {}
+        self._removed: Set[Any] = set()
+        self._tail: Dict[Any, None] = {}
+        self._cache: Dict[Any, Record] = {}
+        self._len = len(snapshot)
+
+    def slot(self, key: Any) -> Optional[int]:
+        """Snapshot slot of key, whether or not the key still holds its snapshot record"""
+        return self.snapshot.slot(key)
+
+    def _in_snapshot(self, key: Any) -> bool:
+        return key not in self._removed and self.snapshot.slot(key) is not None
+
+    def _peek(self, key: Any, cache: bool = True) -> Optional[Record]:
+        record = self._written.get(key)
+        if record is not None:
+            return record
+        if key in self._removed:
+            return None
+        record = self._cache.get(key)
+        if record is None:
+            slot = self.snapshot.slot(key)
+            if slot is None:
+                return None
+            record = self.snapshot.record(slot)
+            if cache:
+                record = self._cache.setdefault(key, record)
+        return record
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._written or self._in_snapshot(key)
+
+    def __iter__(self) -> Iterator[Any]:
+        removed = self._removed
+        for key in self.snapshot.order:
+            if key not in removed:
+                yield key
+        yield from self._tail
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        record = self._peek(key)
+        return default if record is None else record
+
+    def __getitem__(self, key: Any) -> Record:
+        record = self._peek(key)
+        if record is None:
+            raise KeyError(key)
+        return record
+
+    def __setitem__(self, key: Any, record: Record):
+        if key not in self:
+            self._len += 1
+            if key in self._removed or self.snapshot.slot(key) is None:
+                self._tail[key] = None
+        self._written[key] = record
+        self._cache.pop(key, None)
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        record = self._peek(key, cache=False)
+        if record is None:
+            return default
+        if key in self._tail:
+            del self._tail[key]
+        elif self.snapshot.slot(key) is not None:
+            self._removed.add(key)
+        self._written.pop(key, None)
+        self._cache.pop(key, None)
+        self._len -= 1
+        return record
+
+    def values(self) -> Iterator[Record]:
+        """Iterate records in insertion order without caching them, so full scans stay lean"""
+        for key in self:
+            record = self._peek(key, cache=False)
+            if record is None:
+                raise KeyError(key)
+            yield record
+
+    def items(self) -> Iterator[Tuple[Any, Record]]:
+        for key in self:
+            yield key, self[key]
+
+    def snapshot_records(self, start: int, stop: int) -> List[Tuple[Any, Record]]:
+        """Current (key, record) pairs of the keys in snapshot slots start to stop, skipping deleted ones"""
+        pairs = []
+        for slot in range(start, stop):
+            key = self.snapshot.order[slot]
+            record = self._peek(key, cache=False)
+            if record is not None:
+                pairs.append((key, record))
+        return pairs
+
+
+class LazyKeyOrder:
+    """Keys of a LazyRecords mapping in ascending order, as RecordStore keeps them for keyset pages
+
+    The snapshot's keys are read from its sorted key table, skipping the
+    deleted ones, and merged with a SortedKeyList of the keys stored since
+    loading, so nothing is sorted at startup. The owner calls add() and
+    remove() after storing or popping a key in the mapping.
+    """
+
+    def __init__(self, records: LazyRecords):
+        self._records = records
+        self._added = SortedKeyList(records._tail)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __iter__(self) -> Iterator[Any]:
+        return self.irange()
+
+    def add(self, key: Any):
+        """Record a key newly stored in the mapping"""
+        self._added.add(key)
+
+    def remove(self, key: Any) -> bool:
+        """Record a key popped from the mapping; snapshot keys are skipped through its deletions"""
+        return self._added.remove(key)
+
+    def _snapshot_keys(self, start: int, stop: int) -> Iterator[Any]:
+        keys = self._records.snapshot.keys
+        removed = self._records._removed
+        for i in range(start, stop):
+            key = keys[i]
+            if key not in removed:
+                yield key
+
+    def irange(self, lo: Optional[Any] = None, hi: Optional[Any] = None, exclusive_lo: bool = False) -> Iterator[Any]:
+        """Iterate keys between lo and hi (inclusive unless exclusive_lo) in order"""
+        keys = self._records.snapshot.keys
+        start = 0 if lo is None else (bisect_right if exclusive_lo else bisect_left)(keys, lo)
+        stop = len(keys) if hi is None else bisect_right(keys, hi)
+        return heapq.merge(self._snapshot_keys(start, stop), self._added.irange(lo, hi, exclusive_lo))
@@ -0,0 +1,547 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar
+
+from app.flusher import percentiles
+from app.indexes import HashIndex, RangeIndex, UniqueViolation
+from app.timing import stage
+
+Record = Dict[str, Any]
+T = TypeVar("T")
+
+# Changes kept in the change table for other workers' in-memory indexes to catch up from
+CHANGE_RETENTION = 10000
+# Change feed shared by every table and worker of the database (see enable_feed)
+FEED_TABLE = "library_changes"
+# Seconds a writer waits for another worker's write lock before failing
+BUSY_TIMEOUT = 10.0
+# PRAGMA synchronous per durability mode; WAL with NORMAL only loses the last commits on power loss
+SYNCHRONOUS = {"sync": "FULL", "group": "NORMAL", "async": "NORMAL"}
+
+
+def _column(name: str) -> str:
+    if not name.isidentifier():
+        raise ValueError(f"Index name {name!r} cannot be used as a column name")
+    return f"idx_{name}"
+
+
+class SqliteStore:
+    """Record store kept in a SQLite table, shared by every worker process
+
+    Offers the RecordStore interface on top of a WAL-mode database, so any
+    number of uvicorn workers read and write the same data. Each thread
+    gets its own connection and every statement text is fixed, so the
+    connection's statement cache keeps them prepared.
+
+    HashIndex and RangeIndex entries become indexed columns and their
+    criteria are answered in SQL. Any other index (e.g. the search index)
+    stays in memory and follows the change table, which every write appends
+    to in the same transaction; before such an index is read it applies the
+    changes made since, by whichever worker. The change sequence doubles as
+    the store version and is shared by all workers.
+
+    Once enable_feed() is called, writes also append their changes to the
+    database-wide feed table in the same transaction, so the feed is
+    numbered in commit order across every table and worker.
+    """
+
+    # Reads query the database file, so async callers run them on a thread
+    blocking_reads = True
+
+    def __init__(self, path: str, table: str, key: str = "id", indexes: Optional[Dict[str, Any]] = None,
+                 durability: str = "sync", seed: Optional[Callable[[], List[Record]]] = None):
+        if durability not in SYNCHRONOUS:
+            raise ValueError(f"Unknown durability mode: {durability}")
+        if not table.isidentifier():
+            raise ValueError(f"Invalid table name: {table!r}")
+        self.path = path
+        self.table = table
+        self.key = key
+        self.mode = durability
+        self.indexes = indexes or {}
+        # The database is its own persistence; managers read stats() and pending() from it
+        self.persistence = self
+
+        self._columns = {
+            name: index for name, index in self.indexes.items() if isinstance(index, (HashIndex, RangeIndex))
+        }
+        self._unique = [name for name, index in self._columns.items() if isinstance(index, HashIndex) and index.unique]
+        self._followers = {name: index for name, index in self.indexes.items() if name not in self._columns}
+        self._followed: Optional[int] = None
+        self._follow_lock = threading.RLock()
+        self._feed: Optional[str] = None
+        self._feed_size = 0
+
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._writes = 0
+        self._transactions = 0
+        self._errors = 0
+        self._commit_latency: Deque[float] = deque(maxlen=10000)
+
+        self._prepare_statements()
+        self._create_schema()
+        if seed is not None:
+            self._seed(seed)
+
+    # -------------------------
+    # Schema and connections
+    # -------------------------
+    def _prepare_statements(self):
+        t, columns = self.table, [_column(name) for name in self._columns]
+        self._sql_get = f"SELECT data FROM {t} WHERE key = ?"
+        self._sql_contains = f"SELECT 1 FROM {t} WHERE key = ?"
+        self._sql_count = f"SELECT count(*) FROM {t}"
+        self._sql_values = f"SELECT data FROM {t} ORDER BY pos"
+        self._sql_insert = (
+            f"INSERT INTO {t} (key, pos, data{''.join(', ' + c for c in columns)}) "
+            f"VALUES (?, ?, ?{', ?' * len(columns)})"
+        )
+        self._sql_replace = (
+            f"UPDATE {t} SET data = ?{''.join(', ' + c + ' = ?' for c in columns)} WHERE key = ?"
+        )
+        self._sql_delete = f"DELETE FROM {t} WHERE key = ?"
+        self._sql_log = f"INSERT INTO {t}_changes (key, old, new) VALUES (?, ?, ?)"
+        self._sql_version = "SELECT seq FROM sqlite_sequence WHERE name = ?"
+        self._sql_oldest = f"SELECT min(seq) FROM {t}_changes"
+        self._sql_changes = f"SELECT old, new FROM {t}_changes WHERE seq > ? ORDER BY seq"
+        self._sql_prune = f"DELETE FROM {t}_changes WHERE seq <= ?"
+        self._sql_feed_append = f"INSERT INTO {FEED_TABLE} (collection, op, key, record) VALUES (?, ?, ?, ?)"
+        self._sql_feed_prune = f"DELETE FROM {FEED_TABLE} WHERE seq <= ?"
+        self._sql_feed_oldest = f"SELECT min(seq) FROM {FEED_TABLE}"
+        self._sql_feed_read = f"SELECT seq, collection, op, key, record FROM {FEED_TABLE} WHERE seq > ? ORDER BY seq LIMIT ?"
+
+    def _create_schema(self):
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        columns = "".join(f", {_column(name)}" for name in self._columns)
+        statements = [
+            "CREATE TABLE IF NOT EXISTS library_meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)",
+            f"CREATE TABLE IF NOT EXISTS {self.table} (key INTEGER PRIMARY KEY, pos INTEGER NOT NULL, "
+            f"data TEXT NOT NULL{columns})",
+            f"CREATE INDEX IF NOT EXISTS {self.table}_pos ON {self.table} (pos)",
+            f"CREATE TABLE IF NOT EXISTS {self.table}_changes "
+            f"(seq INTEGER PRIMARY KEY AUTOINCREMENT, key NOT NULL, old TEXT, new TEXT)",
+        ]
+        # Composite indexes keep filtered listings in key order without a sort
+        statements += [
+            f"CREATE INDEX IF NOT EXISTS {self.table}_{_column(name)} ON {self.table} ({_column(name)}, key)"
+            for name in self._columns
+        ]
+        statements += [
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {self.table}_{_column(name)}_unique ON {self.table} ({_column(name)})"
+            for name in self._unique
+        ]
+        with self._transaction() as conn:
+            for statement in statements:
+                conn.execute(statement)
+            # The first worker to create the database picks the generation all workers share
+            conn.execute("INSERT OR IGNORE INTO library_meta (name, value) VALUES ('generation', ?)",
+                         (uuid.uuid4().hex[:8],))
+            row = conn.execute("SELECT value FROM library_meta WHERE name = 'generation'").fetchone()
+            self.generation = row[0]
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode: transactions are opened explicitly below
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+            conn.execute(f"PRAGMA synchronous={SYNCHRONOUS[self.mode]}")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Write transaction; takes the database write lock up front so it cannot deadlock on upgrade"""
+        conn = self._conn()
+        started = time.perf_counter()
+        with stage("lock"):
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except sqlite3.IntegrityError as e:
+            conn.execute("ROLLBACK")
+            violated = [name for name in self._unique if f"{self.table}.{_column(name)}" in str(e)]
+            if not violated:
+                raise
+            raise UniqueViolation(f"Another record already has this {self._columns[violated[0]].field}") from e
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        try:
+            with stage("persist"):
+                conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            with self._stats_lock:
+                self._errors += 1
+            raise
+        with self._stats_lock:
+            self._transactions += 1
+            self._commit_latency.append((time.perf_counter() - started) * 1000)
+
+    @contextmanager
+    def _snapshot(self) -> Iterator[sqlite3.Connection]:
+        """Read transaction: every statement inside sees the same committed state"""
+        conn = self._conn()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        finally:
+            conn.execute("COMMIT")
+
+    def _seed(self, load: Callable[[], List[Record]]):
+        """Fill a brand-new table from the records returned by load, once across all workers"""
+        with self._transaction() as conn:
+            if conn.execute(self._sql_count).fetchone()[0] or self._version(conn):
+                return
+            records = load()
+            for pos, record in enumerate(records, 1):
+                conn.execute(self._sql_insert, self._row(record[self.key], pos, record))
+            # Later changes are numbered after the seeded rows, which keeps insertion order
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)",
+                         (f"{self.table}_changes", len(records)))
+        self._count_writes(len(records))
+
+    # -------------------------
+    # Helpers
+    # -------------------------
+    def _row(self, key: Any, pos: int, record: Record) -> tuple:
+        return (key, pos, json.dumps(record), *self._column_values(record))
+
+    def _column_values(self, record: Record) -> List[Any]:
+        values = []
+        for index in self._columns.values():
+            value = record.get(index.field)
+            if isinstance(index, HashIndex) and index.normalize is not None and value is not None:
+                value = index.normalize(value)
+            values.append(value)
+        return values
+
+    def _version(self, conn: sqlite3.Connection) -> int:
+        row = conn.execute(self._sql_version, (f"{self.table}_changes",)).fetchone()
+        return row[0] if row else 0
+
+    def _log(self, conn: sqlite3.Connection, key: Any, old: Optional[str], new: Optional[Record]) -> int:
+        """Append a change; the old and new records are only kept when in-memory indexes follow them"""
+        if self._followers:
+            cursor = conn.execute(self._sql_log, (key, old, json.dumps(new) if new is not None else None))
+        else:
+            cursor = conn.execute(self._sql_log, (key, None, None))
+        seq = cursor.lastrowid
+        conn.execute(self._sql_prune, (seq - CHANGE_RETENTION,))
+        return seq
+
+    def _publish(self, conn: sqlite3.Connection, op: str, key: Any, record: Optional[Record]):
+        """Append a change to the feed table, if the feed is enabled, in the write's transaction"""
+        if self._feed is None:
+            return
+        data = json.dumps(record) if record is not None else None
+        cursor = conn.execute(self._sql_feed_append, (self._feed, op, key, data))
+        conn.execute(self._sql_feed_prune, (cursor.lastrowid - self._feed_size,))
+
+    def _count_writes(self, count: int):
+        with self._stats_lock:
+            self._writes += count
+
+    def _follow(self, conn: sqlite3.Connection):
+        """Bring the in-memory indexes up to the snapshot conn is reading"""
+        version = self._version(conn)
+        if self._followed == version:
+            return
+        oldest = conn.execute(self._sql_oldest).fetchone()[0] or version + 1
+        if self._followed is None or oldest > self._followed + 1:
+            # Too far behind for the retained changes: rebuild from the table
+            records = {record[self.key]: record for record in self._iter_values(conn)}
+            for index in self._followers.values():
+                index.rebuild(records)
+        else:
+            for old, new in conn.execute(self._sql_changes, (self._followed,)):
+                if old is not None:
+                    old = json.loads(old)
+                    for index in self._followers.values():
+                        index.remove(old[self.key], old)
+                if new is not None:
+                    new = json.loads(new)
+                    for index in self._followers.values():
+                        index.add(new[self.key], new)
+        self._followed = version
+
+    def _iter_values(self, conn: sqlite3.Connection) -> Iterator[Record]:
+        return (json.loads(data) for data, in conn.execute(self._sql_values))
+
+    def _where(self, criteria: Dict[str, Any]) -> Tuple[List[str], List[Any]]:
+        clauses, params = [], []
+        for name, value in criteria.items():
+            index = self._columns[name]
+            column = _column(name)
+            if isinstance(index, RangeIndex):
+                low, high = value
+                if low is not None:
+                    clauses.append(f"{column} >= ?")
+                    params.append(low)
+                if high is not None:
+                    clauses.append(f"{column} <= ?")
+                    params.append(high)
+            else:
+                clauses.append(f"{column} = ?")
+                params.append(index.normalize(value) if index.normalize is not None else value)
+        return clauses, params
+
+    def _split(self, criteria: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        in_sql = {name: value for name, value in criteria.items() if name in self._columns}
+        return in_sql, {name: value for name, value in criteria.items() if name not in in_sql}
+
+    # -------------------------
+    # Reads
+    # -------------------------
+    @property
+    def version(self) -> int:
+        """Sequence number of the latest change, shared by all workers"""
+        return self._version(self._conn())
+
+    @property
+    def ready(self) -> bool:
+        """Always true: indexes live in the database or catch up when they are read"""
+        return True
+
+    def build_indexes(self):
+        """Nothing to build up front; followers catch up when they are read"""
+
+    def ensure_indexes(self):
+        """Nothing to wait for; followers catch up when they are read"""
+
+    def read(self, read: Callable[[], T]) -> T:
+        """Run a multi-step read, including in-memory index lookups, against one database snapshot"""
+        with self._follow_lock:
+            with self._snapshot() as conn:
+                self._follow(conn)
+                return read()
+
+    def __len__(self) -> int:
+        return self._conn().execute(self._sql_count).fetchone()[0]
+
+    def __contains__(self, key: Any) -> bool:
+        return self._conn().execute(self._sql_contains, (key,)).fetchone() is not None
+
+    def __iter__(self) -> Iterator[Record]:
+        return iter(self.values())
+
+    def values(self) -> List[Record]:
+        """Get all records in insertion order"""
+        return list(self._iter_values(self._conn()))
+
+    def get(self, key: Any) -> Optional[Record]:
+        """Get a record by primary key"""
+        row = self._conn().execute(self._sql_get, (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def find(self, criteria: Dict[str, Any]) -> List[Any]:
+        """Get the keys of the records matching every criterion, in key order"""
+        in_sql, in_memory = self._split(criteria)
+        clauses, params = self._where(in_sql)
+        sql = f"SELECT key FROM {self.table}{' WHERE ' + ' AND '.join(clauses) if clauses else ''} ORDER BY key"
+        if not in_memory:
+            return [key for key, in self._conn().execute(sql, params)]
+
+        def read() -> List[Any]:
+            matches: List[Set[Any]] = [self._followers[name].match(value) for name, value in in_memory.items()]
+            keys = set.intersection(*matches)
+            return [key for key, in self._conn().execute(sql, params) if key in keys]
+
+        return self.read(read)
+
+    def select(self, criteria: Dict[str, Any]) -> List[Record]:
+        """Get the records matching every criterion, in key order"""
+        return self.page(None, -1, criteria)
+
+    def page(self, after: Optional[Any] = None, limit: int = 100,
+             criteria: Optional[Dict[str, Any]] = None) -> List[Record]:
+        """Get up to limit records with keys greater than after, in key order (all of them for -1)"""
+        in_sql, in_memory = self._split(criteria or {})
+        if in_memory:
+            def read() -> List[Record]:
+                keys = [key for key in self.find(criteria) if after is None or key > after]
+                records = (self.get(key) for key in (keys if limit < 0 else keys[:limit]))
+                return [record for record in records if record is not None]
+
+            return self.read(read)
+
+        clauses, params = self._where(in_sql)
+        if after is not None:
+            clauses.append("key > ?")
+            params.append(after)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        params.append(limit)
+        sql = f"SELECT data FROM {self.table}{where} ORDER BY key LIMIT ?"
+        return [json.loads(data) for data, in self._conn().execute(sql, params)]
+
+    def page_by(self, name: str, bounds: Tuple[Optional[Any], Optional[Any]] = (None, None),
+                after: Optional[Tuple[Any, Any]] = None, limit: int = 100) -> List[Record]:
+        """Get up to limit records ordered by the column of RangeIndex name, then key"""
+        column = _column(name)
+        clauses, params = self._where({name: bounds})
+        if after is not None:
+            clauses.append(f"({column}, key) > (?, ?)")
+            params.extend(after)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        params.append(limit)
+        sql = f"SELECT data FROM {self.table}{where} ORDER BY {column}, key LIMIT ?"
+        return [json.loads(data) for data, in self._conn().execute(sql, params)]
+
+    # -------------------------
+    # Writes
+    # -------------------------
+    def insert(self, record: Record) -> Record:
+        """Insert a new record, rejecting duplicate keys"""
+        key = record[self.key]
+        with self._transaction() as conn:
+            if conn.execute(self._sql_contains, (key,)).fetchone() is not None:
+                raise ValueError(f"Record with ID {key} already exists")
+            seq = self._log(conn, key, None, record)
+            conn.execute(self._sql_insert, self._row(key, seq, record))
+            self._publish(conn, "insert", key, record)
+        self._count_writes(1)
+        return record
+
+    def insert_many(self, records: List[Record]) -> List[Optional[str]]:
+        """Insert several records in a single transaction, returning a per-record error or None"""
+        results: List[Optional[str]] = []
+        with self._transaction() as conn:
+            for record in records:
+                key = record[self.key]
+                if conn.execute(self._sql_contains, (key,)).fetchone() is not None:
+                    results.append(f"Record with ID {key} already exists")
+                    continue
+                seq = self._log(conn, key, None, record)
+                conn.execute(self._sql_insert, self._row(key, seq, record))
+                self._publish(conn, "insert", key, record)
+                results.append(None)
+        self._count_writes(results.count(None))
+        return results
+
+    def update(self, key: Any, record: Record) -> Optional[Record]:
+        """Replace the record stored under key
+
+        The record keeps its position unless its key changes, in which case
+        it is moved to the end under the new key.
+        """
+        new_key = record[self.key]
+        with self._transaction() as conn:
+            row = conn.execute(self._sql_get, (key,)).fetchone()
+            if row is None:
+                return None
+            if new_key != key and conn.execute(self._sql_contains, (new_key,)).fetchone() is not None:
+                raise ValueError(f"Record with ID {new_key} already exists")
+
+            seq = self._log(conn, key, row[0], record)
+            if new_key == key:
+                conn.execute(self._sql_replace, (json.dumps(record), *self._column_values(record), key))
+                self._publish(conn, "update", key, record)
+            else:
+                conn.execute(self._sql_delete, (key,))
+                conn.execute(self._sql_insert, self._row(new_key, seq, record))
+                self._publish(conn, "delete", key, None)
+                self._publish(conn, "insert", new_key, record)
+        self._count_writes(1)
+        return record
+
+    def delete(self, key: Any) -> Optional[Record]:
+        """Delete a record by primary key, returning it if it existed"""
+        with self._transaction() as conn:
+            row = conn.execute(self._sql_get, (key,)).fetchone()
+            if row is None:
+                return None
+            self._log(conn, key, row[0], None)
+            conn.execute(self._sql_delete, (key,))
+            self._publish(conn, "delete", key, None)
+        self._count_writes(1)
+        return json.loads(row[0])
+
+    def delete_many(self, keys: Iterable[Any]) -> int:
+        """Delete several records in a single transaction"""
+        deleted = 0
+        with self._transaction() as conn:
+            for key in keys:
+                row = conn.execute(self._sql_get, (key,)).fetchone()
+                if row is not None:
+                    self._log(conn, key, row[0], None)
+                    conn.execute(self._sql_delete, (key,))
+                    self._publish(conn, "delete", key, None)
+                    deleted += 1
+        self._count_writes(deleted)
+        return deleted
+
+    def save(self):
+        """Checkpoint the write-ahead log into the database file"""
+        self._conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        """Close every connection opened by this store"""
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    # -------------------------
+    # Change feed
+    # -------------------------
+    def enable_feed(self, collection: str, size: int):
+        """Publish this table's changes to the shared feed table as collection, keeping the last size changes"""
+        with self._transaction() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {FEED_TABLE} (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         f"collection TEXT NOT NULL, op TEXT NOT NULL, key NOT NULL, record TEXT)")
+        self._feed = collection
+        self._feed_size = size
+
+    def read_feed(self, seq: int, limit: int) -> Tuple[int, int, List[Tuple[int, str, str, Any, Optional[Record]]]]:
+        """Read the feed after seq from one snapshot
+
+        Returns the sequence numbers of the oldest retained and the latest
+        change, and up to limit (seq, collection, op, key, record) changes.
+        """
+        with self._snapshot() as conn:
+            row = conn.execute(self._sql_version, (FEED_TABLE,)).fetchone()
+            latest = row[0] if row else 0
+            oldest = conn.execute(self._sql_feed_oldest).fetchone()[0]
+            rows = conn.execute(self._sql_feed_read, (seq, limit)).fetchall()
+        changes = [(seq, collection, op, key, json.loads(record) if record is not None else None)
+                   for seq, collection, op, key, record in rows]
+        return (oldest if oldest is not None else latest + 1), latest, changes
+
+    # -------------------------
+    # Monitoring
+    # -------------------------
+    def pending(self) -> int:
+        """Changes are committed by the request itself, so nothing is ever queued"""
+        return 0
+
+    def stats(self) -> dict:
+        """Write figures of this worker process"""
+        with self._stats_lock:
+            elapsed = time.perf_counter() - self._started
+            return {
+                "mode": f"sqlite/{self.mode}",
+                "pending_writes": 0,
+                "writes": self._writes,
+                "transactions": self._transactions,
+                "errors": self._errors,
+                "avg_batch_size": round(self._writes / self._transactions, 2) if self._transactions else 0,
+                "writes_per_sec": round(self._writes / elapsed, 2) if elapsed else 0,
+                "commit_latency_ms": percentiles(self._commit_latency),
+            }
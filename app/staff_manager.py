@@ -1,22 +1,54 @@
 import json
 import logging
-from typing import List
+from typing import Iterator, List, Optional
+from app import config
+from app.changes import change_log
+from app.indexes import HashIndex
 from app.models import Staff
+from app.pagination import DEFAULT_PAGE_SIZE, paginate, stream_records
+from app.persistence import open_store
+from app.store import RecordStore
+from app.writer import store_writer
 
 logger = logging.getLogger("api")
 
 class StaffManager:
     def __init__(self):
-        self.data_file = "app/data/staff.json"
-        self.staff = self._load_staff()
+        # Opened by open() when the application starts, not at import time
+        self.store: Optional[RecordStore[int]] = None
+        self.persistence = None
+        self.data_file = None
 
-    def _load_staff(self) -> List[dict]:
-        """Load staff from JSON file"""
+    def open(self):
+        """Load the staff store; a snapshot-backed store finishes indexing in build_indexes()"""
+        self.store = open_store(
+            "staff",
+            self._load_staff,
+            indexes={"position": HashIndex("position", normalize=str.casefold)},
+            model=Staff,
+            interned=("position",),
+            shards=config.SHARDS,
+        )
+        change_log.attach("staff", self.store)
+        self.persistence = self.store.persistence
+        self.data_file = self.persistence.path
+
+    @property
+    def ready(self) -> bool:
+        """Whether the staff store is open and fully indexed"""
+        return self.store is not None and self.store.ready
+
+    @property
+    def staff(self) -> List[dict]:
+        """All staff in insertion order"""
+        return self.store.values()
+
+    def _load_staff(self, persistence) -> List[dict]:
+        """Load staff from the data file"""
         try:
-            with open(self.data_file, "r") as f:
-                staff_data = json.load(f)
-                logger.info(f"Loaded {len(staff_data)} staff members from file")
-                return staff_data
+            staff_data = persistence.load()
+            logger.info("Loaded %s staff members from file", len(staff_data))
+            return staff_data
         except FileNotFoundError:
             logger.warning("Staff data file not found, starting with empty list")
             return []
@@ -25,26 +57,47 @@ class StaffManager:
             return []
 
     def save_data(self):
-        """Save staff to JSON file"""
+        """Write a full staff snapshot to the data file"""
         try:
-            with open(self.data_file, "w") as f:
-                json.dump(self.staff, f, indent=4)
+            self.store.save()
             logger.debug("Staff data saved successfully")
         except Exception as e:
-            logger.error(f"Error saving staff data: {e}")
+            logger.error("Error saving staff data: %s", e)
             raise
 
-    def get_all_staff(self) -> List[dict]:
-        """Get all staff"""
-        return self.staff
+    def close(self):
+        """Flush pending writes and release the data file"""
+        if self.store is not None:
+            self.store.close()
+
+    @staticmethod
+    def _criteria(position: Optional[str]) -> dict:
+        """Translate filter arguments into store index criteria"""
+        return {"position": position} if position is not None else {}
+
+    def get_all_staff(self, position: Optional[str] = None) -> List[dict]:
+        """Get all staff, optionally filtered by position"""
+        criteria = self._criteria(position)
+        return self.store.select(criteria) if criteria else self.store.values()
+
+    def get_staff_page(self, after: Optional[int] = None, limit: int = DEFAULT_PAGE_SIZE,
+                       position: Optional[str] = None) -> dict:
+        """Get one page of staff ordered by ID, starting after the given ID"""
+        return paginate(self.store, after, limit, self._criteria(position))
+
+    def stream_staff(self, fmt: str = "json", after: Optional[int] = None,
+                     position: Optional[str] = None) -> Iterator[bytes]:
+        """Encode all matching staff ordered by ID as JSON, NDJSON or CSV chunks"""
+        return stream_records(self.store, fmt, after, self._criteria(position),
+                              columns=list(Staff.model_fields))
 
     def get_staff(self, staff_id: int) -> dict:
         """Get staff by ID"""
-        staff = next((s for s in self.staff if s["id"] == staff_id), None)
+        staff = self.store.get(staff_id)
         if staff:
-            logger.debug(f"Retrieved staff with ID: {staff_id}")
+            logger.debug("Retrieved staff with ID: %s", staff_id)
         else:
-            logger.debug(f"Staff with ID {staff_id} not found")
+            logger.debug("Staff with ID %s not found", staff_id)
         return staff
 
     def add_staff(self, staff: Staff) -> dict:
@@ -52,34 +105,66 @@ class StaffManager:
         staff_dict = staff.model_dump()
         
         # Check if staff with same ID already exists
-        if any(s["id"] == staff_dict["id"] for s in self.staff):
-            logger.warning(f"Staff with ID {staff_dict['id']} already exists")
+        if staff_dict["id"] in self.store:
+            logger.warning("Staff with ID %s already exists", staff_dict['id'])
             raise ValueError(f"Staff with ID {staff_dict['id']} already exists")
         
-        self.staff.append(staff_dict)
-        self.save_data()
-        logger.info(f"Added new staff: {staff_dict}")
+        self.store.insert(staff_dict)
+        logger.debug("Added new staff: %s", staff_dict)
         return staff_dict
 
+    def add_staff_bulk(self, staff: List[Staff]) -> List[Optional[str]]:
+        """Add several staff members with a single write, returning a per-row error or None"""
+        results = self.store.insert_many([item.model_dump() for item in staff])
+        logger.info("Bulk added %s of %s staff members", results.count(None), len(results))
+        return results
+
     def update_staff(self, staff_id: int, updated_staff: Staff) -> dict:
         """Update an existing staff member"""
-        for i, staff in enumerate(self.staff):
-            if staff["id"] == staff_id:
-                self.staff[i] = updated_staff.model_dump()
-                self.save_data()
-                logger.info(f"Updated staff with ID: {staff_id}")
-                return self.staff[i]
+        staff_dict = self.store.update(staff_id, updated_staff.model_dump())
+        if staff_dict is not None:
+            logger.info("Updated staff with ID: %s", staff_id)
+            return staff_dict
         
-        logger.warning(f"Staff with ID {staff_id} not found for update")
+        logger.warning("Staff with ID %s not found for update", staff_id)
         return None
 
     def delete_staff(self, staff_id: int):
         """Delete a staff member by ID"""
-        initial_count = len(self.staff)
-        self.staff = [staff for staff in self.staff if staff["id"] != staff_id]
-        
-        if len(self.staff) < initial_count:
-            self.save_data()
-            logger.info(f"Deleted staff with ID: {staff_id}")
+        if self.store.delete(staff_id) is not None:
+            logger.info("Deleted staff with ID: %s", staff_id)
         else:
-            logger.warning(f"Staff with ID {staff_id} not found for deletion")
\ No newline at end of file
+            logger.warning("Staff with ID %s not found for deletion", staff_id)
+
+    def delete_staff_bulk(self, staff_ids: List[int]) -> int:
+        """Delete several staff members by ID with a single write"""
+        deleted = self.store.delete_many(staff_ids)
+        logger.info("Bulk deleted %s staff members", deleted)
+        return deleted
+
+    # -------------------------
+    # Async variants for async handlers: writes run on the store writer (see app.writer)
+    # -------------------------
+    async def get_staff_async(self, staff_id: int) -> dict:
+        """Get staff member by ID without blocking the event loop"""
+        return await store_writer.read(self.store, self.get_staff, staff_id)
+
+    async def add_staff_async(self, staff: Staff) -> dict:
+        """Add a new staff member, returning once it is durable"""
+        return await store_writer.write(self.add_staff, staff)
+
+    async def add_staff_bulk_async(self, staff: List[Staff]) -> List[Optional[str]]:
+        """Add several staff members with a single write, returning once they are durable"""
+        return await store_writer.write(self.add_staff_bulk, staff)
+
+    async def update_staff_async(self, staff_id: int, updated_staff: Staff) -> dict:
+        """Update an existing staff member, returning once the change is durable"""
+        return await store_writer.write(self.update_staff, staff_id, updated_staff)
+
+    async def delete_staff_async(self, staff_id: int):
+        """Delete a staff member by ID, returning once the deletion is durable"""
+        return await store_writer.write(self.delete_staff, staff_id)
+
+    async def delete_staff_bulk_async(self, staff_ids: List[int]) -> int:
+        """Delete several staff members by ID with a single write, returning once it is durable"""
+        return await store_writer.write(self.delete_staff_bulk, staff_ids)
@@ -0,0 +1,482 @@
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import islice
+from typing import Any, Callable, Dict, Generic, Hashable, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+from app.indexes import SortedKeyList
+from app.snapshot import LazyKeyOrder, LazyRecords
+from app.timing import stage
+
+Record = Dict[str, Any]
+K = TypeVar("K", bound=Hashable)
+T = TypeVar("T")
+# One committed change as published to a change feed: ("insert" | "update" | "delete", key, record or None)
+Change = Tuple[str, Any, Optional[Record]]
+
+# Optimistic attempts before a read falls back to the write lock
+READ_RETRIES = 8
+# Snapshot records indexed per hold of the write lock by build_indexes()
+INDEX_BATCH = 5000
+
+# Durability waits collected by deferred_waits() in the current context instead of blocked on
+_deferred: ContextVar[Optional[List[Tuple[Any, int]]]] = ContextVar("deferred_waits", default=None)
+
+
+@contextmanager
+def deferred_waits() -> Iterator[List[Tuple[Any, int]]]:
+    """Collect the (persistence, ticket) durability waits of writes inside the block instead of blocking
+
+    The caller must wait on every ticket (see FlushingPersistence.wait_async)
+    before reporting the writes as done.
+    """
+    waits: List[Tuple[Any, int]] = []
+    token = _deferred.set(waits)
+    try:
+        yield waits
+    finally:
+        _deferred.reset(token)
+
+
+class WouldBlock(Exception):
+    """A read inside nonblocking() needed the write lock or an index build"""
+
+
+# Set by nonblocking() where reads must not wait, such as on the event loop
+_nonblocking: ContextVar[bool] = ContextVar("nonblocking", default=False)
+
+
+@contextmanager
+def nonblocking() -> Iterator[None]:
+    """Make reads inside the block raise WouldBlock instead of waiting for writers or index builds
+
+    The caller is expected to run the read again where it may block.
+    """
+    token = _nonblocking.set(True)
+    try:
+        yield
+    finally:
+        _nonblocking.reset(token)
+
+
+@contextmanager
+def overlapped_waits() -> Iterator[None]:
+    """Wait for the durability of the writes inside the block once, at its end
+
+    Writes to several stores (or shards) in the block then become durable
+    together instead of one after the other. Inside deferred_waits() the
+    waits are left to its caller as usual.
+    """
+    if _deferred.get() is not None:
+        yield
+        return
+    with deferred_waits() as waits:
+        yield
+    for persistence, ticket in waits:
+        with stage("persist"):
+            persistence.wait(ticket)
+
+
+class RecordStore(Generic[K]):
+    """In-memory record store with an id-keyed primary index
+
+    Records live in a dict keyed by their primary key, so get, insert,
+    update and delete are O(1) while iteration keeps insertion order. A
+    sorted key list alongside it serves keyset pagination in key order,
+    and optional secondary indexes (see app.indexes) answer field queries.
+    Every mutation is forwarded to the optional persistence.
+
+    Concurrency: writers are serialized by a lock and bump ``version`` once
+    when they start and once when they finish, so an odd version means a
+    write is in flight. Records are never modified in place, only replaced.
+    Reads take no lock: single-key reads are atomic, and reads spanning
+    several structures (listings, index queries) check that the version did
+    not move while they ran and otherwise repeat, so every read reflects one
+    committed version of the store. A read that keeps colliding with writes
+    falls back to the lock after READ_RETRIES attempts. Persistence changes
+    are submitted under the lock, in commit order, but waited on after it is
+    released, so concurrent writers still share group commits.
+
+    ``feed``, when set, receives every write's changes (see Change) under
+    the write lock, so in commit order; app.changes sets it.
+
+    ``layout`` may name a factory for a more compact record mapping (see
+    app.layouts); records then go in and come out as dicts as before.
+    Records may also be a LazyRecords mapping over a binary snapshot. The
+    store then serves keys and records straight from the mapped file and
+    its secondary indexes start empty: build_indexes() fills them in the
+    background, and queries that need an index wait for it.
+    """
+
+    # Reads are served from memory, so they may run on the event loop
+    blocking_reads = False
+
+    def __init__(self, records: Iterable[Record] = (), key: str = "id", persistence=None,
+                 indexes: Optional[Dict[str, Any]] = None, layout: Optional[Callable[[], Any]] = None):
+        self.key = key
+        self.indexes = indexes or {}
+        self.layout = layout
+        self._records: Dict[K, Record] = {}
+        self._lock = threading.RLock()
+        self._writer: Optional[int] = None
+        self._build_lock = threading.Lock()
+        self.version = 0
+        # Distinguishes this store's versions from those of a previous process
+        self.generation = uuid.uuid4().hex[:8]
+        self.load(records)
+        self.persistence = persistence
+        if persistence is not None:
+            persistence.bind(self.values)
+        self.feed: Optional[Callable[[List[Change]], None]] = None
+
+    def load(self, records: Iterable[Record]):
+        """Replace the store contents with the given records
+
+        A LazyRecords mapping is adopted as is, leaving its records to be
+        indexed by build_indexes() and its keys in the snapshot's order.
+        """
+        with self._writing():
+            # Snapshot slots below the cursor are indexed; None once every record is
+            self._index_cursor: Optional[int] = None
+            if isinstance(records, LazyRecords):
+                self._records = records
+                # Served from the snapshot's sorted key table rather than sorted here
+                self._order = LazyKeyOrder(records)
+                if self.indexes:
+                    self._index_cursor = 0
+                    for index in self.indexes.values():
+                        index.rebuild({})
+            else:
+                if self.layout is not None:
+                    self._records = self.layout()
+                    for record in records:
+                        self._records[record[self.key]] = record
+                else:
+                    self._records = {record[self.key]: record for record in records}
+                self._order = SortedKeyList(self._records)
+                for index in self.indexes.values():
+                    index.rebuild(self._records)
+
+    @property
+    def ready(self) -> bool:
+        """Whether every record is indexed, so index queries answer without waiting"""
+        return self._index_cursor is None
+
+    def build_indexes(self, batch: int = INDEX_BATCH):
+        """Index the records of a lazily loaded snapshot
+
+        Works through the snapshot a batch at a time, holding off writers
+        for one batch only. Meanwhile writes maintain the indexes for keys
+        already covered and leave the others to this walk, which indexes
+        whatever record a key holds when it gets there.
+        """
+        with self._build_lock:
+            while self._index_cursor is not None:
+                with self._lock:
+                    start = self._index_cursor
+                    stop = min(start + batch, len(self._records.snapshot))
+                    for key, record in self._records.snapshot_records(start, stop):
+                        for index in self.indexes.values():
+                            index.add(key, record)
+                    self._index_cursor = stop if stop < len(self._records.snapshot) else None
+
+    def ensure_indexes(self):
+        """Wait until the secondary indexes cover every record, building them if nobody is"""
+        if self._index_cursor is not None:
+            if _nonblocking.get():
+                raise WouldBlock("Secondary indexes are still being built")
+            self.build_indexes()
+
+    def _indexed(self, key: K) -> bool:
+        """Whether index maintenance applies to key yet; called under the write lock"""
+        if self._index_cursor is None:
+            return True
+        slot = self._records.slot(key)
+        return slot is None or slot < self._index_cursor
+
+    # -------------------------
+    # Concurrency control
+    # -------------------------
+    @contextmanager
+    def _writing(self):
+        # Waiting for other writers is reported on its own when the request is timed
+        with stage("lock"):
+            self._lock.acquire()
+        try:
+            self.version += 1
+            self._writer = threading.get_ident()
+            try:
+                yield
+            finally:
+                self._writer = None
+                self.version += 1
+        finally:
+            self._lock.release()
+
+    @contextmanager
+    def exclusive(self):
+        """Hold off other writers for the duration of the block; the holder's own writes go through"""
+        with self._lock:
+            yield
+
+    def read(self, read: Callable[[], T]) -> T:
+        """Run a multi-step read against a single committed version, without locking
+
+        Inside nonblocking(), a read that keeps colliding with writes raises
+        WouldBlock rather than falling back to the write lock.
+        """
+        if self._writer == threading.get_ident():
+            # Reads made by the writer itself (e.g. a snapshot during a write) see its changes
+            return read()
+        for _ in range(READ_RETRIES):
+            version = self.version
+            if version % 2 == 0:
+                try:
+                    result = read()
+                except Exception:
+                    # A failure caused by a concurrent write is retried; any other is real
+                    if self.version == version:
+                        raise
+                else:
+                    if self.version == version:
+                        return result
+            # Let the writer finish before trying again
+            time.sleep(0)
+        if _nonblocking.get():
+            raise WouldBlock("Read kept colliding with writes")
+        with self._lock:
+            return read()
+
+    def _submit(self, entries: List[Tuple[str, Any]]) -> int:
+        """Queue changes with the persistence; called under the write lock to keep commit order"""
+        if self.persistence is None or not entries:
+            return 0
+        with stage("persist"):
+            return self.persistence.submit(entries)
+
+    def _publish(self, changes: List[Change]):
+        """Hand committed changes to the feed; called under the write lock to keep commit order"""
+        if self.feed is not None and changes:
+            self.feed(changes)
+
+    def _wait(self, ticket: int):
+        """Wait for submitted changes to become durable; called after releasing the write lock"""
+        if not ticket:
+            return
+        waits = _deferred.get()
+        if waits is not None:
+            waits.append((self.persistence, ticket))
+            return
+        with stage("persist"):
+            self.persistence.wait(ticket)
+
+    def _link(self, key: K, record: Record):
+        self._records[key] = record
+        self._order.add(key)
+        if self._indexed(key):
+            for index in self.indexes.values():
+                index.add(key, record)
+
+    def _unlink(self, key: K) -> Optional[Record]:
+        record = self._records.pop(key, None)
+        if record is not None:
+            self._order.remove(key)
+            if self._indexed(key):
+                for index in self.indexes.values():
+                    index.remove(key, record)
+        return record
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._records
+
+    def __iter__(self) -> Iterator[Record]:
+        return iter(self.values())
+
+    def values(self) -> List[Record]:
+        """Get all records in insertion order"""
+        return self.read(lambda: list(self._records.values()))
+
+    def get(self, key: K) -> Optional[Record]:
+        """Get a record by primary key"""
+        return self._records.get(key)
+
+    def find(self, criteria: Dict[str, Any]) -> List[K]:
+        """Get the keys of the records matching every criterion, in key order
+
+        Each criterion is answered by the index registered under its name: a
+        value for a HashIndex, a (low, high) tuple for a RangeIndex. See
+        _matching() for how the candidates are chosen.
+        """
+        self.ensure_indexes()
+        return self.read(lambda: list(self._matching(criteria)))
+
+    def _matching(self, criteria: Dict[str, Any], after: Optional[K] = None,
+                  limit: Optional[int] = None) -> Iterator[K]:
+        """Keys greater than after of the records matching every criterion, in key order
+
+        Candidates are walked from one source, and checked against the other
+        criteria on their record: a HashIndex bucket or the primary key
+        order, both kept in key order and read lazily, or the keys a
+        RangeIndex holds in range, collected and sorted. The source chosen
+        is the one expected to be cheapest to read up to ``limit`` matches,
+        taking matches to be spread evenly over it. A page thus costs in
+        proportion to its size; a RangeIndex, which is read whole, is only
+        chosen when it holds fewer keys than the others would read.
+        """
+        sizes = {name: self.indexes[name].count(value) for name, value in criteria.items()}
+        if not sizes:
+            return self._order.irange(after, exclusive_lo=True)
+        matches = min(sizes.values())
+        if not matches:
+            return iter(())
+
+        def cost(size: int) -> float:
+            return size if limit is None else min(size, limit * size / matches)
+
+        source, best = None, cost(len(self._order))
+        for name, size in sizes.items():
+            estimate = cost(size) if self.indexes[name].key_ordered else size
+            if estimate < best:
+                source, best = name, estimate
+        if source is None:
+            keys = self._order.irange(after, exclusive_lo=True)
+        else:
+            keys = self.indexes[source].keys(criteria[source], after)
+        checks = [(self.indexes[name], value) for name, value in criteria.items() if name != source]
+        if not checks:
+            return keys
+        return (key for key in keys
+                if all(index.accepts(self._records[key], value) for index, value in checks))
+
+    def select(self, criteria: Dict[str, Any]) -> List[Record]:
+        """Get the records matching every criterion, in key order"""
+        self.ensure_indexes()
+        return self.read(lambda: self._fetch(self._matching(criteria)))
+
+    def _fetch(self, keys: Iterable[K]) -> List[Record]:
+        records = (self._records.get(key) for key in keys)
+        return [record for record in records if record is not None]
+
+    def page(self, after: Optional[K] = None, limit: int = 100,
+             criteria: Optional[Dict[str, Any]] = None) -> List[Record]:
+        """Get up to limit records with keys greater than after, in key order
+
+        Filtered pages stop reading candidates once limit records match, so
+        walking every page of a listing costs about as much as one full
+        query.
+        """
+        if criteria:
+            self.ensure_indexes()
+        return self.read(lambda: self._fetch(islice(self._matching(criteria or {}, after, limit), limit)))
+
+    def page_by(self, name: str, bounds: Tuple[Optional[Any], Optional[Any]] = (None, None),
+                after: Optional[Tuple[Any, K]] = None, limit: int = 100) -> List[Record]:
+        """Get up to limit records ordered by the field of RangeIndex name, then key
+
+        Only records within the inclusive (low, high) bounds are returned,
+        starting after the (value, key) position ``after``. The cost follows
+        the page size, not the number of records in range.
+        """
+        self.ensure_indexes()
+        index = self.indexes[name]
+        return self.read(lambda: self._fetch(islice(index.walk(bounds, after), limit)))
+
+    def insert(self, record: Record) -> Record:
+        """Insert a new record, rejecting duplicate keys"""
+        key = record[self.key]
+        with self._writing():
+            if key in self._records:
+                raise ValueError(f"Record with ID {key} already exists")
+            self._link(key, record)
+            ticket = self._submit([("put", record)])
+            self._publish([("insert", key, record)])
+        self._wait(ticket)
+        return record
+
+    def insert_many(self, records: List[Record]) -> List[Optional[str]]:
+        """Insert several records and persist them with a single write
+
+        Returns one entry per record: None if it was inserted, otherwise
+        the reason it was rejected.
+        """
+        results: List[Optional[str]] = []
+        inserted: List[Record] = []
+        with self._writing():
+            for record in records:
+                key = record[self.key]
+                if key in self._records:
+                    results.append(f"Record with ID {key} already exists")
+                    continue
+                self._link(key, record)
+                inserted.append(record)
+                results.append(None)
+            ticket = self._submit([("put", record) for record in inserted])
+            self._publish([("insert", record[self.key], record) for record in inserted])
+        self._wait(ticket)
+        return results
+
+    def update(self, key: K, record: Record) -> Optional[Record]:
+        """Replace the record stored under key
+
+        The record keeps its position unless its key changes, in which case
+        it is moved to the end under the new key.
+        """
+        new_key = record[self.key]
+        with self._writing():
+            if key not in self._records:
+                return None
+            if new_key != key and new_key in self._records:
+                raise ValueError(f"Record with ID {new_key} already exists")
+
+            if new_key == key:
+                # Replace in place so the record keeps its insertion position
+                old = self._records[key]
+                if self._indexed(key):
+                    for index in self.indexes.values():
+                        index.remove(key, old)
+                        index.add(key, record)
+                self._records[key] = record
+                ticket = self._submit([("put", record)])
+                self._publish([("update", key, record)])
+            else:
+                self._unlink(key)
+                self._link(new_key, record)
+                ticket = self._submit([("del", key), ("put", record)])
+                self._publish([("delete", key, None), ("insert", new_key, record)])
+        self._wait(ticket)
+        return record
+
+    def delete(self, key: K) -> Optional[Record]:
+        """Delete a record by primary key, returning it if it existed"""
+        with self._writing():
+            record = self._unlink(key)
+            ticket = self._submit([("del", key)] if record is not None else [])
+            self._publish([("delete", key, None)] if record is not None else [])
+        self._wait(ticket)
+        return record
+
+    def delete_many(self, keys: Iterable[K]) -> int:
+        """Delete several records with a single persistence write"""
+        with self._writing():
+            deleted = [key for key in keys if self._unlink(key) is not None]
+            ticket = self._submit([("del", key) for key in deleted])
+            self._publish([("delete", key, None) for key in deleted])
+        self._wait(ticket)
+        return len(deleted)
+
+    def save(self):
+        """Write a full snapshot through the persistence"""
+        if self.persistence is not None:
+            # Writers are held off so the snapshot matches one version exactly
+            with self._lock:
+                self.persistence.compact()
+
+    def close(self):
+        """Flush and release the persistence"""
+        if self.persistence is not None:
+            self.persistence.close()
@@ -0,0 +1,248 @@
+import asyncio
+import cProfile
+import functools
+import hmac
+import itertools
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional
+
+from fastapi.routing import APIRoute
+
+from app import config
+
+# Privileged request headers: the token enables timing for the request, the profile header also captures a profile
+DEBUG_TOKEN_HEADER = "x-debug-token"
+DEBUG_PROFILE_HEADER = "x-debug-profile"
+# Response header naming the file a requested profile was saved to
+PROFILE_FILE_HEADER = "X-Profile-File"
+
+# "cprofile" traces every call, "sample" records the stack of the request's threads periodically
+PROFILE_MODES = ("cprofile", "sample")
+
+# Timer of the request being handled; None unless timing was asked for, so stages cost one lookup otherwise
+_current: ContextVar[Optional["StageTimer"]] = ContextVar("stage_timer", default=None)
+_NOT_TIMED = nullcontext()
+_profile_counter = itertools.count(1)
+
+
+class _Stage:
+    __slots__ = ("timer", "name", "started", "nested")
+
+    def __init__(self, timer: "StageTimer", name: str):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.nested = 0.0
+        self.timer._stack.append(self)
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        now = time.perf_counter()
+        elapsed = now - self.started
+        timer = self.timer
+        timer._stack.pop()
+        timer._add(self.name, elapsed - self.nested)
+        if timer._stack:
+            timer._stack[-1].nested += elapsed
+        else:
+            timer._last = now
+
+
+class StageTimer:
+    """Milliseconds one request spent per stage, for its Server-Timing header
+
+    Stages are exclusive: time spent in a stage nested inside another (a
+    disk write inside the handler) only counts for the inner one. Gaps
+    between top-level stages can be attributed to a name as well (see
+    ``gap``), so the stages add up to nearly the whole request.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.profile: Optional[RequestProfile] = None
+        self.token = None
+        self._body_read = False
+        self._stack: List[_Stage] = []
+        self._last = self.started
+
+    @classmethod
+    def install(cls, request) -> Optional["StageTimer"]:
+        """Start timing request, or return None if neither the configuration nor the request asks for it
+
+        A request carrying the debug token may also ask for a profile. The
+        request's body reads are timed as the "body" stage.
+        """
+        privileged = bool(config.DEBUG_TOKEN) and hmac.compare_digest(
+            request.headers.get(DEBUG_TOKEN_HEADER, "").encode(), config.DEBUG_TOKEN.encode())
+        if not (config.SERVER_TIMING or privileged):
+            return None
+
+        timer = cls()
+        mode = request.headers.get(DEBUG_PROFILE_HEADER) if privileged else None
+        if mode in PROFILE_MODES:
+            timer.profile = RequestProfile(mode, config.PROFILE_SAMPLE_INTERVAL_MS / 1000)
+        receive = request.receive
+
+        async def timed_receive():
+            # Once the body is in, receive only waits for the client to disconnect, which is not a stage
+            if timer._body_read:
+                return await receive()
+            with timer.stage("body"):
+                message = await receive()
+            timer._body_read = message["type"] != "http.request" or not message.get("more_body", False)
+            return message
+
+        request._receive = timed_receive
+        timer.token = _current.set(timer)
+        return timer
+
+    def uninstall(self):
+        _current.reset(self.token)
+
+    def _add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds * 1000
+
+    def stage(self, name: str) -> _Stage:
+        return _Stage(self, name)
+
+    def gap(self, name: str):
+        """Attribute the time since the last top-level stage ended to name"""
+        if not self._stack:
+            now = time.perf_counter()
+            self._add(name, now - self._last)
+            self._last = now
+
+    def header(self) -> str:
+        """Server-Timing header value, the stages in the order they first ran followed by the total"""
+        total = (time.perf_counter() - self.started) * 1000
+        return ", ".join([f"{name};dur={ms:.3f}" for name, ms in self.stages.items()] + [f"total;dur={total:.3f}"])
+
+
+def stage(name: str):
+    """Context manager timing a stage of the current request; does nothing when it is not timed"""
+    timer = _current.get()
+    return _NOT_TIMED if timer is None else timer.stage(name)
+
+
+def _timed(call: Callable) -> Callable:
+    """Time an endpoint as the "handler" stage, the time before it as "validate" """
+    if asyncio.iscoroutinefunction(call):
+        @functools.wraps(call)
+        async def endpoint(*args, **kwargs):
+            timer = _current.get()
+            if timer is None:
+                return await call(*args, **kwargs)
+            timer.gap("validate")
+            with timer.stage("handler"):
+                return await call(*args, **kwargs)
+        return endpoint
+
+    @functools.wraps(call)
+    def endpoint(*args, **kwargs):
+        timer = _current.get()
+        if timer is None:
+            return call(*args, **kwargs)
+        timer.gap("validate")
+        # Plain endpoints run on a worker thread, which a profile has to follow
+        with timer.stage("handler"), timer.profile.thread() if timer.profile else _NOT_TIMED:
+            return call(*args, **kwargs)
+    return endpoint
+
+
+class TimedRoute(APIRoute):
+    """Route whose endpoint is timed as the "handler" stage of timed requests"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dependant.call = _timed(self.dependant.call)
+
+
+class RequestProfile:
+    """Profile of one request, saved to a file for offline analysis
+
+    "cprofile" runs cProfile on every thread the request executes on and
+    saves the merged statistics (open with pstats or snakeviz). "sample"
+    records the stacks of those threads every ``interval`` seconds and
+    saves them as folded stacks, one ``frame;frame;... count`` line per
+    distinct stack (open with flamegraph.pl or speedscope). Either captures
+    whatever else runs on those threads meanwhile, such as other requests
+    on the event loop.
+    """
+
+    def __init__(self, mode: str, interval: float):
+        self.mode = mode
+        self.interval = interval
+        self._profilers: List[cProfile.Profile] = []
+        self._threads: Dict[int, int] = {}
+        self._samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+    @contextmanager
+    def thread(self) -> Iterator[None]:
+        """Profile the calling thread while inside the block"""
+        if self.mode == "cprofile":
+            profiler = cProfile.Profile()
+            self._profilers.append(profiler)
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+            return
+
+        ident = threading.get_ident()
+        self._threads[ident] = self._threads.get(ident, 0) + 1
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+            self._sampler.start()
+        try:
+            yield
+        finally:
+            self._threads[ident] -= 1
+            if not self._threads[ident]:
+                del self._threads[ident]
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident in list(self._threads):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if stack:
+                    self._samples[";".join(reversed(stack))] += 1
+
+    def save(self, method: str, path: str) -> str:
+        """Write the profile to config.PROFILE_DIR, returning the file's path"""
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        name = re.sub(r"[^A-Za-z0-9]+", "_", path).strip("_") or "root"
+        stem = f"{time.strftime('%Y%m%dT%H%M%S')}-{method}-{name}-{os.getpid()}-{next(_profile_counter)}"
+        if self.mode == "cprofile":
+            filename = os.path.join(config.PROFILE_DIR, stem + ".prof")
+            stats = pstats.Stats(self._profilers[0])
+            for profiler in self._profilers[1:]:
+                stats.add(profiler)
+            stats.dump_stats(filename)
+        else:
+            filename = os.path.join(config.PROFILE_DIR, stem + ".folded")
+            with open(filename, "w") as f:
+                for stack, count in self._samples.most_common():
+                    f.write(f"{stack} {count}\n")
+        return filename
@@ -0,0 +1,159 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from anyio import to_thread
+from starlette.concurrency import run_in_threadpool
+
+from app import config
+from app.store import WouldBlock, deferred_waits, nonblocking
+from app.timing import stage
+
+T = TypeVar("T")
+
+# "writer" runs writes on a dedicated executor and awaits group commits on the event loop,
+# "threadpool" runs them on the shared AnyIO threadpool until durable, as plain def handlers do
+WRITE_PATHS = ("writer", "threadpool")
+
+
+class WritesBacklogged(Exception):
+    """A write waited longer than allowed for room among the pending writes"""
+
+
+def _run_deferred(call: Callable[..., T], args: tuple):
+    with deferred_waits() as waits:
+        result = call(*args)
+    return result, waits
+
+
+class StoreWriter:
+    """Runs store calls for async handlers without tying up the event loop or the shared threadpool
+
+    Writes run on ``threads`` dedicated threads, so disk writes in "sync"
+    durability never occupy the AnyIO threadpool that plain handlers
+    need. With "group" durability the writer thread only applies the
+    change in memory and queues it; the handler then waits for the group
+    commit on the event loop, without holding any thread.
+
+    At most ``max_pending`` writes are in flight (queued, running or
+    awaiting durability). Further writes wait for room, which slows
+    writers down to the pace of the disk, and fail with WritesBacklogged
+    after ``timeout`` seconds.
+
+    Reads of in-memory stores run inline on the event loop as long as they
+    take no lock: one that would wait for a writer or for indexes to be
+    built raises WouldBlock instead (see nonblocking()) and is run again on
+    the threadpool. Stores that read from disk are always read on the
+    threadpool. In "threadpool" mode reads and writes both run on the
+    threadpool, as with plain def handlers.
+    """
+
+    def __init__(self, mode: str = "writer", threads: int = 2, max_pending: int = 1000, timeout: float = 5.0):
+        if mode not in WRITE_PATHS:
+            raise ValueError(f"Unknown write path: {mode}")
+        self.mode = mode
+        self.threads = threads
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._room: Optional[asyncio.Semaphore] = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiting = 0
+        self._completed = 0
+        self._backlogged = 0
+        self._offloaded = 0
+
+    def start(self):
+        """Create the writer threads; writes made before start() create them on demand"""
+        with self._lock:
+            if self._executor is None and self.mode == "writer":
+                self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix="store-writer")
+
+    def stop(self):
+        """Finish the writes already handed to the writer threads and release them"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._room = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    async def read(self, store, call: Callable[..., T], *args) -> T:
+        """Run a read of store, inline unless the store reads from disk or the read would block"""
+        if self.mode == "threadpool" or store.blocking_reads:
+            return await run_in_threadpool(call, *args)
+        try:
+            with nonblocking():
+                return call(*args)
+        except WouldBlock:
+            self._offloaded += 1
+            return await run_in_threadpool(call, *args)
+
+    async def _enter(self) -> asyncio.Semaphore:
+        if self._room is None:
+            # Bound to the running event loop, so created on first use rather than at import
+            self._room = asyncio.Semaphore(self.max_pending)
+        room = self._room
+        if room.locked():
+            self._waiting += 1
+            try:
+                with stage("queue"):
+                    await asyncio.wait_for(room.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                self._backlogged += 1
+                raise WritesBacklogged(f"{self.max_pending} writes pending for more than {self.timeout}s")
+            finally:
+                self._waiting -= 1
+        else:
+            await room.acquire()
+        self._in_flight += 1
+        return room
+
+    def _exit(self, room: asyncio.Semaphore):
+        self._in_flight -= 1
+        self._completed += 1
+        room.release()
+
+    async def write(self, call: Callable[..., T], *args) -> T:
+        """Run a write and return its result once the change is durable"""
+        if self.mode == "threadpool":
+            return await run_in_threadpool(call, *args)
+        if self._executor is None:
+            self.start()
+        room = await self._enter()
+        try:
+            loop = asyncio.get_running_loop()
+            # The request's context goes along, so stage timing covers the writer thread too
+            context = contextvars.copy_context()
+            result, waits = await loop.run_in_executor(self._executor, context.run, _run_deferred, call, args)
+            for persistence, ticket in waits:
+                with stage("persist"):
+                    await persistence.wait_async(ticket)
+            return result
+        finally:
+            self._exit(room)
+
+    def stats(self) -> dict:
+        """Writes in flight and waiting, and the AnyIO threadpool's load; call from the event loop"""
+        limiter = to_thread.current_default_thread_limiter()
+        return {
+            "mode": self.mode,
+            "threads": self.threads if self.mode == "writer" else 0,
+            "max_pending": self.max_pending,
+            "in_flight": self._in_flight,
+            "waiting": self._waiting,
+            "completed": self._completed,
+            "backlogged": self._backlogged,
+            "reads_offloaded": self._offloaded,
+            "threadpool": {
+                "size": int(limiter.total_tokens),
+                "busy": limiter.borrowed_tokens,
+                "waiting": limiter.statistics().tasks_waiting,
+            },
+        }
+
+
+store_writer = StoreWriter(config.WRITE_PATH, config.WRITER_THREADS, config.MAX_PENDING_WRITES,
+                           config.WRITE_QUEUE_TIMEOUT)
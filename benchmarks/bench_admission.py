@@ -0,0 +1,134 @@
+"""Benchmark: read tail latency under a write storm, with and without admission control
+
+Starts ``uvicorn app.main:app`` once per mode:
+
+- ``off``: no in-flight caps (``LIBRARY_MAX_*_IN_FLIGHT=0``), every request is admitted
+- ``on``: reads and writes capped at ``--max-reads`` and ``--max-writes`` in flight,
+  with ``--queue`` more waiting up to ``--queue-timeout-ms``; the rest are shed
+
+and drives it with ``--readers`` clients fetching single books, first alone
+and then while ``--writers`` clients update books as fast as they can.
+Shed writers wait ``--backoff`` seconds before retrying, as Retry-After
+asks; ``--backoff 0`` retries at once, as a runaway batch job would. Reports read latency percentiles per phase, write throughput and
+latency, and the server's admission counters from ``GET /internal/stats``.
+
+Usage: python -m benchmarks.bench_admission [--modes off on] [--writers 200] [--readers 4] [--backoff 1]
+                                            [--storage journal] [--durability sync] [--duration 10]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, List
+
+from app.flusher import percentiles
+from benchmarks.bench_search import make_catalog
+from benchmarks.loadtest import HttpConnection, UvicornClient, seed
+
+
+async def measure(client: UvicornClient, writers: int, args) -> dict:
+    write_latency: List[float] = []
+    read_latency: List[float] = []
+    statuses: Counter = Counter()
+    deadline = time.perf_counter() + args.duration
+
+    async def writer(user: int):
+        send = client.connection()
+        rng = random.Random(user)
+        while time.perf_counter() < deadline:
+            book_id = rng.randrange(args.records)
+            body = json.dumps({"id": book_id, "title": f"Edition {rng.random()}", "author": "A. Writer",
+                               "year": 2000}).encode()
+            started = time.perf_counter()
+            status, _ = await send("PUT", f"/books/{book_id}", body)
+            statuses[f"write_{status}"] += 1
+            if status == 200:
+                write_latency.append((time.perf_counter() - started) * 1000)
+            elif status in (429, 503):
+                await asyncio.sleep(args.backoff)
+
+    async def reader(user: int):
+        send = client.connection()
+        rng = random.Random(-user)
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            status, _ = await send("GET", f"/books/{rng.randrange(args.records)}")
+            read_latency.append((time.perf_counter() - started) * 1000)
+            statuses[f"read_{status}"] += 1
+            await asyncio.sleep(args.read_interval)
+
+    await asyncio.gather(*(writer(i) for i in range(writers)), *(reader(i) for i in range(args.readers)))
+    return {
+        "writers": writers,
+        "read_latency_ms": percentiles(read_latency),
+        "writes_per_sec": round(len(write_latency) / args.duration, 1),
+        "write_latency_ms": percentiles(write_latency),
+        "statuses": dict(sorted(statuses.items())),
+    }
+
+
+async def run(mode: str, directory: str, books: List[dict], args) -> List[dict]:
+    env: Dict[str, str] = dict(
+        os.environ,
+        LIBRARY_DATA_DIR=directory,
+        LIBRARY_STORAGE=args.storage,
+        LIBRARY_DURABILITY=args.durability,
+        LIBRARY_LOG_FILE=os.path.join(directory, "app.log"),
+        LIBRARY_ACCESS_LOG_FILE=os.path.join(directory, "api.log"),
+        LIBRARY_LOG_BODY="off",
+        LIBRARY_MAX_READS_IN_FLIGHT=str(args.max_reads if mode == "on" else 0),
+        LIBRARY_MAX_WRITES_IN_FLIGHT=str(args.max_writes if mode == "on" else 0),
+        LIBRARY_ADMISSION_QUEUE=str(args.queue),
+        LIBRARY_ADMISSION_QUEUE_TIMEOUT_MS=str(args.queue_timeout_ms),
+    )
+    client = UvicornClient(env, args.port, 1)
+    await client.start()
+    results = []
+    try:
+        await seed(client, books)
+        for writers in (0, args.writers):
+            result = await measure(client, writers, args)
+            connection = HttpConnection("127.0.0.1", args.port)
+            _, body = await connection.fetch("GET", "/internal/stats")
+            connection.close()
+            results.append({"admission": mode, **result, "counters": json.loads(body)["admission"]})
+    finally:
+        await client.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", nargs="+", choices=["off", "on"], default=["off", "on"])
+    parser.add_argument("--records", type=int, default=10_000)
+    parser.add_argument("--writers", type=int, default=200)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--read-interval", type=float, default=0.01, help="pause between a reader's requests")
+    parser.add_argument("--backoff", type=float, default=1.0, help="seconds a shed writer waits before retrying")
+    parser.add_argument("--max-reads", type=int, default=64)
+    parser.add_argument("--max-writes", type=int, default=8)
+    parser.add_argument("--queue", type=int, default=32)
+    parser.add_argument("--queue-timeout-ms", type=int, default=500)
+    parser.add_argument("--storage", default="journal")
+    parser.add_argument("--durability", default="sync")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--port", type=int, default=8769)
+    args = parser.parse_args()
+
+    books = list(make_catalog(args.records, random.Random(0)).values())
+    for mode in args.modes:
+        # Every run starts from the same empty data directory
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ("books", "readers", "staff"):
+                with open(os.path.join(directory, f"{name}.json"), "w") as f:
+                    f.write("[]")
+            for result in asyncio.run(run(mode, directory, books, args)):
+                print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Benchmark: threadpool saturation and read tail latency under write load, threadpool vs writer path
+
+Starts ``uvicorn app.main:app`` once per write path (``LIBRARY_WRITE_PATH``):
+
+- ``threadpool``: reads and writes hold an AnyIO threadpool thread until
+  the write is durable, as the plain ``def`` handlers did
+- ``writer``: writes run on the dedicated store writer and durability is
+  awaited on the event loop; reads of in-memory stores run inline
+
+and drives it with ``--writers`` concurrent clients updating books while
+``--readers`` clients fetch single books. Reports write throughput, write
+and read latency percentiles, and the threadpool's peak busy threads and
+queued tasks, sampled from ``GET /internal/stats``.
+
+Usage: python -m benchmarks.bench_async [--paths threadpool writer] [--writers 100] [--readers 4]
+                                        [--storage journal] [--durability sync] [--duration 10]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Dict, List
+
+from app.flusher import percentiles
+from benchmarks.bench_search import make_catalog
+from benchmarks.loadtest import HttpConnection, UvicornClient, seed
+
+STATS_INTERVAL = 0.05
+
+
+async def measure(client: UvicornClient, args) -> dict:
+    write_latency: List[float] = []
+    read_latency: List[float] = []
+    errors = 0
+    peak = {"busy": 0, "waiting": 0, "writes_waiting": 0}
+    deadline = time.perf_counter() + args.duration
+
+    async def writer(user: int):
+        nonlocal errors
+        send = client.connection()
+        rng = random.Random(user)
+        while time.perf_counter() < deadline:
+            book_id = rng.randrange(args.records)
+            body = json.dumps({"id": book_id, "title": f"Edition {rng.random()}", "author": "A. Writer",
+                               "year": 2000}).encode()
+            started = time.perf_counter()
+            status, _ = await send("PUT", f"/books/{book_id}", body)
+            write_latency.append((time.perf_counter() - started) * 1000)
+            errors += status != 200
+
+    async def reader(user: int):
+        nonlocal errors
+        send = client.connection()
+        rng = random.Random(-user)
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            status, _ = await send("GET", f"/books/{rng.randrange(args.records)}")
+            read_latency.append((time.perf_counter() - started) * 1000)
+            errors += status != 200
+            await asyncio.sleep(args.read_interval)
+
+    async def sample_stats():
+        connection = HttpConnection("127.0.0.1", args.port)
+        while time.perf_counter() < deadline:
+            _, body = await connection.fetch("GET", "/internal/stats")
+            stats = json.loads(body)["writes"]
+            peak["busy"] = max(peak["busy"], stats["threadpool"]["busy"])
+            peak["waiting"] = max(peak["waiting"], stats["threadpool"]["waiting"])
+            peak["writes_waiting"] = max(peak["writes_waiting"], stats["waiting"])
+            await asyncio.sleep(STATS_INTERVAL)
+        connection.close()
+
+    await asyncio.gather(*(writer(i) for i in range(args.writers)),
+                         *(reader(i) for i in range(args.readers)), sample_stats())
+    return {
+        "writes_per_sec": round(len(write_latency) / args.duration, 1),
+        "write_latency_ms": percentiles(write_latency),
+        "read_latency_ms": percentiles(read_latency),
+        "reads": len(read_latency),
+        "errors": errors,
+        "threadpool_peak_busy": peak["busy"],
+        "threadpool_peak_queued": peak["waiting"],
+        "writes_peak_waiting": peak["writes_waiting"],
+    }
+
+
+async def run(path: str, directory: str, books: List[dict], args) -> dict:
+    env: Dict[str, str] = dict(
+        os.environ,
+        LIBRARY_DATA_DIR=directory,
+        LIBRARY_STORAGE=args.storage,
+        LIBRARY_DURABILITY=args.durability,
+        LIBRARY_WRITE_PATH=path,
+        LIBRARY_LOG_FILE=os.path.join(directory, "app.log"),
+        LIBRARY_ACCESS_LOG_FILE=os.path.join(directory, "api.log"),
+        LIBRARY_LOG_BODY="off",
+    )
+    client = UvicornClient(env, args.port, 1)
+    await client.start()
+    try:
+        await seed(client, books)
+        result = await measure(client, args)
+    finally:
+        await client.stop()
+    return {"write_path": path, "storage": args.storage, "durability": args.durability,
+            "writers": args.writers, "readers": args.readers, **result}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--paths", nargs="+", choices=["threadpool", "writer"], default=["threadpool", "writer"])
+    parser.add_argument("--records", type=int, default=10_000)
+    parser.add_argument("--writers", type=int, default=100)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--read-interval", type=float, default=0.01, help="pause between a reader's requests")
+    parser.add_argument("--storage", default="journal")
+    parser.add_argument("--durability", default="sync")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--port", type=int, default=8768)
+    args = parser.parse_args()
+
+    books = list(make_catalog(args.records, random.Random(0)).values())
+    for path in args.paths:
+        # Every run starts from the same empty data directory
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ("books", "readers", "staff"):
+                with open(os.path.join(directory, f"{name}.json"), "w") as f:
+                    f.write("[]")
+            print(json.dumps(asyncio.run(run(path, directory, books, args))), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Benchmark: bytes and time to bring a replica up to date, full listing vs the change feed
+
+Seeds ``--records`` books into the application in-process, then for each
+churn level updates that many random books and syncs a replica twice:
+once by downloading ``GET /books`` again, once by fetching
+``GET /changes?since=<position>`` page by page. Reports bytes transferred
+and milliseconds per sync; the feed should grow with the churn and stay
+flat with the catalog size.
+
+Usage: python -m benchmarks.bench_changes [--records 10000 100000] [--churn 10 100 1000]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.bench_search import make_catalog
+from benchmarks.loadtest import AsgiClient, seed
+
+# Changes fetched per GET /changes request
+PAGE_SIZE = 1000
+
+
+async def run(application, records: int, churn_levels, rng: random.Random):
+    books = list(make_catalog(records, rng).values())
+    client = AsgiClient(application.app)
+    await client.start()
+    try:
+        await seed(client, books)
+        send = client.connection()
+        # The replica is current as of the seeding; every update below logs one change
+        position = application.change_log.latest()
+        for churn in churn_levels:
+            for _ in range(churn):
+                book = dict(books[rng.randrange(records)], title=f"Edition {rng.random()}")
+                status, _ = await send("PUT", f"/books/{book['id']}", json.dumps(book).encode())
+                if status != 200:
+                    raise RuntimeError(f"Update failed with status {status}")
+
+            started = time.perf_counter()
+            status, full_bytes = await send("GET", "/books")
+            full_ms = (time.perf_counter() - started) * 1000
+
+            started = time.perf_counter()
+            feed_bytes, target = 0, position + churn
+            while position < target:
+                status, size = await send("GET", f"/changes?since={position}&limit={PAGE_SIZE}")
+                feed_bytes += size
+                position = min(target, position + PAGE_SIZE)
+            feed_ms = (time.perf_counter() - started) * 1000
+
+            print(json.dumps({"records": records, "churn": churn,
+                              "full_bytes": full_bytes, "full_ms": round(full_ms, 1),
+                              "feed_bytes": feed_bytes, "feed_ms": round(feed_ms, 1),
+                              "saved": round(1 - feed_bytes / full_bytes, 4)}), flush=True)
+    finally:
+        await client.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--churn", type=int, nargs="+", default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # The application reads its configuration at import, so it is imported once the environment is set
+        os.environ.update(
+            LIBRARY_DATA_DIR=directory,
+            LIBRARY_STORAGE="journal",
+            LIBRARY_DURABILITY="async",
+            LIBRARY_LOG_FILE=os.path.join(directory, "app.log"),
+            LIBRARY_ACCESS_LOG_FILE=os.path.join(directory, "api.log"),
+            LIBRARY_LOG_BODY="off",
+            LIBRARY_CHANGE_LOG_SIZE=str(max(args.records) + sum(args.churn)),
+        )
+        from app import config, main as application
+        for records in args.records:
+            # Each catalog starts from an empty data directory
+            config.DATA_DIR = os.path.join(directory, str(records))
+            os.makedirs(config.DATA_DIR)
+            asyncio.run(run(application, records, args.churn, random.Random(records)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Benchmark: loan lookups and circulation on a large number of active loans, indexed vs linear scan
+
+Writes a synthetic library (books, readers and ``--loans`` active loans
+with due dates spread around today) into a temporary data directory,
+opens it through the managers as the API does, and reports per operation
+latency percentiles in microseconds:
+
+- availability: the active loan of a book, via the book_id index
+- reader_loans: the active loans of a reader, via the reader_id index
+- overdue_page: the first page of loans due before today, most overdue first, via the due date index
+- checkout, renew, return: writes validated against the book and reader managers
+
+The lookups are also timed as a linear scan over the active loans, which
+is what answering them without the indexes costs.
+
+Usage: python -m benchmarks.bench_loans [--loans 1000000] [--storage journal] [--durability group]
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+from typing import Callable, List
+
+from app import config
+from app.flusher import percentiles
+from app.library_manager import BookManager
+from app.loan_manager import LoanManager
+from app.models import Checkout
+from app.persistence import atomic_write_json
+from app.reader_manager import ReaderManager
+
+READERS_PER_LOAN = 0.2
+
+
+def write_library(directory: str, loans: int, spare: int, rng: random.Random, today: date):
+    books = loans + spare
+    atomic_write_json(os.path.join(directory, "books.json"),
+                      ({"id": i, "title": f"Title {i}", "author": f"Author {i % 5000}", "year": 1900 + i % 120}
+                       for i in range(books)), indent=None)
+    readers = max(1, int(loans * READERS_PER_LOAN))
+    atomic_write_json(os.path.join(directory, "readers.json"),
+                      ({"id": i, "name": f"Reader {i}", "membership_id": f"M{i}"} for i in range(readers)), indent=None)
+
+    def loan(i: int) -> dict:
+        # Due dates up to 30 days either side of today, so about half the loans are overdue
+        due = today + timedelta(days=rng.randint(-30, 30))
+        return {"id": i, "book_id": i, "reader_id": rng.randrange(readers),
+                "loaned_on": (due - timedelta(days=14)).isoformat(), "due": due.isoformat(),
+                "renewals": 0, "returned_on": None}
+
+    atomic_write_json(os.path.join(directory, "loans.json"), (loan(i) for i in range(loans)), indent=None)
+    return books, readers
+
+
+def timed(call: Callable[[int], object], samples: List[int]) -> dict:
+    latency = []
+    for sample in samples:
+        started = time.perf_counter()
+        call(sample)
+        latency.append((time.perf_counter() - started) * 1_000_000)
+    return percentiles(latency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--loans", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--writes", type=int, default=2000)
+    parser.add_argument("--scans", type=int, default=5, help="samples of the linear scan baseline")
+    parser.add_argument("--storage", default="journal")
+    parser.add_argument("--durability", default="group")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    today = date.today()
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        books, readers = write_library(directory, args.loans, args.writes, rng, today)
+        print(json.dumps({"loans": args.loans, "books": books, "readers": readers,
+                          "written_s": round(time.perf_counter() - started, 1)}), flush=True)
+
+        config.DATA_DIR = directory
+        config.STORAGE_MODE = args.storage
+        config.DURABILITY = args.durability
+        book_manager, reader_manager = BookManager(), ReaderManager()
+        loan_manager = LoanManager(book_manager, reader_manager)
+        started = time.perf_counter()
+        for manager in (book_manager, reader_manager, loan_manager):
+            manager.open()
+            manager.store.build_indexes()
+        loan_manager.history.build_indexes()
+        print(json.dumps({"storage": args.storage, "opened_s": round(time.perf_counter() - started, 1)}), flush=True)
+
+        store = loan_manager.store
+        book_samples = [rng.randrange(args.loans) for _ in range(args.queries)]
+        reader_samples = [rng.randrange(readers) for _ in range(args.queries)]
+        overdue_cut = (today - timedelta(days=1)).isoformat()
+        lookups = {
+            "availability": (
+                lambda book_id: loan_manager.get_book_loan(book_id),
+                lambda book_id: [loan for loan in store.values() if loan["book_id"] == book_id],
+                book_samples,
+            ),
+            "reader_loans": (
+                lambda reader_id: loan_manager.get_reader_loans(reader_id),
+                lambda reader_id: [loan for loan in store.values() if loan["reader_id"] == reader_id],
+                reader_samples,
+            ),
+            "overdue_page": (
+                lambda _: loan_manager.get_overdue_page(today),
+                lambda _: sorted((loan["due"], loan["id"]) for loan in store.values() if loan["due"] <= overdue_cut)[:100],
+                list(range(args.queries // 10)),
+            ),
+        }
+        for name, (indexed, scan, samples) in lookups.items():
+            print(json.dumps({"op": name, "indexed_us": timed(indexed, samples),
+                              "scan_us": timed(scan, samples[:args.scans])}), flush=True)
+
+        # New loans go to the spare books, which nobody has borrowed yet
+        loan_ids = list(range(args.loans, args.loans + args.writes))
+        checkout = timed(lambda i: loan_manager.checkout(
+            Checkout(id=i, book_id=i, reader_id=rng.randrange(readers)), today), loan_ids)
+        renew = timed(lambda i: loan_manager.renew(i, today), loan_ids)
+        returned = timed(lambda i: loan_manager.return_loan(i, today), loan_ids)
+        for name, latency in (("checkout", checkout), ("renew", renew), ("return", returned)):
+            print(json.dumps({"op": name, "durability": args.durability, "latency_us": latency}), flush=True)
+
+        for manager in (book_manager, reader_manager, loan_manager):
+            manager.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Benchmark: memory per record of the dict, slots and columnar record layouts
+
+Loads a synthetic catalog into a RecordStore the way the application does
+(parsed from JSON, so every record brings its own string objects) and
+reports the bytes traced per record once the parsed input is released,
+along with the cost of reading a record back as a dict.
+
+Usage: python -m benchmarks.bench_memory [--sizes 100000 1000000] [--layouts dict slots columnar]
+"""
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+
+from app.layouts import RECORD_LAYOUTS, record_layout
+from app.models import Book
+from app.store import RecordStore
+from benchmarks.bench_search import make_catalog
+
+GETS = 100_000
+
+
+def measure(text: str, size: int, layout: str) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    store = RecordStore(json.loads(text), layout=record_layout(layout, "id", Book, interned=("author",)))
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+
+    keys = [random.Random(0).randrange(size) for _ in range(GETS)]
+    started = time.perf_counter()
+    for key in keys:
+        store.get(key)
+    get_us = (time.perf_counter() - started) / GETS * 1e6
+    del store
+    return {"layout": layout, "records": size, "bytes_per_record": round(used / size, 1),
+            "total_mb": round(used / 2**20, 1), "get_us": round(get_us, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--layouts", nargs="+", choices=RECORD_LAYOUTS, default=list(RECORD_LAYOUTS))
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        text = json.dumps(list(make_catalog(size, random.Random(size)).values()))
+        for layout in args.layouts:
+            print(json.dumps(measure(text, size, layout)))
+
+
+if __name__ == "__main__":
+    main()
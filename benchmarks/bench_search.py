@@ -0,0 +1,84 @@
+"""Benchmark: SearchIndex build time and query latency on a synthetic catalog
+
+Usage: python -m benchmarks.bench_search [--sizes 100000 1000000] [--queries 500]
+"""
+import argparse
+import itertools
+import random
+import string
+import time
+from typing import List
+
+from app.flusher import percentiles
+from app.search import SearchIndex
+
+# Consonant-vowel(-consonant) syllables give word-like tokens with a realistic trigram spread
+SYLLABLES = [c + v for c in "bcdfghklmnprstvwz" for v in "aeiou"] + [c + v + "r" for c in "bdgkpt" for v in "aeiou"]
+
+
+def make_vocabulary(size: int, rng: random.Random) -> List[str]:
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def make_catalog(n: int, rng: random.Random) -> dict:
+    title_words = make_vocabulary(50_000, rng)
+    surnames = make_vocabulary(20_000, rng)
+    # Skewed word choice, so common words have long postings like in real catalogs
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** 0.7 for rank in range(len(title_words))))
+    books = {}
+    for i in range(n):
+        title = " ".join(rng.choices(title_words, cum_weights=cum_weights, k=rng.randint(2, 6)))
+        author = f"{rng.choice(string.ascii_uppercase)}. {rng.choice(surnames)}"
+        books[i] = {"id": i, "title": title, "author": author, "year": 1900 + i % 120}
+    return books
+
+
+def typo(word: str, rng: random.Random) -> str:
+    i = rng.randrange(len(word))
+    return word[:i] + rng.choice(string.ascii_lowercase) + word[i + 1:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--queries", type=int, default=500)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        rng = random.Random(size)
+        books = make_catalog(size, rng)
+        index = SearchIndex({"title": 2.0, "author": 1.0})
+
+        started = time.perf_counter()
+        index.rebuild(books)
+        build = time.perf_counter() - started
+        print(f"\n{size} books: index built in {build:.1f}s, {len(index._doc_freq)} distinct tokens")
+
+        samples = [books[rng.randrange(size)] for _ in range(args.queries)]
+        workloads = {
+            "exact": [" ".join(b["title"].split()[:2]) for b in samples],
+            "prefix": [b["title"].split()[0][:3] for b in samples],
+            "typo": [typo(b["title"].split()[-1], rng) for b in samples],
+            "author typo": [typo(b["author"].split()[-1], rng) for b in samples],
+        }
+        for name, queries in workloads.items():
+            latencies = []
+            for query in queries:
+                started = time.perf_counter()
+                index.search(query, limit=10)
+                latencies.append((time.perf_counter() - started) * 1000)
+            print(f"  {name:<12} latency ms: {percentiles(latencies)}")
+
+        started = time.perf_counter()
+        for i in range(1000):
+            key = rng.randrange(size)
+            index.remove(key, books[key])
+            index.add(key, books[key])
+        print(f"  update      {(time.perf_counter() - started):.3f} ms per remove+add")
+
+
+if __name__ == "__main__":
+    main()
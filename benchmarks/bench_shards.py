@@ -0,0 +1,105 @@
+"""Benchmark: multi-threaded write throughput and save cost, one store vs hash-partitioned shards
+
+For each storage mode and shard count, seeds ``--records`` books into an
+empty data directory through BookManager (as the API opens it, with
+``LIBRARY_SHARDS`` set), then:
+
+- ``--threads`` threads update random books for ``--duration`` seconds,
+  reporting writes per second and latency percentiles in milliseconds
+- one book is updated and the collection saved, reporting the save time
+  and the bytes rewritten; a sharded store only rewrites the changed shard
+
+Usage: python -m benchmarks.bench_shards [--shards 1 4] [--storage json journal] [--durability sync]
+                                         [--records 20000] [--threads 8] [--duration 5]
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from typing import List
+
+from app import config
+from app.flusher import percentiles
+from app.library_manager import BookManager
+from benchmarks.bench_search import make_catalog
+
+
+def data_bytes(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def run(books: List[dict], storage: str, shards: int, args) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        config.DATA_DIR = directory
+        config.STORAGE_MODE = storage
+        config.DURABILITY = args.durability
+        config.SHARDS = shards
+        manager = BookManager()
+        manager.open()
+        manager.store.insert_many(books)
+        manager.save_data()
+
+        latencies: List[List[float]] = [[] for _ in range(args.threads)]
+        deadline = time.perf_counter() + args.duration
+
+        def writer(thread: int):
+            rng = random.Random(thread)
+            while time.perf_counter() < deadline:
+                book = dict(books[rng.randrange(len(books))], title=f"Edition {rng.random()}")
+                started = time.perf_counter()
+                manager.store.update(book["id"], book)
+                latencies[thread].append((time.perf_counter() - started) * 1000)
+
+        threads = [threading.Thread(target=writer, args=(thread,)) for thread in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writes = sum(map(len, latencies))
+
+        # Bring every shard's files up to date, then time the save after a single change
+        manager.save_data()
+        before = {name: os.path.getmtime(os.path.join(directory, name)) for name in os.listdir(directory)}
+        book = dict(books[0], title="Saved")
+        manager.store.update(book["id"], book)
+        started = time.perf_counter()
+        manager.save_data()
+        save_ms = (time.perf_counter() - started) * 1000
+        rewritten = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+                        if before.get(name) != os.path.getmtime(os.path.join(directory, name)))
+        result = {
+            "storage": storage,
+            "durability": args.durability,
+            "shards": shards,
+            "threads": args.threads,
+            "writes_per_sec": round(writes / args.duration, 1),
+            "write_latency_ms": percentiles(sample for thread in latencies for sample in thread),
+            "save_ms": round(save_ms, 2),
+            "save_bytes": rewritten,
+            "data_bytes": data_bytes(directory),
+        }
+        manager.close()
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--storage", nargs="+", default=["json", "journal"])
+    parser.add_argument("--durability", default="sync")
+    parser.add_argument("--records", type=int, default=20_000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    books = list(make_catalog(args.records, random.Random(0)).values())
+    for storage in args.storage:
+        for shards in args.shards:
+            print(json.dumps(run(books, storage, shards, args)), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Benchmark: time to first request and to readiness after starting the API on a large catalog
+
+Writes a synthetic catalog as books.json (and, for the snapshot mode, as a
+binary snapshot converted beforehand), then starts ``uvicorn app.main:app``
+once per storage mode and measures:
+
+- first request: process start until ``GET /books/{id}`` answers 200
+- ready: process start until ``GET /health`` answers 200, i.e. every index is built
+- the server's resident memory once ready
+
+Usage: python -m benchmarks.bench_startup [--records 1000000] [--storage json snapshot]
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from app.snapshot import write_snapshot
+from benchmarks.bench_search import make_catalog
+
+POLL_INTERVAL = 0.02
+
+
+def status(port: int, path: str) -> int:
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        conn.request("GET", path)
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        return response.status
+    except OSError:
+        return 0
+
+
+def wait_for(port: int, path: str, started: float, timeout: float) -> float:
+    while time.perf_counter() - started < timeout:
+        if status(port, path) == 200:
+            return round(time.perf_counter() - started, 2)
+        time.sleep(POLL_INTERVAL)
+    raise RuntimeError(f"GET {path} did not succeed within {timeout}s")
+
+
+def resident_mb(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def run(storage: str, directory: str, records: int, args) -> dict:
+    env = dict(
+        os.environ,
+        LIBRARY_DATA_DIR=directory,
+        LIBRARY_STORAGE=storage,
+        LIBRARY_LOG_FILE=os.path.join(directory, "app.log"),
+        LIBRARY_ACCESS_LOG_FILE=os.path.join(directory, "api.log"),
+        LIBRARY_LOG_BODY="off",
+    )
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(args.port), "--log-level", "warning"],
+        env=env,
+    )
+    try:
+        first = wait_for(args.port, f"/books/{records // 2}", started, args.timeout)
+        ready = wait_for(args.port, "/health", started, args.timeout)
+        memory = resident_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+    return {"storage": storage, "records": records, "first_request_s": first, "ready_s": ready,
+            "rss_mb": memory}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=1_000_000)
+    parser.add_argument("--storage", nargs="+", default=["json", "snapshot"])
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--timeout", type=float, default=600.0)
+    args = parser.parse_args()
+
+    books = list(make_catalog(args.records, random.Random(0)).values())
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "books.json"), "w") as f:
+            json.dump(books, f)
+        for name in ("readers", "staff"):
+            shutil.copy(os.path.join("app", "data", f"{name}.json"), directory)
+        if "snapshot" in args.storage:
+            started = time.perf_counter()
+            write_snapshot(os.path.join(directory, "books.snap"), books)
+            print(f"snapshot written in {time.perf_counter() - started:.1f}s, "
+                  f"{os.path.getsize(os.path.join(directory, 'books.snap')) / 2**20:.0f} MiB "
+                  f"(JSON: {os.path.getsize(os.path.join(directory, 'books.json')) / 2**20:.0f} MiB)")
+        del books
+
+        for storage in args.storage:
+            print(json.dumps(run(storage, directory, args.records, args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Micro-benchmark: list-scan lookups vs the id-indexed RecordStore
+
+Usage: python -m benchmarks.bench_store [--sizes 10000 100000 1000000] [--ops 200]
+"""
+import argparse
+import random
+import time
+from typing import Callable, List
+
+from app.store import RecordStore
+
+
+def make_records(n: int) -> List[dict]:
+    return [
+        {"id": i, "title": f"Title {i}", "author": f"Author {i % 5000}", "year": 1900 + i % 120}
+        for i in range(n)
+    ]
+
+
+class ListScan:
+    """The pre-index manager logic, kept here as the comparison baseline"""
+
+    def __init__(self, records: List[dict]):
+        self.records = records
+
+    def get(self, key):
+        return next((r for r in self.records if r["id"] == key), None)
+
+    def insert(self, record):
+        if any(r["id"] == record["id"] for r in self.records):
+            raise ValueError(f"Record with ID {record['id']} already exists")
+        self.records.append(record)
+
+    def update(self, key, record):
+        for i, r in enumerate(self.records):
+            if r["id"] == key:
+                self.records[i] = record
+                return record
+        return None
+
+    def delete(self, key):
+        self.records = [r for r in self.records if r["id"] != key]
+
+
+def timed(ops: int, fn: Callable[[int], None]) -> float:
+    """Run fn for each op index and return microseconds per op"""
+    start = time.perf_counter()
+    for i in range(ops):
+        fn(i)
+    return (time.perf_counter() - start) / ops * 1e6
+
+
+def run(size: int, ops: int, impl: str) -> dict:
+    records = make_records(size)
+    store = ListScan(records) if impl == "list" else RecordStore(records)
+    rng = random.Random(size)
+    keys = [rng.randrange(size) for _ in range(ops)]
+
+    results = {
+        "get": timed(ops, lambda i: store.get(keys[i])),
+        "insert": timed(ops, lambda i: store.insert({"id": size + i, "title": "t", "author": "a", "year": 2000})),
+        "update": timed(ops, lambda i: store.update(keys[i], {"id": keys[i], "title": "u", "author": "a", "year": 2001})),
+        "delete": timed(ops, lambda i: store.delete(size + i)),
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--ops", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'size':>10} {'impl':>7} {'get':>12} {'insert':>12} {'update':>12} {'delete':>12}  (us/op)")
+    for size in args.sizes:
+        for impl in ("list", "indexed"):
+            r = run(size, args.ops, impl)
+            print(f"{size:>10} {impl:>7} {r['get']:>12.2f} {r['insert']:>12.2f} {r['update']:>12.2f} {r['delete']:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Benchmark: API throughput against 1, 4 and 8 uvicorn workers sharing one SQLite store
+
+Starts ``uvicorn app.main:app --workers N`` on a fresh data directory for
+each worker count, seeds it through the bulk endpoint, then drives a mixed
+workload (80% GET by id, 10% filtered page, 10% PUT) from several client
+processes over keep-alive connections. Afterwards every book is read back
+through different workers to check they all see the same data.
+
+Usage: python -m benchmarks.bench_workers [--workers 1 4 8] [--clients 16] [--seconds 10]
+                                          [--books 10000] [--storage sqlite]
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+
+from app.flusher import percentiles
+
+AUTHORS = [f"Author {i}" for i in range(100)]
+
+
+def request(conn: http.client.HTTPConnection, method: str, path: str, body=None) -> int:
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+    response = conn.getresponse()
+    response.read()
+    return response.status
+
+
+def wait_until_up(port: int, timeout: float = 60.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            if request(conn, "GET", "/health") == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+def client(port: int, books: int, seconds: float, seed: int, results):
+    rng = random.Random(seed)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    latencies: List[float] = []
+    errors = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        roll = rng.random()
+        book_id = rng.randrange(books)
+        started = time.perf_counter()
+        if roll < 0.8:
+            status = request(conn, "GET", f"/books/{book_id}")
+        elif roll < 0.9:
+            status = request(conn, "GET", f"/books?author={rng.choice(AUTHORS).replace(' ', '%20')}&limit=20")
+        else:
+            book = {"id": book_id, "title": f"Title {rng.random()}", "author": rng.choice(AUTHORS), "year": 2000}
+            status = request(conn, "PUT", f"/books/{book_id}", book)
+        latencies.append((time.perf_counter() - started) * 1000)
+        errors += status >= 400
+    results.put((latencies, errors))
+
+
+def run(workers: int, args) -> dict:
+    port = args.port
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(
+            os.environ,
+            LIBRARY_DATA_DIR=directory,
+            LIBRARY_STORAGE=args.storage,
+            LIBRARY_LOG_FILE=os.path.join(directory, "app.log"),
+            LIBRARY_ACCESS_LOG_FILE=os.path.join(directory, "api.log"),
+            LIBRARY_LOG_BODY="off",
+        )
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--workers", str(workers),
+             "--log-level", "warning"],
+            env=env,
+        )
+        try:
+            wait_until_up(port)
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            rows = "\n".join(
+                json.dumps({"id": i, "title": f"Title {i}", "author": AUTHORS[i % len(AUTHORS)], "year": 1950})
+                for i in range(args.books)
+            )
+            conn.request("POST", "/books/bulk", body=rows)
+            conn.getresponse().read()
+
+            results = multiprocessing.Queue()
+            clients = [
+                multiprocessing.Process(target=client, args=(port, args.books, args.seconds, seed, results))
+                for seed in range(args.clients)
+            ]
+            started = time.perf_counter()
+            for process in clients:
+                process.start()
+            collected = [results.get() for _ in clients]
+            elapsed = time.perf_counter() - started
+            for process in clients:
+                process.join()
+
+            # Fresh connections are spread over the workers; all must agree on every record
+            mismatches = 0
+            for i in range(0, args.books, max(1, args.books // 200)):
+                seen = set()
+                for _ in range(3):
+                    check = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                    check.request("GET", f"/books/{i}")
+                    seen.add(check.getresponse().read())
+                    check.close()
+                mismatches += len(seen) > 1
+        finally:
+            server.terminate()
+            server.wait()
+
+    latencies = [latency for batch, _ in collected for latency in batch]
+    return {
+        "workers": workers,
+        "requests_per_sec": round(len(latencies) / elapsed, 1),
+        "latency_ms": percentiles(latencies),
+        "errors": sum(errors for _, errors in collected),
+        "inconsistent_reads": mismatches,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--books", type=int, default=10_000)
+    parser.add_argument("--storage", default="sqlite")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs, {args.storage} storage, {args.clients} clients, {args.seconds}s per run")
+    for workers in args.workers:
+        print(json.dumps(run(workers, args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,568 @@
+"""Load test: scripted workload mixes and trace replay against the API, with regression gating
+
+Drives ``app.main:app`` either in-process, by calling the ASGI application
+directly (lifespan included, no sockets), or over HTTP against a local
+``uvicorn`` started for the run. A catalog of ``--records`` books is seeded
+through the bulk endpoint, then each scenario runs ``--concurrency``
+virtual users, each on its own keep-alive connection, for ``--duration``
+seconds:
+
+- ``read-heavy``: lookups by id, keyset pages and author filters, 5% updates
+- ``write-heavy``: inserts, updates and deletes of the users' own books, 10% reads
+- ``bulk``: NDJSON bulk inserts of ``--bulk-size`` books
+- ``search``: ranked searches and autocomplete on catalog words
+- ``replay``: the requests of ``--replay FILE`` in order, once per ``--replay-loops``
+
+A trace is either JSON lines with ``method``, ``path`` and optionally
+``body`` (which JSON access logs already are) or a text access log; other
+lines are skipped. Access logs record paths without their query strings
+and cut long bodies short (those are sent empty), so a hand-written trace
+replays more faithfully. Results (throughput, p50/p95/p99 latency, server RSS)
+are printed and, with ``--output``, saved as JSON. With ``--baseline`` the
+run is compared to a saved result and exits with status 1 if throughput
+dropped or a latency percentile grew by more than ``--threshold``.
+
+Usage: python -m benchmarks.loadtest [--target inprocess|uvicorn] [--scenarios read-heavy search ...]
+                                     [--records 10000] [--concurrency 8] [--duration 10]
+                                     [--replay logs/api.log] [--output results.json]
+                                     [--baseline baseline.json] [--threshold 0.15]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote, unquote
+
+from app.flusher import percentiles
+from benchmarks.bench_search import make_catalog
+
+SCENARIOS = ("read-heavy", "write-heavy", "bulk", "search")
+# Compared against the baseline: throughput must not drop, latencies must not grow
+GATED_LATENCIES = ("p50", "p95", "p99")
+# Ids of books created during the run start here, per virtual user, clear of the seeded catalog
+CREATED_ID_BASE = 1_000_000_000
+CREATED_ID_STRIDE = 10_000_000
+SEED_BATCH = 20_000
+
+# Requests are (method, path with query, body bytes)
+Request = Tuple[str, str, bytes]
+Send = Callable[[str, str, bytes], Awaitable[Tuple[int, int]]]
+
+
+# -------------------------
+# Clients
+# -------------------------
+class AsgiClient:
+    """Calls an ASGI application directly, running its lifespan around the test"""
+
+    def __init__(self, app):
+        self.app = app
+        self._to_app: asyncio.Queue = asyncio.Queue()
+        self._from_app: asyncio.Queue = asyncio.Queue()
+        self._lifespan: Optional[asyncio.Task] = None
+
+    async def start(self):
+        scope = {"type": "lifespan", "asgi": {"version": "3.0"}, "state": {}}
+        self._lifespan = asyncio.create_task(self.app(scope, self._to_app.get, self._from_app.put))
+        await self._to_app.put({"type": "lifespan.startup"})
+        message = await self._from_app.get()
+        if message["type"] != "lifespan.startup.complete":
+            raise RuntimeError(f"Application startup failed: {message}")
+
+    async def stop(self):
+        await self._to_app.put({"type": "lifespan.shutdown"})
+        await self._from_app.get()
+        await self._lifespan
+
+    def connection(self) -> Send:
+        return self.request
+
+    async def request(self, method: str, path: str, body: bytes = b"") -> Tuple[int, int]:
+        path, _, query = path.partition("?")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": unquote(path),
+            "raw_path": path.encode(),
+            "query_string": query.encode(),
+            "root_path": "",
+            "headers": [(b"host", b"loadtest"), (b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode())],
+            "client": ("127.0.0.1", 50000),
+            "server": ("loadtest", 80),
+        }
+        done = asyncio.Event()
+        received = False
+        status = 0
+        size = 0
+
+        async def receive() -> dict:
+            nonlocal received
+            if not received:
+                received = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # Only report a disconnect once the response is complete, like a patient client
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message: dict):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+                if not message.get("more_body", False):
+                    done.set()
+
+        await self.app(scope, receive, send)
+        done.set()
+        return status, size
+
+
+class HttpConnection:
+    """Minimal HTTP/1.1 keep-alive client on asyncio streams"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def _read_body(self, headers: Dict[str, str]) -> bytes:
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                length = int((await self._reader.readline()).split(b";")[0], 16)
+                chunks.append((await self._reader.readexactly(length + 2))[:length])
+                if not length:
+                    return b"".join(chunks)
+        return await self._reader.readexactly(int(headers.get("content-length", 0)))
+
+    async def request(self, method: str, path: str, body: bytes = b"") -> Tuple[int, int]:
+        status, content = await self.fetch(method, path, body)
+        return status, len(content)
+
+    async def fetch(self, method: str, path: str, body: bytes = b"") -> Tuple[int, bytes]:
+        """Send a request and return its status and body"""
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        head = (f"{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n")
+        self._writer.write(head.encode() + body)
+        status = int((await self._reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        content = await self._read_body(headers)
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, content
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class UvicornClient:
+    """Runs ``uvicorn app.main:app`` in a subprocess and opens connections to it"""
+
+    def __init__(self, env: Dict[str, str], port: int, workers: int):
+        self.env = env
+        self.port = port
+        self.workers = workers
+        self.process: Optional[subprocess.Popen] = None
+        self._connections: List[HttpConnection] = []
+
+    async def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(self.port),
+             "--workers", str(self.workers), "--log-level", "warning"],
+            env=self.env,
+        )
+        deadline = time.perf_counter() + 120
+        while time.perf_counter() < deadline:
+            try:
+                status, _ = await HttpConnection("127.0.0.1", self.port).request("GET", "/health")
+                if status == 200:
+                    return
+            except OSError:
+                pass
+            await asyncio.sleep(0.1)
+        raise RuntimeError("uvicorn did not become ready")
+
+    async def stop(self):
+        for connection in self._connections:
+            connection.close()
+        self.process.terminate()
+        self.process.wait()
+
+    def connection(self) -> Send:
+        connection = HttpConnection("127.0.0.1", self.port)
+        self._connections.append(connection)
+        return connection.request
+
+
+# -------------------------
+# Workloads
+# -------------------------
+class Catalog:
+    """What the scenarios know about the seeded books"""
+
+    def __init__(self, books: List[dict]):
+        self.size = len(books)
+        self.authors = sorted({book["author"] for book in books})
+        words = Counter(word for book in books[:20_000] for word in book["title"].split())
+        self.words = [word for word, _ in words.most_common(2000)]
+
+
+def _book(book_id: int, rng: random.Random, catalog: Catalog) -> dict:
+    title = " ".join(rng.choices(catalog.words, k=rng.randint(2, 5)))
+    return {"id": book_id, "title": title, "author": rng.choice(catalog.authors), "year": rng.randint(1900, 2024)}
+
+
+def read_heavy(rng: random.Random, catalog: Catalog, user: int) -> Callable[[], Request]:
+    def next_request() -> Request:
+        roll = rng.random()
+        book_id = rng.randrange(catalog.size)
+        if roll < 0.70:
+            return "GET", f"/books/{book_id}", b""
+        if roll < 0.85:
+            return "GET", f"/books?limit=50&after={book_id}", b""
+        if roll < 0.95:
+            return "GET", f"/books?author={quote(rng.choice(catalog.authors))}&limit=20", b""
+        return "PUT", f"/books/{book_id}", json.dumps(_book(book_id, rng, catalog)).encode()
+    return next_request
+
+
+def write_heavy(rng: random.Random, catalog: Catalog, user: int) -> Callable[[], Request]:
+    created: List[int] = []
+    next_id = CREATED_ID_BASE + user * CREATED_ID_STRIDE
+
+    def next_request() -> Request:
+        nonlocal next_id
+        roll = rng.random()
+        if roll < 0.4 or not created:
+            next_id += 1
+            created.append(next_id)
+            return "POST", "/books", json.dumps(_book(next_id, rng, catalog)).encode()
+        if roll < 0.8:
+            book_id = rng.choice(created)
+            return "PUT", f"/books/{book_id}", json.dumps(_book(book_id, rng, catalog)).encode()
+        if roll < 0.9:
+            return "DELETE", f"/books/{created.pop(rng.randrange(len(created)))}", b""
+        return "GET", f"/books/{rng.randrange(catalog.size)}", b""
+    return next_request
+
+
+def bulk(rng: random.Random, catalog: Catalog, user: int, size: int = 500) -> Callable[[], Request]:
+    next_id = CREATED_ID_BASE + (user + 500) * CREATED_ID_STRIDE
+
+    def next_request() -> Request:
+        nonlocal next_id
+        rows = []
+        for _ in range(size):
+            next_id += 1
+            rows.append(json.dumps(_book(next_id, rng, catalog)))
+        return "POST", "/books/bulk", "\n".join(rows).encode()
+    return next_request
+
+
+def search(rng: random.Random, catalog: Catalog, user: int) -> Callable[[], Request]:
+    def next_request() -> Request:
+        if rng.random() < 0.7:
+            query = " ".join(rng.sample(catalog.words[:500], rng.randint(1, 2)))
+            return "GET", f"/books/search?q={quote(query)}&limit=10", b""
+        word = rng.choice(catalog.words)
+        return "GET", f"/books/suggest?prefix={quote(word[:rng.randint(1, 3)])}", b""
+    return next_request
+
+
+WORKLOADS = {"read-heavy": read_heavy, "write-heavy": write_heavy, "bulk": bulk, "search": search}
+
+
+# -------------------------
+# Trace replay
+# -------------------------
+_TEXT_RESPONSE = re.compile(r"Response: ([A-Z]+) (\S+) - Status: \d+ - Time: [\d.]+ms(?: - Body: (.*))?$")
+_TEXT_LEGACY = re.compile(r" - ([A-Z]+) (\S+) - Request received - payload: (.*)$")
+_TRUNCATED = re.compile(r"\.\.\. \(\d+ bytes\)$")
+
+
+def _body(value: Any) -> bytes:
+    if value in (None, "", "None"):
+        return b""
+    if not isinstance(value, str):
+        return json.dumps(value).encode()
+    # A body the access log cut short cannot be replayed faithfully
+    return b"" if _TRUNCATED.search(value) else value.encode()
+
+
+def load_trace(path: str) -> List[Request]:
+    """Requests of a JSON-lines trace or an access log, in order"""
+    requests = []
+    with open(path, "r", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("{"):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(entry, dict) or "method" not in entry or "path" not in entry:
+                    continue
+                # JSON access logs hold a request and a response line per request; keep the responses
+                if "message" in entry and "status" not in entry:
+                    continue
+                requests.append((entry["method"], entry["path"], _body(entry.get("body"))))
+                continue
+            match = _TEXT_RESPONSE.search(line) or _TEXT_LEGACY.search(line)
+            if match:
+                requests.append((match.group(1), match.group(2), _body(match.group(3))))
+    if not requests:
+        raise ValueError(f"No requests found in {path}")
+    return requests
+
+
+def replay(trace: List[Request], loops: int) -> Callable[[], Optional[Request]]:
+    position = 0
+
+    def next_request() -> Optional[Request]:
+        nonlocal position
+        if position >= len(trace) * loops:
+            return None
+        position += 1
+        return trace[(position - 1) % len(trace)]
+    return next_request
+
+
+# -------------------------
+# Measurement
+# -------------------------
+def process_memory(pid: int) -> Dict[str, Optional[float]]:
+    """Current and peak resident memory of a process in MB (Linux only)"""
+    memory = {"rss_mb": None, "peak_rss_mb": None}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    memory["rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+                elif line.startswith("VmHWM:"):
+                    memory["peak_rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return memory
+
+
+async def run_scenario(client, sources: List[Callable[[], Optional[Request]]], duration: float,
+                       warmup: float) -> dict:
+    """Run one virtual user per request source until the duration ends or every source is exhausted"""
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    started = time.perf_counter()
+    measure_from = started + warmup
+    deadline = measure_from + duration
+
+    async def user(next_request: Callable[[], Optional[Request]]):
+        send = client.connection()
+        while time.perf_counter() < deadline:
+            request = next_request()
+            if request is None:
+                return
+            method, path, body = request
+            sent = time.perf_counter()
+            try:
+                status, _ = await send(method, path, body)
+            except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                status = 0
+            if sent >= measure_from:
+                latencies.append((time.perf_counter() - sent) * 1000)
+                statuses[status] += 1
+
+    await asyncio.gather(*(user(source) for source in sources))
+    elapsed = max(time.perf_counter() - max(measure_from, started), 1e-9)
+    errors = sum(count for status, count in statuses.items() if status == 0 or status >= 400)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "latency_ms": percentiles(latencies),
+    }
+
+
+async def seed(client, books: List[dict]):
+    send = client.connection()
+    for start in range(0, len(books), SEED_BATCH):
+        rows = "\n".join(json.dumps(book) for book in books[start:start + SEED_BATCH])
+        status, _ = await send("POST", "/books/bulk", rows.encode())
+        if status != 200:
+            raise RuntimeError(f"Seeding failed with status {status}")
+
+
+async def run(args, env: Dict[str, str]) -> dict:
+    books = list(make_catalog(args.records, random.Random(args.seed)).values())
+    catalog = Catalog(books)
+    if args.target == "inprocess":
+        # The application reads its configuration at import, so it is imported once the environment is set
+        os.environ.update(env)
+        from app.main import app
+        client = AsgiClient(app)
+        pid = os.getpid()
+    else:
+        client = UvicornClient(env, args.port, args.workers)
+        pid = None
+
+    await client.start()
+    results: Dict[str, dict] = {}
+    try:
+        pid = pid or client.process.pid
+        await seed(client, books)
+        del books
+        for name in args.scenarios:
+            if name == "replay":
+                trace = load_trace(args.replay)
+                shared = replay(trace, args.replay_loops)
+                sources = [shared] * args.concurrency
+                result = await run_scenario(client, sources, float("inf"), 0)
+            else:
+                factory = WORKLOADS[name]
+                sources = [
+                    factory(random.Random(args.seed * 1000 + user), catalog, user, args.bulk_size)
+                    if name == "bulk" else factory(random.Random(args.seed * 1000 + user), catalog, user)
+                    for user in range(args.concurrency)
+                ]
+                result = await run_scenario(client, sources, args.duration, args.warmup)
+            result.update(process_memory(pid))
+            results[name] = result
+            print(f"{name:12} {result['throughput_rps']:9.1f} req/s  p50 {result['latency_ms']['p50']} ms  "
+                  f"p95 {result['latency_ms']['p95']} ms  p99 {result['latency_ms']['p99']} ms  "
+                  f"errors {result['errors']}/{result['requests']}  rss {result['rss_mb']} MB", flush=True)
+    finally:
+        await client.stop()
+    return results
+
+
+# -------------------------
+# Baseline comparison
+# -------------------------
+def compare(baseline: dict, current: dict, threshold: float, min_delta_ms: float) -> List[str]:
+    """Regressions of current against baseline, as messages; scenarios missing from either are skipped"""
+    regressions = []
+    for name, result in current["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+        if result["throughput_rps"] < before["throughput_rps"] * (1 - threshold):
+            regressions.append(f"{name}: throughput {result['throughput_rps']} req/s, "
+                               f"baseline {before['throughput_rps']} req/s")
+        for point in GATED_LATENCIES:
+            now, then = result["latency_ms"][point], before["latency_ms"][point]
+            if now is None or then is None:
+                continue
+            if now > then * (1 + threshold) and now - then > min_delta_ms:
+                regressions.append(f"{name}: {point} latency {now} ms, baseline {then} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", choices=["inprocess", "uvicorn"], default="inprocess")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS + ("replay",), default=list(SCENARIOS))
+    parser.add_argument("--records", type=int, default=10_000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=1.0, help="unmeasured seconds before each scenario")
+    parser.add_argument("--bulk-size", type=int, default=500)
+    parser.add_argument("--replay", help="trace to replay (JSON lines or an access log)")
+    parser.add_argument("--replay-loops", type=int, default=1)
+    parser.add_argument("--storage", help="LIBRARY_STORAGE for the run (default: the application's)")
+    parser.add_argument("--durability", help="LIBRARY_DURABILITY for the run")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--port", type=int, default=8767)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results saved by an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.15, help="tolerated relative regression")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="latency growth below this many milliseconds is never a regression")
+    args = parser.parse_args()
+    if "replay" in args.scenarios and not args.replay:
+        parser.error("the replay scenario needs --replay FILE")
+    if args.replay and "replay" not in args.scenarios:
+        args.scenarios.append("replay")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ("books", "readers", "staff"):
+            with open(os.path.join(directory, f"{name}.json"), "w") as f:
+                f.write("[]")
+        env = dict(
+            os.environ,
+            LIBRARY_DATA_DIR=directory,
+            LIBRARY_LOG_FILE=os.path.join(directory, "app.log"),
+            LIBRARY_ACCESS_LOG_FILE=os.path.join(directory, "api.log"),
+            LIBRARY_LOG_BODY="off",
+        )
+        if args.storage:
+            env["LIBRARY_STORAGE"] = args.storage
+        if args.durability:
+            env["LIBRARY_DURABILITY"] = args.durability
+        print(f"{args.target}, {args.records} books, {args.concurrency} users, {args.duration}s per scenario, "
+              f"{env.get('LIBRARY_STORAGE', 'json')} storage", flush=True)
+        scenarios = asyncio.run(run(args, env))
+
+    results = {
+        "meta": {
+            "target": args.target,
+            "records": args.records,
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "storage": env.get("LIBRARY_STORAGE", "json"),
+            "durability": env.get("LIBRARY_DURABILITY", "sync"),
+            "workers": args.workers if args.target == "uvicorn" else None,
+            "replay": args.replay,
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "scenarios": scenarios,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        differing = [key for key in ("target", "records", "concurrency", "storage", "durability", "workers")
+                     if baseline.get("meta", {}).get(key) != results["meta"][key]]
+        if differing:
+            print(f"Warning: the baseline was run with a different {', '.join(differing)}")
+        regressions = compare(baseline, results, args.threshold, args.min_delta_ms)
+        if regressions:
+            print(f"REGRESSED against {args.baseline} (threshold {args.threshold:.0%}):")
+            for message in regressions:
+                print(f"  {message}")
+            raise SystemExit(1)
+        print(f"No regression against {args.baseline} (threshold {args.threshold:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""Stress test: mixed concurrent reads and writes against a persisted RecordStore
+
+Writer threads insert, update and delete records in their own key ranges
+while reader threads page, filter, search and fetch records. Every read is
+checked for consistency as it runs; afterwards the in-memory state, the
+secondary indexes and the reloaded persistence are checked against the
+writers' own bookkeeping.
+
+With ``--storage snapshot`` the store starts from a lazily decoded binary
+snapshot and builds its indexes in the background while the load runs.
+
+Usage: python -m benchmarks.stress_store [--records 50000] [--readers 8] [--writers 4]
+                                         [--seconds 5] [--durability group] [--storage journal]
+                                         [--layout dict]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Dict, List
+
+from app.flusher import FlushingPersistence
+from app.indexes import HashIndex, RangeIndex
+from app.layouts import RECORD_LAYOUTS, record_layout
+from app.models import Book
+from app.persistence import JournalPersistence, SnapshotPersistence
+from app.search import SearchIndex, tokenize
+from app.store import RecordStore
+
+AUTHORS = [f"Author {i}" for i in range(50)]
+WORDS = ["river", "night", "garden", "empire", "shadow", "winter", "letters", "journey"]
+KEY_SPACE = 1_000_000
+
+
+def make_book(key: int, rng: random.Random) -> dict:
+    title = " ".join(rng.sample(WORDS, 2))
+    return {"id": key, "title": title, "author": rng.choice(AUTHORS), "year": rng.randint(1900, 2020)}
+
+
+def open_store(path: str, durability: str, storage: str, layout: str, records=()) -> RecordStore:
+    inner = SnapshotPersistence(path) if storage == "snapshot" else JournalPersistence(path)
+    persistence = FlushingPersistence(inner, mode=durability, interval_ms=5)
+    indexes = {
+        "author": HashIndex("author", normalize=str.casefold),
+        "year": RangeIndex("year"),
+        "search": SearchIndex({"title": 2.0, "author": 1.0}),
+    }
+    if not records:
+        try:
+            records = persistence.load()
+        except FileNotFoundError:
+            records = []
+    return RecordStore(records, persistence=persistence, indexes=indexes,
+                       layout=record_layout(layout, "id", Book, interned=("author",)))
+
+
+class Failures:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.messages: List[str] = []
+
+    def add(self, message: str):
+        with self._lock:
+            if len(self.messages) < 20:
+                self.messages.append(message)
+
+
+def writer(store: RecordStore, slot: int, writers: int, own: List[int], expected: Dict[int, dict],
+           stop: threading.Event, counts: Counter, failures: Failures):
+    # Each writer owns the keys congruent to its slot, so it can track their expected state alone
+    rng = random.Random(slot)
+    ops = 0
+    while not stop.is_set():
+        action = rng.random()
+        try:
+            if action < 0.4 or not own:
+                key = rng.randrange(slot, KEY_SPACE, writers)
+                if key in expected:
+                    continue
+                record = make_book(key, rng)
+                store.insert(record)
+                expected[key] = record
+                own.append(key)
+            elif action < 0.8:
+                key = rng.choice(own)
+                record = make_book(key, rng)
+                store.update(key, record)
+                expected[key] = record
+            else:
+                key = own.pop(rng.randrange(len(own)))
+                store.delete(key)
+                del expected[key]
+            ops += 1
+        except Exception as e:
+            failures.add(f"writer {slot}: {e!r}")
+    counts["writes"] += ops
+
+
+def reader(store: RecordStore, slot: int, stop: threading.Event, counts: Counter, failures: Failures):
+    rng = random.Random(1000 + slot)
+    search = store.indexes["search"]
+    ops = 0
+    while not stop.is_set():
+        action = rng.randrange(5)
+        if action == 0:
+            after = rng.randrange(KEY_SPACE)
+            page = store.page(after, 100)
+            keys = [record["id"] for record in page]
+            if keys != sorted(keys) or (keys and keys[0] <= after) or len(set(keys)) != len(keys):
+                failures.add(f"page after {after} out of order: {keys[:5]}...")
+        elif action == 1:
+            author = rng.choice(AUTHORS)
+            for record in store.select({"author": author}):
+                if record["author"] != author:
+                    failures.add(f"author filter {author!r} returned {record}")
+                    break
+        elif action == 2:
+            low = rng.randint(1900, 2020)
+            for record in store.page(None, 200, {"year": (low, low + 5)}):
+                if not low <= record["year"] <= low + 5:
+                    failures.add(f"year filter {low}..{low + 5} returned {record}")
+                    break
+        elif action == 3:
+            word = rng.choice(WORDS)
+            # Searching and fetching in one read sees the index and the records at the same version
+            found = store.read(lambda: [store.get(key) for key, _ in search.search(word, 20)])
+            for record in found:
+                if record is None or word not in tokenize(record["title"]):
+                    failures.add(f"search {word!r} returned {record}")
+                    break
+        else:
+            key = rng.randrange(KEY_SPACE)
+            record = store.get(key)
+            if record is not None and record["id"] != key:
+                failures.add(f"get {key} returned {record}")
+        ops += 1
+    counts["reads"] += ops
+
+
+def verify(store: RecordStore, expected: Dict[int, dict], failures: Failures):
+    if len(store) != len(expected):
+        failures.add(f"store holds {len(store)} records, expected {len(expected)}")
+    for key, record in expected.items():
+        if store.get(key) != record:
+            failures.add(f"record {key}: {store.get(key)} != {record}")
+            break
+    if list(store._order) != sorted(expected):
+        failures.add("key order does not match the records")
+    for author in AUTHORS:
+        indexed = store.indexes["author"].match(author)
+        if indexed != {key for key, record in expected.items() if record["author"] == author}:
+            failures.add(f"author index for {author!r} is inconsistent")
+            break
+    if store.indexes["year"].match((None, None)) != set(expected):
+        failures.add("year index is inconsistent")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=50_000)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--durability", choices=["sync", "group", "async"], default="group")
+    parser.add_argument("--storage", choices=["journal", "snapshot"], default="journal")
+    parser.add_argument("--layout", choices=RECORD_LAYOUTS, default="dict")
+    parser.add_argument("--switch-interval", type=float, default=None,
+                        help="GIL switch interval in seconds; lower it to let writers wake up sooner")
+    args = parser.parse_args()
+    if args.switch_interval is not None:
+        sys.setswitchinterval(args.switch_interval)
+
+    rng = random.Random(0)
+    initial = [make_book(key, rng) for key in rng.sample(range(KEY_SPACE), args.records)]
+    expected = {record["id"]: record for record in initial}
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "books.snap" if args.storage == "snapshot" else "books.json")
+        store = open_store(path, args.durability, args.storage, args.layout, initial)
+        store.save()
+        if args.storage == "snapshot":
+            store.close()
+            store = open_store(path, args.durability, args.storage, args.layout)
+
+        owned: Dict[int, List[int]] = {slot: [] for slot in range(args.writers)}
+        for key in expected:
+            if args.writers:
+                owned[key % args.writers].append(key)
+        stop = threading.Event()
+        counts: Counter = Counter()
+        failures = Failures()
+        threads = [
+            threading.Thread(target=writer, args=(store, slot, args.writers, owned[slot], expected, stop, counts,
+                                                  failures))
+            for slot in range(args.writers)
+        ] + [
+            threading.Thread(target=reader, args=(store, slot, stop, counts, failures))
+            for slot in range(args.readers)
+        ] + [
+            threading.Thread(target=store.build_indexes)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        verify(store, expected, failures)
+        store.close()
+        reloaded = open_store(path, args.durability, args.storage, args.layout)
+        if {record["id"]: record for record in reloaded.values()} != expected:
+            failures.add("reloaded persistence differs from the final in-memory state")
+        reloaded.close()
+
+    print(f"{args.writers} writers, {args.readers} readers, {args.storage} storage, {args.layout} layout, "
+          f"{args.durability} durability, {elapsed:.1f}s")
+    print(f"  writes: {counts['writes']} ({counts['writes'] / elapsed:.0f}/s)")
+    print(f"  reads:  {counts['reads']} ({counts['reads'] / elapsed:.0f}/s)")
+    if failures.messages:
+        print("FAILED:")
+        for message in failures.messages:
+            print(f"  {message}")
+        raise SystemExit(1)
+    print("  consistency checks passed")
+
+
+if __name__ == "__main__":
+    main()
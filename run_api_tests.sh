@@ -82,6 +82,33 @@ echo ""
 echo "3. Testing error case - Get non-existent staff:"
 curl -X GET "http://localhost:8000/staff/999"
 
+echo ""
+echo ""
+echo "Testing Loan Endpoints:"
+echo "-----------------------"
+
+# Lend the book to the reader
+echo "1. Lending book 1 to reader 1:"
+curl -X POST "http://localhost:8000/loans" \
+     -H "Content-Type: application/json" \
+     -d '{"id": 1, "book_id": 1, "reader_id": 1}'
+
+echo ""
+echo "2. Testing error case - Change the ID of a book on loan (expect 409):"
+curl -X PUT "http://localhost:8000/books/1" \
+     -H "Content-Type: application/json" \
+     -d '{"id": 2, "title": "The Great Gatsby", "author": "F. Scott Fitzgerald", "year": 1925}'
+
+echo ""
+echo "3. Testing error case - Change the ID of a reader with loans (expect 409):"
+curl -X PUT "http://localhost:8000/readers/1" \
+     -H "Content-Type: application/json" \
+     -d '{"id": 2, "name": "John Doe", "membership_id": "MEM001"}'
+
+echo ""
+echo "4. Returning the book:"
+curl -X POST "http://localhost:8000/loans/1/return"
+
 echo ""
 echo ""
 echo "Final Health Check:"